@@ -10,6 +10,16 @@ ALLOWED_HOSTS = ['*']
 
 STATIC_ROOT = STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
+# Content-hashed, pre-compressed static files (served by eda.static.serve)
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "eda.storage.CompressedManifestStaticFilesStorage",
+    },
+}
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
 EMAIL_HOST = "smtp.gmail.com"
@@ -0,0 +1,78 @@
+"""
+Serve collected static files, choosing a pre-compressed copy (see
+eda.storage) if the client accepts one, and letting browsers cache files
+with content-hashed names forever.
+"""
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+import mimetypes
+import os
+import posixpath
+
+
+mimetypes.add_type('application/geo+json', '.geojson')
+mimetypes.add_type('application/json', '.topojson')
+
+# Best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+def _accepted_encodings(request):
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _is_hashed(path):
+    # Only the manifest storage knows which names include a hash
+    return path in getattr(staticfiles_storage, 'hashed_files', {}).values()
+
+
+def serve(request, path):
+
+    path = posixpath.normpath(path).lstrip('/')
+    fullpath = safe_join(settings.STATIC_ROOT, path)
+    if not os.path.isfile(fullpath) or fullpath.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+        raise Http404(f"'{path}' does not exist")
+
+    statobj = os.stat(fullpath)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), statobj.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+
+    send, content_encoding = fullpath, encoding
+    if not encoding:
+        accepted = _accepted_encodings(request)
+        for coding, suffix in ENCODINGS:
+            if coding in accepted and os.path.isfile(fullpath + suffix):
+                send, content_encoding = fullpath + suffix, coding
+                break
+
+    response = FileResponse(open(send, 'rb'), content_type=content_type)
+    response.headers['Last-Modified'] = http_date(statobj.st_mtime)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+
+    if _is_hashed(path):
+        patch_cache_control(response, public=True, max_age=ONE_YEAR, immutable=True)
+    else:
+        # Same name, possibly different content next time - check first
+        patch_cache_control(response, public=True, no_cache=True)
+
+    return response
@@ -0,0 +1,73 @@
+"""
+Static file storage that adds content hashes to file names (so they
+can be cached forever) and writes pre-compressed copies of each text
+file alongside it, for eda.static.serve to hand out.
+"""
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ('.css', '.js', '.json', '.geojson', '.topojson', '.svg', '.html', '.txt', '.map', '.ico')
+
+# Not worth it for anything smaller than this
+MIN_SIZE = 512
+
+
+def compress(path):
+    """
+    Write .gz (and, if brotli is available, .br) copies of `path` - unless
+    they wouldn't be any smaller
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    # Fall back to the original name for anything not in the manifest
+    # (e.g. directories used as URL prefixes) rather than failing
+    manifest_strict = False
+
+    def url(self, name, force=False):
+        # Use the hashed names even with DEBUG on (as it is in production)
+        return super().url(name, force=True)
+
+    def url_converter(self, name, hashed_files, template=None):
+        converter = super().url_converter(name, hashed_files, template)
+
+        def tolerant_converter(matchobj):
+            try:
+                return converter(matchobj)
+            except ValueError:
+                # A reference to a file we don't ship, like a source map
+                return matchobj.group(0)
+
+        return tolerant_converter
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+
+        if dry_run:
+            return
+
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE) and self.exists(name) and self.size(name) >= MIN_SIZE:
+                compress(self.path(name))
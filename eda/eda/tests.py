@@ -0,0 +1,82 @@
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.utils.http import http_date
+
+import gzip
+import os
+import tempfile
+from unittest import mock
+
+from . import static, storage
+
+
+class StaticTests(SimpleTestCase):
+    """
+    Serving collected static files, pre-compressed where possible
+    """
+
+    def setUp(self):
+        self.root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STATIC_ROOT=self.root))
+        self.css = b'body { color: black; }\n' * 100
+        self.write('site.css', self.css)
+        storage.compress(os.path.join(self.root, 'site.css'))
+        # Brotli may not be installed, so make sure there's a .br to choose
+        self.write('site.css.br', b'brotli')
+        self.write('tiny.js', b'x')
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def serve(self, path, **headers):
+        """
+        Return the response to a request for `path`, and what it sent
+        """
+        response = static.serve(RequestFactory().get(f'/static/{path}', **headers), path)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_compress(self):
+        with gzip.open(os.path.join(self.root, 'site.css.gz')) as f:
+            self.assertEqual(f.read(), self.css)
+        # Not worth it when it'd be no smaller
+        storage.compress(os.path.join(self.root, 'tiny.js'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'tiny.js.gz')))
+
+    def test_encodings(self):
+        for accept, encoding in [('gzip, deflate, br', 'br'), ('gzip', 'gzip'), ('GZIP', 'gzip'),
+                                 ('br;q=0, gzip', 'gzip'), ('gzip;q=0.0, br;q=0.5', 'br'),
+                                 ('br;q=0,gzip;q=0', None), ('identity', None), ('', None)]:
+            with self.subTest(accept=accept):
+                response, content = self.serve('site.css', HTTP_ACCEPT_ENCODING=accept)
+                self.assertEqual(response.get('Content-Encoding'), encoding)
+                self.assertEqual(response['Content-Type'], 'text/css')
+                self.assertEqual(response['Vary'], 'Accept-Encoding')
+                if encoding == 'gzip':
+                    self.assertEqual(gzip.decompress(content), self.css)
+                elif encoding is None:
+                    self.assertEqual(content, self.css)
+        # Nothing to choose from
+        response, content = self.serve('tiny.js', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(content, b'x')
+
+    def test_not_found(self):
+        # Including the compressed copies themselves
+        for path in ['missing.css', 'site.css.gz', 'site.css.br', '']:
+            with self.subTest(path=path), self.assertRaises(Http404):
+                self.serve(path)
+
+    def test_caching(self):
+        with mock.patch.object(static, '_is_hashed', return_value=True):
+            response, content = self.serve('site.css')
+        self.assertEqual(response['Cache-Control'], f'public, max-age={static.ONE_YEAR}, immutable')
+        response, content = self.serve('site.css')
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        last_modified = response['Last-Modified']
+        response, content = self.serve('site.css', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        response, content = self.serve('site.css', HTTP_IF_MODIFIED_SINCE=http_date(0))
+        self.assertEqual(response.status_code, 200)
@@ -23,6 +23,8 @@ from django.views.generic import TemplateView, RedirectView
 from django.views.static import serve
 from django.urls import path, re_path, include
 
+from eda import static
+
 
 urlpatterns = [
 
@@ -68,3 +70,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
 ]
+
+# Collected (hashed and compressed) static files, where there are any
+if settings.STATIC_ROOT:
+    urlpatterns.append(re_path(r'^static/(?P<path>.*)$', static.serve))
@@ -1,7 +1,11 @@
 from django.contrib import admin
-from django.contrib.auth import get_permission_codename
+from django.core.exceptions import PermissionDenied
 from django.forms import ModelForm
-from django.utils.html import urlize, escape
+from django.http import JsonResponse
+from django.db import router, transaction
+from django.db.models import OuterRef, Subquery
+from django.urls import re_path, reverse
+from django.utils.html import format_html, format_html_join, urlize, escape
 from django.utils.safestring import mark_safe
 
 from search_admin_autocomplete.admin import SearchAutoCompleteAdmin
@@ -10,7 +14,10 @@ from simple_history.admin import SimpleHistoryAdmin
 
 # Register your models here.
 
-from .models import Contact, Tower, Photo, Website, Dove
+from . import autocomplete, matching, search
+from .invalidation import ALL_TOWERS, DOVE
+from .models import Contact, Tower, Photo, Website, Dove, DoveChange, DoveUpdate, batched_invalidation
+from .permissions import can_edit, editable_districts
 
 from position_widget.widgets import PositionInput
 
@@ -18,6 +25,92 @@ admin.site.site_header = "Ely DA Admin"
 admin.site.site_title = "Database admin"
 admin.site.index_title = "Database admin"
 
+### FILTERS
+
+
+class EditableListFilter(admin.SimpleListFilter):
+    """
+    Only show things in districts the current user can edit
+    """
+    title = "editable"
+    parameter_name = "editable"
+    # How to get from the model to the district
+    district_lookup = "district"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "Editable by me")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.filter(**{f"{self.district_lookup}__in": editable_districts(request)})
+        return queryset
+
+
+class TowerEditableListFilter(EditableListFilter):
+    district_lookup = "tower__district"
+
+
+class OurTowerListFilter(admin.SimpleListFilter):
+    """
+    Only show Dove changes to rings that one of our towers is linked to
+    """
+    title = "our towers"
+    parameter_name = "ours"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "Linked to one of our towers")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.exclude(our_tower=None)
+        return queryset
+
+
+### SEARCH
+
+
+def is_autocomplete(request):
+    """
+    Is `request` from an autocomplete widget (for a foreign key)?
+    """
+    return request is not None and getattr(request.resolver_match, 'url_name', None) == 'autocomplete'
+
+
+class PrefixSearchAutoCompleteAdmin(SearchAutoCompleteAdmin):
+    """
+    SearchAutoCompleteAdmin, with its suggestions (and the autocomplete
+    widgets of foreign keys to this model) served from an in-memory prefix
+    index of search_fields (see autocomplete.py) rather than a LIKE query
+    per keystroke
+    """
+    # The data generation the index is rebuilt on
+    autocomplete_dependency = ALL_TOWERS
+
+    def prefix_index(self):
+        return autocomplete.index(self.model._default_manager.all(), self.search_fields, self.autocomplete_dependency)
+
+    def get_urls(self):
+        # Unlike SearchAutoCompleteAdmin's, the suggestions need a login, and
+        # can be for several words
+        urls = super(SearchAutoCompleteAdmin, self).get_urls()
+        return [re_path(r'^search/(?P<search_term>[^/]{0,50})$', self.admin_site.admin_view(self.search_api))] + urls
+
+    def search_api(self, request, search_term):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        index = self.prefix_index()
+        opts = self.model._meta
+        return JsonResponse([{
+            'keyword': index.labels[pk],
+            'url': reverse(f'admin:{opts.app_label}_{opts.model_name}_change', args=(pk,)),
+        } for pk in index.complete(search_term, self.max_results)], safe=False)
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and is_autocomplete(request):
+            return queryset.filter(pk__in=self.prefix_index().complete(search_term, limit=None)), False
+        return super().get_search_results(request, queryset, search_term)
+
+
 ### INLINES
 
 
@@ -26,19 +119,19 @@ class ContactInline(admin.TabularInline):
     extra = 0
 
     def has_add_permission(self, request, obj):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_add_permission(request, obj)
 
     def has_change_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
     def has_delete_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_delete_permission(request, obj)
@@ -49,19 +142,19 @@ class WebsiteInline(admin.TabularInline):
     extra = 0
 
     def has_add_permission(self, request, obj):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_add_permission(request, obj)
 
     def has_change_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
     def has_delete_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_delete_permission(request, obj)
@@ -74,19 +167,19 @@ class PhotoInline(admin.StackedInline):
     extra = 0
 
     def has_add_permission(self, request, obj):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_add_permission(request, obj)
 
     def has_change_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
     def has_delete_permission(self, request, obj=None):
-        if object and request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        if obj and can_edit(request, obj.district):
             return True
         else:
             return super().has_delete_permission(request, obj)
@@ -101,14 +194,30 @@ class MyTowerAdminForm(ModelForm):
         }
         fields = '__all__' # required for Django 3.x
 
-class TowerAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
+class TowerAdmin(PrefixSearchAutoCompleteAdmin, SimpleHistoryAdmin):
     form = MyTowerAdminForm
     inlines = [ContactInline, WebsiteInline, PhotoInline]
     list_display = ["__str__", "district", "bells"]
-    list_filter = ["district", "report", "bells", "ringing_status", "ring_type", "practice_day"]
+    list_filter = [EditableListFilter, "district", "report", "bells", "ringing_status", "ring_type", "practice_day"]
     search_fields = ["place", "dedication", "full_dedication", "nickname"]
-    search_help_text = "Search by place or dedication"
-    readonly_fields = ["os_grid", "dove_link_html", "bellboard_link_html", "felstead_link_html"]
+    search_help_text = "Search by place, dedication, nickname, notes, service or practice"
+    readonly_fields = ["os_grid", "dove_link_html", "dove_suggestions", "bellboard_link_html", "felstead_link_html"]
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        # A tower and its inlines are saved in the same transaction, so
+        # invalidate what they affect once, rather than for each of them
+        with transaction.atomic(using=router.db_for_write(self.model)), batched_invalidation():
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+    def get_search_results(self, request, queryset, search_term):
+        '''
+        Search with the full-text index (see search.py), falling back to
+        the standard search for anything it can't make sense of (and
+        leaving tower pickers to the prefix index)
+        '''
+        if is_autocomplete(request) or not search.match_expression(search_term):
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(pk__in=search.search(search_term, limit=None)), False
 
     def has_change_permission(self, request, obj=None):
         '''
@@ -117,7 +226,7 @@ class TowerAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
         '''
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.get_district_display().lower()}"):
+        elif can_edit(request, obj.district):
             return True
         else:
             return super().has_change_permission(request, obj)
@@ -126,6 +235,24 @@ class TowerAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
     def dove_link_html(self, instance):
         return mark_safe(urlize(instance.dove_link, nofollow=True, autoescape=True))
 
+    @admin.display(description="Dove suggestions")
+    def dove_suggestions(self, instance):
+        """
+        The Dove rings that best match this tower (see matching.py), best first
+        """
+        if instance.pk is None:
+            return ""
+        suggestions = matching.suggest(instance)
+        if not suggestions:
+            return "No likely Dove rings nearby"
+        return format_html('<table>{}</table>', format_html_join(
+            "", '<tr><td>{}</td><td><a href="{}">RingID {}</a> TowerID {}</td><td>{} {}</td><td>{} bells</td><td>{}</td><td>{}</td></tr>',
+            ((score, reverse("admin:tower_database_dove_change", args=(ring.ringid,)), ring.ringid, ring.towerid,
+              ring.place, ring.dedication, ring.bells or "?",
+              f"{distance:.1f} km" if distance is not None else "",
+              "(linked)" if ring.ringid == instance.dove_ringid else "")
+             for score, distance, ring in suggestions)))
+
     def bellboard_link_html(self, instance):
         return mark_safe(urlize(instance.bellboard_link, nofollow=True, autoescape=True))
 
@@ -186,6 +313,7 @@ class TowerAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
                     "dove_ringid",
                     "dove_towerid",
                     "dove_link_html",
+                    "dove_suggestions",
                     "bellboard_link_html",
                     "towerbase_id",
                     "felstead_link_html",
@@ -199,60 +327,52 @@ class TowerAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
 
 
 
-class ContactAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
+class ContactAdmin(PrefixSearchAutoCompleteAdmin, SimpleHistoryAdmin):
     fields = ["tower", "role", "primary", "publish", "title", "forename", "name", "phone1", "phone2", "email", "form"]
+    autocomplete_fields = ["tower"]
     list_display = ["full_name", "tower", "role", "phone1", "phone2", "email"]
     readonly_fields = ["full_name"]
+    list_filter = [TowerEditableListFilter]
     search_fields = ["forename", "name", "phone1", "phone2", "email"]
     search_help_text = "Search by name, phone orr email"
 
     def has_change_permission(self, request, obj=None):
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
+        elif can_edit(request, obj.tower.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
-    def has_create_permission(self, request):
-        if request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
-            return True
-        else:
-            return super().has_create_permission(request)
-
     def has_delete_permission(self, request, obj=None):
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
+        elif can_edit(request, obj.tower.district):
             return True
         else:
             return super().has_delete_permission(request, obj)
 
 
-class WebsiteAdmin(SearchAutoCompleteAdmin, SimpleHistoryAdmin):
+class WebsiteAdmin(PrefixSearchAutoCompleteAdmin, SimpleHistoryAdmin):
     search_fields = ["url", "link_text"]
     search_help_text = "Search by website address or link text"
     fields = ["tower", "url", "link_text"]
+    autocomplete_fields = ["tower"]
     list_display = ["tower", "link_text", "url"]
+    list_filter = [TowerEditableListFilter]
 
     def has_change_permission(self, request, obj=None):
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
+        elif can_edit(request, obj.tower.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
-    def has_create_permission(self, request):
-        if request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
-            return True
-        else:
-            return super().has_create_permission(request)
-
     def has_delete_permission(self, request, obj=None):
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
+        elif can_edit(request, obj.tower.district):
             return True
         else:
             return super().has_delete_permission(request, obj)
@@ -262,26 +382,23 @@ class PhotoAdmin(SimpleHistoryAdmin):
     fields = ["tower", "image", "img_tag", "alt_text", "credit", "height", "width"]
     readonly_fields = ["height", "width", "img_tag"]
     list_display = ["tower", "height", "width", "img_tag"]
+    autocomplete_fields = ["tower"]
+    list_filter = [TowerEditableListFilter]
 
     def has_change_permission(self, request, obj=None):
         if obj == None:
             return True
-        elif request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
+        elif can_edit(request, obj.tower.district):
             return True
         else:
             return super().has_change_permission(request, obj)
 
-    def has_create_permission(self, request):
-        if request.user.has_perm(f"{self.opts.app_label}.admin_{obj.tower.get_district_display().lower()}"):
-            return True
-        else:
-            return super().has_create_permission(request)
-
-class DoveAdmin(SearchAutoCompleteAdmin):
+class DoveAdmin(PrefixSearchAutoCompleteAdmin):
     search_fields = ["place", "dedicn", "towerid", "ringid"]
     search_help_text = "Search by place or dedication (or tower or ring  ID)"
+    autocomplete_dependency = DOVE
     list_display = ["__str__", "county", "country", "bells"]
-    list_filter = ["bells", "ringtype", ("ur", admin.EmptyFieldListFilter), "county", "country", "diocese"]
+    list_filter = ["bells", "ringtype", "ur", "county", "country", "diocese"]
 
     def get_readonly_fields(self, request, obj=None):
         return [f.name for f in obj._meta.fields]
@@ -292,8 +409,73 @@ class DoveAdmin(SearchAutoCompleteAdmin):
     def has_add_permission(self, request):
         return False
 
+
+class DoveUpdateAdmin(admin.ModelAdmin):
+    list_display = ["time", "rings", "added", "removed", "changed", "changes_link", "snapshot"]
+
+    @admin.display(description="Changes")
+    def changes_link(self, obj):
+        url = reverse("admin:tower_database_dovechange_changelist")
+        return format_html('<a href="{}?update__id__exact={}">View changes</a>', url, obj.pk)
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.model._meta.fields]
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
+
+
+class DoveChangeAdmin(admin.ModelAdmin):
+    """
+    What changed in Dove at each load, for reviewing against our towers
+    """
+    list_display = ["__str__", "ringid", "kind", "changed_fields", "tower_link", "update", "reviewed"]
+    list_filter = [OurTowerListFilter, "kind", "reviewed", "update"]
+    search_fields = ["place", "dedication", "ringid", "towerid"]
+    fields = ["update", "ringid", "towerid", "place", "dedication", "kind", "field_changes", "tower_link", "reviewed"]
+    readonly_fields = ["update", "ringid", "towerid", "place", "dedication", "kind", "field_changes", "tower_link"]
+    actions = ["mark_reviewed"]
+
+    def get_queryset(self, request):
+        # The (first) tower of ours linked to each ring, in the same query
+        ours = Tower.objects.filter(dove_ringid=OuterRef("ringid")).order_by("pk")
+        return super().get_queryset(request).select_related("update").annotate(
+            our_tower=Subquery(ours.values("pk")[:1]), our_tower_place=Subquery(ours.values("place")[:1]))
+
+    @admin.display(description="Fields")
+    def changed_fields(self, obj):
+        return ", ".join(sorted(obj.fields))
+
+    @admin.display(description="Changes")
+    def field_changes(self, obj):
+        return format_html('<table>{}</table>', format_html_join(
+            "", "<tr><th>{}</th><td>{}</td><td>&rarr;</td><td>{}</td></tr>",
+            ((name, old, new) for name, (old, new) in sorted(obj.fields.items()))))
+
+    @admin.display(description="Our tower")
+    def tower_link(self, obj):
+        if obj.our_tower is None:
+            return ""
+        return format_html('<a href="{}">{}</a>', reverse("admin:tower_database_tower_change", args=(obj.our_tower,)),
+                           obj.our_tower_place)
+
+    @admin.action(description="Mark selected changes as reviewed", permissions=["change"])
+    def mark_reviewed(self, request, queryset):
+        self.message_user(request, f"{queryset.update(reviewed=True)} changes marked as reviewed")
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
+
 admin.site.register(Contact, ContactAdmin)
 admin.site.register(Tower, TowerAdmin)
 admin.site.register(Dove, DoveAdmin)
+admin.site.register(DoveUpdate, DoveUpdateAdmin)
+admin.site.register(DoveChange, DoveChangeAdmin)
 admin.site.register(Photo, PhotoAdmin)
 admin.site.register(Website, WebsiteAdmin)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class TowerDatabaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tower_database'
+
+    def ready(self):
+        from . import permissions, search
+        permissions.connect_signals()
+        search.connect_signals()
@@ -0,0 +1,92 @@
+"""
+Autocompletion for the admin's search boxes and tower pickers.
+
+Each model (and set of fields) being completed has an in-memory index:
+a sorted list of every word-aligned tail of each object's text ('S Mary
+the Virgin' gives 's mary the virgin', 'mary the virgin', 'the virgin'
+and 'virgin'), so the objects whose text has a word starting with what's
+been typed are a contiguous run found by binary search. An index is
+built the first time it's needed for each generation of the underlying
+data (see invalidation.py) and kept for as long as that generation is
+current, so a keystroke is just a bisect and a short scan.
+"""
+
+from unidecode import unidecode
+
+import bisect
+import re
+
+from .invalidation import get_generation
+
+
+# How many suggestions to give by default
+LIMIT = 10
+
+
+def normalise(text):
+    """
+    Fold `text` to lower case, plain ASCII words separated by single spaces
+    """
+    return ' '.join(re.findall(r'\w+', unidecode(text).lower()))
+
+
+class PrefixIndex:
+    """
+    A static prefix index over a list of (primary key, label, text)
+    """
+
+    def __init__(self, items):
+        self.labels = {}
+        tails = []
+        for pk, label, text in items:
+            self.labels[pk] = label
+            words = normalise(text).split()
+            tails.extend((' '.join(words[i:]), pk) for i in range(len(words)))
+        tails.sort()
+        self._tails = [tail for tail, _ in tails]
+        self._pks = [pk for _, pk in tails]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def complete(self, term, limit=LIMIT):
+        """
+        Return the primary keys of (up to `limit` of, or with None all) the
+        objects with a word starting with `term`, or a run of words starting
+        with it if it's several words
+        """
+
+        term = normalise(term)
+        if not term:
+            return []
+        found = {}
+        i = bisect.bisect_left(self._tails, term)
+        while i < len(self._tails) and self._tails[i].startswith(term):
+            found[self._pks[i]] = None
+            if limit is not None and len(found) >= limit:
+                break
+            i += 1
+        return list(found)
+
+
+_indexes = {}
+
+
+def index(queryset, fields, dependency):
+    """
+    Return the prefix index of the `fields` of `queryset`'s rows, building
+    it if the data it comes from (`dependency`) has changed. The label of
+    each row is its non-blank fields separated by commas.
+    """
+
+    key = (queryset.model._meta.label, tuple(fields))
+    generation = get_generation(dependency)
+    cached = _indexes.get(key)
+    if cached is None or cached[0] != generation:
+        items = []
+        for pk, *values in queryset.order_by().values_list('pk', *fields):
+            values = [str(value) for value in values if value]
+            items.append((pk, ', '.join(values), ' '.join(values)))
+        cached = (generation, PrefixIndex(items))
+        _indexes[key] = cached
+    return cached[1]
@@ -0,0 +1,347 @@
+"""
+Boundary overlays for the map, simplified for each zoom band.
+
+The source GeoJSON files in static/tower_database/map are far more
+detailed than the map can show at most zoom levels. For each layer and
+each zoom band this builds a TopoJSON document in which:
+
+  * the boundaries are broken into 'arcs' shared between the polygons
+    either side of them, so each shared edge is stored (and simplified)
+    once and neighbouring polygons can't drift apart;
+  * each arc is simplified with Douglas-Peucker to about a pixel at the
+    most detailed zoom in the band;
+  * coordinates are quantized to a grid a fraction of that size and
+    delta-encoded as small integers.
+
+The results are written under SNAPSHOT_ROOT/boundaries, named after the
+source file they came from, so they're rebuilt whenever it changes.
+"""
+
+from django.conf import settings
+
+from geojson import dumps
+
+import glob
+import json
+import os
+import tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SOURCE_DIR = os.path.join(os.path.dirname(__file__), 'static', 'tower_database', 'map')
+BOUNDARY_DIR = os.path.join(settings.SNAPSHOT_ROOT, 'boundaries')
+
+# Layer name (as used in map.js): source file, properties to keep (None for all)
+LAYERS = {
+    'association': ('Association.geojson', None),
+    'districts': ('Districts.geojson', None),
+    'deaneries': ('Deaneries.geojson', None),
+    'parishes': ('Parishes.geojson', None),
+    'benifices': ('Benifices.geojson', None),
+    'counties': ('BoundaryCeremonial.geojson', ['name']),
+}
+
+# The lowest zoom in each band, in order. The last band has full detail
+ZOOM_BANDS = [0, 10, 12, 14]
+
+# Quantization of the source coordinates, in steps per degree. Fine enough
+# to keep all the detail we'd ever show while still matching shared points
+PRECISION = 10 ** 6
+
+# Tolerance for each band, as a fraction of a pixel at its most detailed zoom
+TOLERANCE = 1.0
+# ...and the size of the grid for the output coordinates, likewise
+QUANTUM = 0.25
+
+
+def band(zoom):
+    """
+    Return the lowest zoom of the band containing `zoom`
+    """
+    return max(b for b in ZOOM_BANDS if b <= max(zoom, 0))
+
+
+def _pixel(zoom):
+    # Degrees of longitude per 256 pixel tile pixel at `zoom`
+    return 360 / (256 * 2 ** zoom)
+
+
+def _band_steps(band):
+    """
+    Return (tolerance, quantum) in PRECISION steps for `band`
+    """
+
+    later = [b for b in ZOOM_BANDS if b > band]
+    if not later:
+        return 0, 1
+    pixel = _pixel(later[0] - 1) * PRECISION
+    return TOLERANCE * pixel, max(1, round(QUANTUM * pixel))
+
+
+# Topology
+
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(f"Unsupported geometry type {geometry['type']}")
+
+
+def _quantize_ring(ring):
+    points = [(round(x * PRECISION), round(y * PRECISION)) for x, y, *_ in ring]
+    # Work with open rings, without repeated points
+    result = []
+    for point in points:
+        if not result or point != result[-1]:
+            result.append(point)
+    while len(result) > 1 and result[0] == result[-1]:
+        result.pop()
+    return result
+
+
+def _junctions(rings):
+    """
+    Return the set of points where a boundary shared by two or more rings
+    starts or ends - the points whose neighbours differ between rings
+    """
+
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+class Topology:
+    """
+    A set of polygons broken into shared arcs. Each polygon is a list of
+    rings, each ring a list of arc references: i for arc i, or ~i for
+    arc i reversed.
+    """
+
+    def __init__(self, features):
+        self.arcs = []
+        self._index = {}
+
+        quantized = [[[_quantize_ring(ring) for ring in polygon] for polygon in polygons]
+                     for properties, polygons in features]
+        junctions = _junctions([ring for polygons in quantized for polygon in polygons for ring in polygon])
+
+        self.features = []
+        for (properties, polygons), q_polygons in zip(features, quantized):
+            self.features.append((properties, [[self._cut(ring, junctions) for ring in polygon if len(ring) >= 3]
+                                               for polygon in q_polygons]))
+
+    def _arc(self, points):
+        points = tuple(points)
+        if points in self._index:
+            return self._index[points]
+        if points[::-1] in self._index:
+            return ~self._index[points[::-1]]
+        self._index[points] = len(self.arcs)
+        self.arcs.append(points)
+        return self._index[points]
+
+    def _cut(self, ring, junctions):
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # A ring shared with nothing (or shared whole) - start it from a
+            # fixed point so that identical rings are recognised
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            return [self._arc(ring + [ring[0]])]
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+        closed = ring + [ring[0]]
+        return [self._arc(closed[a:b + 1]) for a, b in zip(cuts, cuts[1:])]
+
+
+# Simplification
+
+def _simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of `points`, always keeping the ends
+    """
+
+    if tolerance <= 0 or len(points) < 3:
+        return list(points)
+
+    tolerance2 = tolerance * tolerance
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length2 = dx * dx + dy * dy
+        worst, worst_distance = None, tolerance2
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if length2 == 0:
+                distance = (x - x1) ** 2 + (y - y1) ** 2
+            else:
+                cross = dx * (y - y1) - dy * (x - x1)
+                distance = cross * cross / length2
+            if distance > worst_distance:
+                worst, worst_distance = i, distance
+        if worst is not None:
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+
+    return [point for point, k in zip(points, keep) if k]
+
+
+def _reduce(arc, tolerance, quantum):
+    result = []
+    for x, y in _simplify(arc, tolerance):
+        point = (round(x / quantum), round(y / quantum))
+        if not result or point != result[-1]:
+            result.append(point)
+    if len(result) == 1:
+        result.append(result[0])
+    return result
+
+
+def topojson(topology, name, band):
+    """
+    Return the TopoJSON document (as a dictionary) for `topology` at `band`
+    """
+
+    tolerance, quantum = _band_steps(band)
+    arcs = [_reduce(arc, tolerance, quantum) for arc in topology.arcs]
+
+    def arc_length(reference):
+        return len(arcs[reference if reference >= 0 else ~reference]) - 1
+
+    # Drop rings that have simplified away to nothing, and then any arcs
+    # that aren't used any more
+    used = {}
+    geometries = []
+    for properties, polygons in topology.features:
+        kept = []
+        for polygon in polygons:
+            rings = [ring for ring in polygon if sum(arc_length(r) for r in ring) >= 3]
+            if rings and rings[0] is polygon[0]:
+                kept.append(rings)
+        for polygon in kept:
+            for ring in polygon:
+                for reference in ring:
+                    used.setdefault(reference if reference >= 0 else ~reference, len(used))
+        geometries.append((properties, kept))
+
+    def renumber(reference):
+        return used[reference] if reference >= 0 else ~used[~reference]
+
+    encoded = [None] * len(used)
+    for old, new in used.items():
+        deltas, previous = [], (0, 0)
+        for point in arcs[old]:
+            deltas.append([point[0] - previous[0], point[1] - previous[1]])
+            previous = point
+        encoded[new] = deltas
+
+    scale = quantum / PRECISION
+    return {
+        'type': 'Topology',
+        'transform': {'scale': [scale, scale], 'translate': [0, 0]},
+        'objects': {
+            name: {
+                'type': 'GeometryCollection',
+                'geometries': [
+                    {
+                        'type': 'MultiPolygon',
+                        'properties': properties,
+                        'arcs': [[[renumber(r) for r in ring] for ring in polygon] for polygon in polygons],
+                    }
+                    for properties, polygons in geometries
+                ],
+            },
+        },
+        'arcs': encoded,
+    }
+
+
+# Files
+
+def _source(name):
+    return os.path.join(SOURCE_DIR, LAYERS[name][0])
+
+
+def version(name):
+    """
+    Return a version string for the current source of `name`, or raise
+    FileNotFoundError
+    """
+    st = os.stat(_source(name))
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def _path(name, band, version):
+    return os.path.join(BOUNDARY_DIR, f'{name}.{band}.{version}.topojson')
+
+
+def build(name):
+    """
+    Build every band of layer `name`, remove older versions, and return
+    a dictionary of band: path
+    """
+
+    current_version = version(name)
+    filename, keep = LAYERS[name]
+    logger.info(f'Building boundary overlay {name} from {filename}')
+
+    with open(_source(name)) as f:
+        source = json.load(f)
+
+    features = []
+    for feature in source['features']:
+        properties = feature['properties'] or {}
+        if keep is not None:
+            properties = {k: properties.get(k) for k in keep}
+        features.append((properties, _polygons(feature['geometry'])))
+    topology = Topology(features)
+
+    os.makedirs(BOUNDARY_DIR, exist_ok=True)
+    paths = {}
+    for b in ZOOM_BANDS:
+        path = _path(name, b, current_version)
+        # Write to a temporary file and rename so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=BOUNDARY_DIR, prefix=f'.{name}.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(dumps(topojson(topology, name, b), separators=(',', ':')))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        paths[b] = path
+
+    for old in glob.glob(os.path.join(BOUNDARY_DIR, f'{glob.escape(name)}.*.topojson')):
+        if old not in paths.values():
+            os.remove(old)
+
+    return paths
+
+
+def current(name, zoom):
+    """
+    Return the path to layer `name` for `zoom`, building it if necessary.
+    Raises KeyError for an unknown layer and FileNotFoundError if its
+    source doesn't exist.
+    """
+
+    path = _path(name, band(zoom), version(name))
+    if not os.path.exists(path):
+        path = build(name)[band(zoom)]
+    return path
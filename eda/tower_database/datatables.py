@@ -0,0 +1,255 @@
+"""
+Server-side processing for DataTables (https://datatables.net/manual/server-side).
+
+The tower lists are normally sent to the browser whole and DataTables
+searches, sorts and filters them there. That stops working well somewhere
+in the low thousands of rows, so bigger tables (like the whole of Dove)
+are sent a page at a time instead: DataTables asks for the rows it's
+going to show and all the searching, sorting, counting and SearchPanes
+facet counting is done here in SQL.
+"""
+
+from django.core.cache import cache
+from django.core.exceptions import BadRequest, ValidationError
+from django.db.models import Count, F, Q
+
+from collections import namedtuple
+
+import re
+
+
+# Tables with more rows than this are paged by the server
+SERVER_SIDE_THRESHOLD = 1000
+
+# The most rows that can be asked for at once
+MAX_LENGTH = 1000
+
+
+class Column(namedtuple('Column', ['name', 'field', 'searchable', 'orderable', 'pane', 'labels', 'sort'])):
+    """
+    A table column. `name` is what DataTables calls it (its columns.data),
+    `field` the lookup used to search, sort and facet it (or None if it's
+    just for display), `pane` whether it gets a SearchPane, `labels` a
+    dictionary of display labels for its values (e.g. a field's choices)
+    and `sort` an expression to sort by instead of `field`
+    """
+
+    def __new__(cls, name, field=None, searchable=True, orderable=True, pane=False, labels=None, sort=None):
+        return super().__new__(cls, name, field, searchable and field is not None,
+                               orderable and field is not None, pane and field is not None, labels, sort)
+
+    def order_by(self, descending):
+        expression = self.sort if self.sort is not None else F(self.field)
+        return expression.desc(nulls_last=True) if descending else expression.asc(nulls_first=True)
+
+
+_PARAMETER = re.compile(r'(\w+)((?:\[[^\]]*\])+)')
+
+
+def _nested(params):
+    """
+    Turn DataTables' flattened parameters ('order[0][column]' etc.) back
+    into nested dictionaries
+    """
+
+    result = {}
+    for key, value in params.items():
+        match = _PARAMETER.fullmatch(key)
+        if not match:
+            continue
+        node = result.setdefault(match.group(1), {})
+        parts = re.findall(r'\[([^\]]*)\]', match.group(2))
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                raise BadRequest(f"Unexpected parameter '{key}'")
+        node[parts[-1]] = value
+    return result
+
+
+def _branch(node, key):
+    """
+    Return the dictionary of parameters under `key` in `node` (from
+    _nested), which is empty if there aren't any
+    """
+    value = node.get(key, {})
+    if not isinstance(value, dict):
+        raise BadRequest(f"'{key}' should have parts, e.g. {key}[0]")
+    return value
+
+
+def _leaf(node, key, default=''):
+    """
+    Return the value of the parameter `key` in `node` (from _nested)
+    """
+    value = node.get(key, default)
+    if isinstance(value, dict):
+        raise BadRequest(f"'{key}' shouldn't have parts")
+    return value
+
+
+def _int(value, default):
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f"'{value}' isn't a number")
+
+
+def _matches(model, field, value):
+    # Blank also matches missing, and only text can be blank
+    model_field = model._meta.get_field(field)
+    if value == '':
+        if model_field.empty_strings_allowed:
+            return Q(**{field: ''}) | Q(**{f'{field}__isnull': True})
+        return Q(**{f'{field}__isnull': True})
+    try:
+        return Q(**{field: model_field.to_python(value)})
+    except ValidationError:
+        raise BadRequest(f"'{value}' isn't a valid {field}")
+
+
+def _sort_key(label):
+    # Numbers (whether numbers or strings of digits) in numerical order, first
+    label = str(label)
+    return (0, int(label), '') if label.isdigit() else (1, 0, label)
+
+
+class Table:
+    """
+    A table that can be served a page at a time: its `columns`, and a
+    function to `render` each object as a dictionary of column name: value
+    (which is inserted as HTML, so must be escaped)
+    """
+
+    def __init__(self, columns, render):
+        self.columns = columns
+        self.render = render
+        self._by_name = {column.name: column for column in columns}
+
+    def _search(self, value):
+        # Every word has to appear in at least one searchable column
+        q = Q()
+        for word in value.split():
+            anywhere = Q()
+            for column in self.columns:
+                if column.searchable:
+                    anywhere |= Q(**{f'{column.field}__icontains': word})
+            q &= anywhere
+        return q
+
+    def _filter(self, queryset, request):
+        filters = Q()
+
+        search = _leaf(_branch(request, 'search'), 'value')
+        if search:
+            filters &= self._search(search)
+
+        columns = _branch(request, 'columns')
+        for i in columns:
+            spec = _branch(columns, i)
+            column = self._by_name.get(_leaf(spec, 'data'))
+            value = _leaf(_branch(spec, 'search'), 'value')
+            if column and column.searchable and value:
+                filters &= Q(**{f'{column.field}__icontains': value})
+
+        # SearchPanes selections arrive as searchPanes[name][0], [1], ...
+        panes = _branch(request, 'searchPanes')
+        for name in panes:
+            selected = _branch(panes, name)
+            column = self._by_name.get(name)
+            if column and column.pane and selected:
+                q = Q()
+                for i in selected:
+                    q |= _matches(queryset.model, column.field, _leaf(selected, i))
+                filters &= q
+
+        return queryset.filter(filters) if filters else queryset
+
+    def _order(self, queryset, request):
+        ordering = []
+        columns = _branch(request, 'columns')
+        order = _branch(request, 'order')
+        for i in sorted(order, key=lambda i: _int(i, 0)):
+            spec = _branch(order, i)
+            # Columns are referred to by index, into the list of columns the
+            # request describes
+            name = _leaf(_branch(columns, _leaf(spec, 'column', None)), 'data', None)
+            column = self._by_name.get(name)
+            if column and column.orderable:
+                ordering.append(column.order_by(_leaf(spec, 'dir') == 'desc'))
+        if not ordering:
+            ordering = queryset.query.order_by or queryset.model._meta.ordering
+        # Always end with something unique, so pages don't overlap
+        return queryset.order_by(*ordering, 'pk')
+
+    def _facet(self, queryset, column):
+        counts = {}
+        for value, n in queryset.order_by().values_list(column.field).annotate(n=Count('pk')):
+            # Blank and missing look the same
+            value = '' if value is None else value
+            counts[value] = counts.get(value, 0) + n
+        return counts
+
+    def _totals(self, queryset):
+        return {
+            'records': queryset.count(),
+            'panes': {column.name: self._facet(queryset, column) for column in self.columns if column.pane},
+        }
+
+    def _panes(self, totals, counts):
+        options = {}
+        for column in self.columns:
+            if not column.pane:
+                continue
+            labels = column.labels or {}
+            options[column.name] = [
+                {
+                    'label': str(labels.get(value, value)),
+                    'total': total,
+                    'value': value,
+                    'count': counts[column.name].get(value, 0),
+                }
+                for value, total in sorted(totals[column.name].items(), key=lambda item: _sort_key(labels.get(item[0], item[0])))
+            ]
+        return options
+
+    def process(self, params, queryset, cache_key=None):
+        """
+        Answer the DataTables request in `params` (a QueryDict) for the rows
+        of `queryset`, returning the response as a dictionary. The counts for
+        the whole of `queryset` are cached under `cache_key`, if given, which
+        should change whenever the data does.
+        """
+
+        request = _nested(params)
+        draw = _int(params.get('draw'), 0)
+        start = max(_int(params.get('start'), 0), 0)
+        length = _int(params.get('length'), 10)
+        if length < 0 or length > MAX_LENGTH:
+            length = MAX_LENGTH
+
+        totals = cache.get(cache_key) if cache_key else None
+        if totals is None:
+            totals = self._totals(queryset)
+            if cache_key:
+                cache.set(cache_key, totals, None)
+
+        filtered = self._filter(queryset, request)
+        if filtered is queryset:
+            filtered_totals = totals
+        else:
+            filtered_totals = self._totals(filtered)
+
+        page = self._order(filtered, request)[start:start + length]
+
+        response = {
+            'draw': draw,
+            'recordsTotal': totals['records'],
+            'recordsFiltered': filtered_totals['records'],
+            'data': [self.render(row) for row in page],
+        }
+        if totals['panes']:
+            response['searchPanes'] = {'options': self._panes(totals['panes'], filtered_totals['panes'])}
+        return response
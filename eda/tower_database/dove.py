@@ -0,0 +1,336 @@
+"""
+Loading Dove's Guide.
+
+Dove is published as one big CSV file (dove.csv), which is loaded into
+the dove_towers table behind the unmanaged Dove model. Each column is
+converted to the type of its model field on the way in - numbers to
+numbers (blank being NULL) and the columns that are either blank or a
+flag ('u/r', 'GF', 'T', ...) to booleans - so queries can compare and
+sort them without casting.
+
+A load builds a complete new table alongside the live one, then drops
+the old table, renames the new one into its place and builds the
+indexes in a single transaction, so readers see either the old Dove or
+the new, never a half-loaded one. Finally the DOVE generation is bumped
+(see invalidation.py) so everything cached from the old data is dropped.
+
+update() wraps a load with a record of what changed. Each file loaded
+is kept, gzipped, under SNAPSHOT_ROOT/dove, and compared with the one
+loaded before it ring by ring (RingID): rows whose content hashes match
+are skipped, and for the rest the fields that differ are recorded as a
+DoveChange against the DoveUpdate for the load. So reviewers, and
+reconciliation, can look at just the rings that changed.
+"""
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from collections import Counter
+
+import csv
+import gzip
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+
+from .invalidation import DOVE, get_generation, invalidate
+from .models import Dove, DoveChange, DoveUpdate
+
+
+SNAPSHOT_DIR = os.path.join(settings.SNAPSHOT_ROOT, 'dove')
+
+# How many old snapshots to keep
+KEEP_SNAPSHOTS = 20
+
+
+# Rows are inserted this many at a time
+BATCH_SIZE = 2000
+
+
+def _integer(value):
+    return int(value) if value else None
+
+def _float(value):
+    if not value:
+        return None
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"'{value}' isn't a finite number")
+    return value
+
+def _boolean(value):
+    return value != ''
+
+def _text(value):
+    return value
+
+
+def converter(field):
+    """
+    Return the function that turns a CSV value into a value for `field`
+    """
+    if isinstance(field, models.BooleanField):
+        return _boolean
+    if isinstance(field, models.IntegerField):
+        return _integer
+    if isinstance(field, models.FloatField):
+        return _float
+    return _text
+
+
+def read(f, bad):
+    """
+    Yield the rows of the Dove CSV file `f` as lists of values, in the
+    order of Dove's fields, counting the values that couldn't be converted
+    (which become NULL) by field in the Counter `bad`
+    """
+
+    reader = csv.reader(f)
+    header = next(reader)
+    fields = Dove._meta.concrete_fields
+    by_column = {name.strip(): i for i, name in enumerate(header)}
+    missing = [field.db_column for field in fields if field.db_column not in by_column]
+    if missing:
+        raise ValueError(f"Columns missing from the Dove file: {', '.join(missing)}")
+    columns = [(by_column[field.db_column], field.name, converter(field)) for field in fields]
+
+    for line in reader:
+        if not line:
+            continue
+        row = []
+        for i, name, convert in columns:
+            try:
+                row.append(convert(line[i] if i < len(line) else ''))
+            except ValueError:
+                bad[name] += 1
+                row.append(None)
+        yield row
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def _create_table(cursor, table):
+    columns = []
+    for field in Dove._meta.concrete_fields:
+        definition = f'{_quote(field.column)} {field.db_type(connection)}'
+        if field.primary_key:
+            definition += ' PRIMARY KEY'
+        elif not field.null:
+            definition += ' NOT NULL'
+        columns.append(definition)
+    cursor.execute(f'CREATE TABLE {_quote(table)} ({", ".join(columns)})')
+
+
+def _create_indexes(cursor, table):
+    indexes = [(f'{table}_{field.column.lower()}', [field.column])
+               for field in Dove._meta.concrete_fields if field.db_index and not field.primary_key]
+    indexes.extend((index.name, [Dove._meta.get_field(name).column for name in index.fields])
+                   for index in Dove._meta.indexes)
+    for name, columns in indexes:
+        cursor.execute(f'CREATE INDEX {_quote(name)} ON {_quote(table)} ({", ".join(map(_quote, columns))})')
+
+
+def load(f):
+    """
+    Replace the Dove data with the contents of the CSV file `f`. Returns
+    the number of rows loaded and a Counter of values that couldn't be
+    converted, by field.
+    """
+
+    table = Dove._meta.db_table
+    new_table = f'{table}_new'
+    columns = ', '.join(_quote(field.column) for field in Dove._meta.concrete_fields)
+    insert = (f'INSERT INTO {_quote(new_table)} ({columns}) '
+              f'VALUES ({", ".join(["%s"] * len(Dove._meta.concrete_fields))})')
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {_quote(new_table)}')
+        _create_table(cursor, new_table)
+
+        bad = Counter()
+        count = 0
+        batch = []
+        for row in read(f, bad):
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                with transaction.atomic():
+                    cursor.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+        with transaction.atomic():
+            cursor.executemany(insert, batch)
+        count += len(batch)
+
+        with transaction.atomic():
+            cursor.execute(f'DROP TABLE IF EXISTS {_quote(table)}')
+            cursor.execute(f'ALTER TABLE {_quote(new_table)} RENAME TO {_quote(table)}')
+            _create_indexes(cursor, table)
+        cursor.execute(f'ANALYZE {_quote(table)}')
+
+    invalidate(DOVE)
+    return count, bad
+
+
+# Snapshots and changes
+
+def snapshots():
+    """
+    Return the paths of the snapshots, oldest first
+    """
+    try:
+        names = os.listdir(SNAPSHOT_DIR)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(SNAPSHOT_DIR, name) for name in sorted(names)
+            if name.startswith('dove-') and name.endswith('.csv.gz')]
+
+
+def open_snapshot(path):
+    return gzip.open(path, 'rt', encoding='utf-8-sig', newline='')
+
+
+def _file_hash(f):
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.read(1 << 16), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def take_snapshot(path, previous=None):
+    """
+    Keep a gzipped copy of the Dove file at `path`, returning the path of
+    the copy - or of the `previous` snapshot, if the file hasn't changed
+    """
+
+    with open(path, 'rb') as f:
+        new_hash = _file_hash(f)
+    if previous:
+        with gzip.open(previous, 'rb') as f:
+            if _file_hash(f) == new_hash:
+                return previous
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    snapshot = os.path.join(SNAPSHOT_DIR, f'dove-{timezone.now():%Y%m%dT%H%M%S%f}.csv.gz')
+    # Written to one side and renamed, so there's never half a snapshot
+    fd, tmp = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix='.dove-')
+    with open(path, 'rb') as src, os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, snapshot)
+    return snapshot
+
+
+def prune_snapshots(keep=KEEP_SNAPSHOTS):
+    for path in snapshots()[:-keep]:
+        os.remove(path)
+
+
+def rows(f):
+    """
+    Return {RingID: (content hash, {field name: value})} for the Dove CSV
+    file `f`, with the values as they are in the file. Columns that aren't
+    Dove fields are included under their own names.
+    """
+
+    reader = csv.reader(f)
+    by_column = {field.db_column: field.name for field in Dove._meta.concrete_fields}
+    names = [by_column.get(column.strip(), column.strip()) for column in next(reader)]
+    result = {}
+    for line in reader:
+        if line:
+            values = dict(zip(names, line))
+            content = hashlib.blake2b('\x1f'.join(line).encode(), digest_size=16).digest()
+            result[values.get('ringid', '')] = (content, values)
+    return result
+
+
+def diff(old, new):
+    """
+    Return the (unsaved) DoveChanges between two sets of `rows()`
+    """
+
+    changes = []
+
+    def change(kind, values, fields):
+        changes.append(DoveChange(ringid=values.get('ringid', ''), towerid=values.get('towerid', ''),
+                                  place=values.get('place', ''), dedication=values.get('dedicn', ''),
+                                  kind=kind, fields=fields))
+
+    for ringid, (content, values) in new.items():
+        if ringid not in old:
+            change(DoveChange.Kind.ADDED, values, {})
+        elif old[ringid][0] != content:
+            old_values = old[ringid][1]
+            fields = {name: [old_values.get(name, ''), values.get(name, '')]
+                      for name in {**old_values, **values}
+                      if old_values.get(name, '') != values.get(name, '')}
+            change(DoveChange.Kind.CHANGED, values, fields)
+    for ringid, (_, values) in old.items():
+        if ringid not in new:
+            change(DoveChange.Kind.REMOVED, values, {})
+
+    return changes
+
+
+def update(path):
+    """
+    Load the Dove file at `path` (see load()), keeping a snapshot of it and
+    recording how it differs from the last one loaded. Returns the
+    DoveUpdate and the Counter of values that couldn't be converted.
+    """
+
+    existing = snapshots()
+    previous = existing[-1] if existing else None
+    snapshot = take_snapshot(path, previous)
+
+    with open_snapshot(snapshot) as f:
+        new = rows(f)
+    if previous:
+        with open_snapshot(previous) as f:
+            changes = diff(rows(f), new)
+    else:
+        # Nothing to compare the first one with
+        changes = []
+
+    previous_generation = get_generation(DOVE)
+    # From the snapshot, so what's loaded is exactly what was compared
+    with open_snapshot(snapshot) as f:
+        count, bad = load(f)
+
+    with transaction.atomic():
+        dove_update = DoveUpdate.objects.create(
+            snapshot=os.path.basename(snapshot),
+            previous_snapshot=os.path.basename(previous) if previous else '',
+            generation=get_generation(DOVE), previous_generation=previous_generation, rings=count,
+            **{kind.label.lower(): sum(1 for c in changes if c.kind == kind) for kind in DoveChange.Kind})
+        for c in changes:
+            c.update = dove_update
+        DoveChange.objects.bulk_create(changes)
+
+    prune_snapshots()
+    return dove_update, bad
+
+
+def changed_rings(since_generation, generation):
+    """
+    Return the RingIDs of the rings that have changed between two DOVE
+    generations, or None if that isn't known (because Dove was loaded
+    without recording what changed)
+    """
+
+    if since_generation == generation:
+        return set()
+    updates = list(DoveUpdate.objects.filter(generation__gt=since_generation, generation__lte=generation)
+                   .order_by('generation'))
+    expected = since_generation
+    for dove_update in updates:
+        if dove_update.previous_generation != expected or not dove_update.previous_snapshot:
+            return None
+        expected = dove_update.generation
+    if expected != generation:
+        return None
+    return set(DoveChange.objects.filter(update__in=updates).values_list('ringid', flat=True))
@@ -0,0 +1,148 @@
+"""
+Generation-counted cache invalidation for the tower database.
+
+Rather than clearing the entire cache whenever anything changes, every
+cached item is stored under a key that includes the current 'generation'
+of each of the things it depends on. There is a generation for each
+individual tower, for each district, for 'all towers', for the Dove
+data and for users' permissions. Changing something just bumps the
+relevant generations - anything cached against the old values is simply
+never asked for again and eventually falls out of the cache, while
+everything else stays warm.
+
+The generations themselves live in the database (the Generation model)
+so that every worker process sees the same values. Each process keeps
+its own copy and only re-reads the table when a small shared 'bus' file
+has been replaced, which every invalidation does - so the cost of a
+lookup on the request path is normally a single stat() call. Looking a
+generation up never writes anything: a key that has never been
+invalidated simply has generation 0, and only gets a row when it is.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+import datetime
+import os
+import tempfile
+import time
+
+
+# Dependency keys
+
+ALL_TOWERS = 'towers'
+
+def tower_key(pk):
+    return f'tower:{pk}'
+
+def district_key(district):
+    return f'district:{district}'
+
+# The (separately loaded) Dove data
+DOVE = 'dove'
+
+# Users' groups and permissions (see permissions.py)
+PERMISSIONS = 'permissions'
+
+
+BUS_FILE = os.path.join(settings.SNAPSHOT_ROOT, 'generations')
+
+# This process's copy of the generation table, and the state of the bus
+# file when it was read
+_generations = {}
+_bus_state = None
+
+
+def _generation_model():
+    # Imported here because the models depend on this module
+    from .models import Generation
+    return Generation
+
+
+def _new_generation():
+    # Seed generations from the clock (in microseconds) so that a counter
+    # that has been lost can never step back onto a value that might
+    # still have stale entries cached against it
+    return time.time_ns() // 1000
+
+
+def _read_bus():
+    try:
+        st = os.stat(BUS_FILE)
+    except FileNotFoundError:
+        # Not None, which means the table hasn't been read yet
+        return ()
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _signal_bus(generation):
+    # Replace (rather than rewrite) the file so every change gets a new inode
+    os.makedirs(os.path.dirname(BUS_FILE), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(BUS_FILE), prefix='.generations.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(generation))
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, BUS_FILE)
+
+
+def get_generations(*keys):
+    """
+    Return a dictionary of the current generation for each of `keys`
+    """
+
+    global _generations, _bus_state
+
+    # Read the bus before the table, so that a change that lands between
+    # the two is picked up again next time
+    state = _read_bus()
+    if state != _bus_state:
+        _generations = dict(_generation_model().objects.values_list('key', 'value'))
+        _bus_state = state
+
+    # Read-only: anything not in the table has never been invalidated
+    return {key: _generations.get(key, 0) for key in keys}
+
+
+def get_generation(key):
+    return get_generations(key)[key]
+
+
+def invalidate(*keys):
+    """
+    Bump the generation of each of `keys`, orphaning anything cached against them
+    """
+
+    global _bus_state
+
+    Generation = _generation_model()
+    new = _new_generation()
+
+    with transaction.atomic():
+        Generation.objects.filter(key__in=keys).update(value=Greatest(F('value') + 1, Value(new)))
+        existing = set(Generation.objects.filter(key__in=keys).values_list('key', flat=True))
+        Generation.objects.bulk_create(
+            [Generation(key=key, value=new) for key in keys if key not in existing],
+            ignore_conflicts=True
+        )
+
+    # Tell everyone else (including ourselves) to re-read the table
+    _signal_bus(new)
+    _bus_state = None
+
+
+def generation_time(generation):
+    """
+    Return the (approximate) time that a generation was created
+    """
+    return datetime.datetime.fromtimestamp(generation / 1000000, tz=datetime.timezone.utc)
+
+
+def versioned_key(name, *dependencies):
+    """
+    Build a cache key for `name` that changes whenever any of `dependencies` does
+    """
+
+    generations = get_generations(*dependencies)
+    return ':'.join([name] + [str(generations[d]) for d in dependencies])
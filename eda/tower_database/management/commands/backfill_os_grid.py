@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tower_database.invalidation import ALL_TOWERS, tower_key, district_key, invalidate
+from tower_database.models import Tower
+from tower_database.osgrid import grid_references
+
+
+class Command(BaseCommand):
+    help = 'Fill in the stored OS grid reference of towers (and their history) that lack one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every grid reference, not just missing ones')
+
+
+    def handle(self, *args, **options):
+
+        changed = set()
+        for model in (Tower, Tower.history.model):
+            rows = model.objects.exclude(latlng='').order_by().only('pk', 'latlng', 'os_grid', 'district')
+            if not options['all']:
+                rows = rows.filter(os_grid='')
+            rows = list(rows)
+            locations = [Tower.parse_location(row.latlng) for row in rows]
+            # Convert them all in one go
+            references = grid_references([lat for lat, _ in locations], [lng for _, lng in locations])
+            updated = []
+            for row, os_grid in zip(rows, references):
+                if os_grid != row.os_grid:
+                    row.os_grid = os_grid
+                    updated.append(row)
+            # bulk_update() bypasses save(), so nothing else is touched
+            model.objects.bulk_update(updated, ['os_grid'], batch_size=500)
+            if model is Tower:
+                changed.update((row.pk, row.district) for row in updated)
+
+        if changed:
+            invalidate(ALL_TOWERS,
+                       *[tower_key(pk) for pk, _ in changed],
+                       *{district_key(district) for _, district in changed})
+
+        self.stdout.write(f"Updated grid references for {len(changed)} towers")
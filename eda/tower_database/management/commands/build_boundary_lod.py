@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import os
+
+from tower_database import boundaries
+
+
+class Command(BaseCommand):
+    help = 'Build the simplified boundary overlays for each map zoom band'
+
+    def add_arguments(self, parser):
+        parser.add_argument('layers', nargs='*', help='Layers to build (default all)')
+
+
+    def handle(self, *args, **options):
+
+        layers = options['layers'] or boundaries.LAYERS.keys()
+
+        for name in layers:
+            if name not in boundaries.LAYERS:
+                raise CommandError(f"Unknown layer '{name}'")
+            try:
+                paths = boundaries.build(name)
+            except FileNotFoundError:
+                self.stdout.write(f"{name}: no source file, skipping")
+                continue
+            source = os.path.getsize(os.path.join(boundaries.SOURCE_DIR, boundaries.LAYERS[name][0]))
+            sizes = ', '.join(f'z{b}+ {os.path.getsize(p) // 1024} KB' for b, p in paths.items())
+            self.stdout.write(f"{name}: {source // 1024} KB -> {sizes}")
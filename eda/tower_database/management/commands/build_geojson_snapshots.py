@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import glob
+import os
+import re
+
+from tower_database import snapshots
+from tower_database.models import Tower
+
+
+class Command(BaseCommand):
+    help = 'Build the pre-serialised GeoJSON files for all towers, each district and each tower'
+
+    def add_arguments(self, parser):
+        pass
+
+
+    def handle(self, *args, **options):
+
+        snapshots.build()
+
+        for district in Tower.Districts.values:
+            snapshots.build(district=district)
+
+        towerids = set()
+        for towerid in Tower.objects.values_list('pk', flat=True):
+            snapshots.build(towerid=towerid)
+            towerids.add(towerid)
+
+        # Tidy up after towers that no longer exist
+        for path in glob.glob(os.path.join(snapshots.GEOJSON_DIR, 'tower-*.geojson')):
+            match = re.match(r'tower-(\d+)\.', os.path.basename(path))
+            if match and int(match.group(1)) not in towerids:
+                os.remove(path)
+
+        self.stdout.write(f"Built snapshots for {len(towerids)} towers")
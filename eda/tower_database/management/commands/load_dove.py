@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tower_database import dove
+
+
+class Command(BaseCommand):
+    help = "Load (or reload) Dove's Guide from its CSV download, recording what's changed since the last load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", nargs='?', default='../dove.csv', help="The Dove CSV file")
+        parser.add_argument("--no-snapshot", action="store_true",
+                            help="Just load the file, without keeping a snapshot or recording the changes")
+
+
+    def handle(self, *args, **options):
+
+        try:
+            if options["no_snapshot"]:
+                # utf-8-sig, as Dove's file starts with a byte order mark
+                with open(options["file"], encoding='utf-8-sig', newline='') as f:
+                    count, bad = dove.load(f)
+                summary = f"Loaded {count} Dove rings"
+            else:
+                update, bad = dove.update(options["file"])
+                summary = f"Loaded {update.rings} Dove rings: {update.added} added, {update.removed} removed, {update.changed} changed"
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        for field, n in sorted(bad.items()):
+            self.stderr.write(f"{n} bad '{field}' values loaded as blank")
+        self.stdout.write(summary)
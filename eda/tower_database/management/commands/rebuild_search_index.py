@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tower_database import search
+from tower_database.models import Tower
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from scratch (e.g. after loading data without saving each tower)'
+
+    def handle(self, *args, **options):
+
+        towers = Tower.objects.order_by()
+        with transaction.atomic():
+            search.rebuild(towers)
+
+        self.stdout.write(f"Indexed {towers.count()} towers")
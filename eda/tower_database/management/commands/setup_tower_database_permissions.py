@@ -32,10 +32,10 @@ class Command(BaseCommand):
             )
 
         # Sets of permissions to allocate
-        ro_permissions = ('view_contact' , 'view_dove', 'view_photo', 'view_tower','view_website')
+        ro_permissions = ('view_contact' , 'view_dove', 'view_dovechange', 'view_doveupdate', 'view_photo', 'view_tower','view_website')
 
         admin_permissions = ('add_contact', 'change_contact', 'view_contact',
-                 'view_dove',
+                 'view_dove', 'change_dovechange', 'view_dovechange', 'view_doveupdate',
                  'add_photo', 'change_photo', 'delete_photo', 'view_photo',
                  'add_tower', 'change_tower', 'delete_tower', 'view_tower',
                  'add_website', 'change_website', 'delete_website', 'view_website'
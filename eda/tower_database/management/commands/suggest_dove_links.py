@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from tower_database import matching
+from tower_database.models import Tower
+
+
+class Command(BaseCommand):
+    help = 'Suggest the Dove rings that towers not yet linked to Dove should be linked to'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                            help="Check the towers already linked too, reporting any whose best match is another ring")
+        parser.add_argument("--limit", type=int, default=matching.LIMIT, help="How many suggestions to give for each tower")
+
+
+    def handle(self, *args, **options):
+
+        towers = Tower.objects.order_by('place', 'dedication')
+        if not options["all"]:
+            towers = towers.filter(dove_ringid='')
+        towers = list(towers)
+        suggestions = matching.suggest_all(towers, options["limit"])
+
+        agree = 0
+        for tower in towers:
+            found = suggestions[tower.pk]
+            if tower.dove_ringid and found and found[0].ring.ringid == tower.dove_ringid:
+                agree += 1
+                continue
+            self.stdout.write(f"\n{tower.place} {tower.dedication}" +
+                              (f" (linked to {tower.dove_ringid}):" if tower.dove_ringid else ":"))
+            if not found:
+                self.stdout.write("    No suggestions")
+            for score, distance, ring in found:
+                where = f", {distance:.1f} km" if distance is not None else ""
+                self.stdout.write(f"    {score:5.1f}  RingID {ring.ringid} TowerID {ring.towerid}: "
+                                  f"{ring.place} {ring.dedication}, {ring.bells or '?'} bells{where}")
+
+        if options["all"]:
+            self.stderr.write(f"Best suggestion agrees with the existing link for {agree} of "
+                              f"{sum(1 for tower in towers if tower.dove_ringid)} linked towers")
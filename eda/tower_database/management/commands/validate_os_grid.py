@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from OSGridConverter import latlong2grid
+
+import contextlib
+import io
+import logging
+import math
+import time
+
+from tower_database.models import Tower, Dove
+from tower_database.osgrid import eastings_northings, grid_references
+
+
+class Command(BaseCommand):
+    help = 'Check the batch OS grid converter against OSGridConverter for every Dove ring and tower'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show', type=int, default=10, help='How many mismatches to list')
+
+
+    def handle(self, *args, **options):
+
+        points = []
+        for lat, lng in Dove.objects.exclude(lat=None).exclude(long=None).order_by().values_list('lat', 'long'):
+            if math.isfinite(lat) and math.isfinite(lng):
+                points.append((lat, lng))
+        points.extend(Tower.objects.exclude(lat=None).order_by().values_list('lat', 'lng'))
+
+        lats, lngs = [lat for lat, _ in points], [lng for _, lng in points]
+
+        start = time.perf_counter()
+        eastings, northings = eastings_northings(lats, lngs)
+        references = grid_references(lats, lngs, figures=10)
+        batch_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # OSGridConverter logs an error and prints a traceback for every point off the grid
+        logging.disable(logging.ERROR)
+        try:
+            with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+                expected = [latlong2grid(lat, lng) for lat, lng in points]
+                expected = [(g.E, g.N, str(g).replace(' ', '')) for g in expected]
+        finally:
+            logging.disable(logging.NOTSET)
+        single_time = time.perf_counter() - start
+
+        mismatches = [(point, want, (e, n, ref))
+                      for point, want, e, n, ref in zip(points, expected, eastings.tolist(), northings.tolist(), references)
+                      if want != (e, n, ref)]
+
+        for (lat, lng), want, got in mismatches[:options['show']]:
+            self.stdout.write(f"{lat},{lng}: expected {want}, got {got}")
+
+        self.stdout.write(f"{len(points)} points: batch {batch_time * 1000:.0f} ms, "
+                          f"one at a time {single_time * 1000:.0f} ms")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} mismatches")
+        self.stdout.write("All match")
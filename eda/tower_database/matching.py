@@ -0,0 +1,145 @@
+"""
+Suggesting the Dove ring a tower should be linked to.
+
+Rather than comparing a tower with all of Dove, the candidates are
+narrowed down first: the rings within RADIUS of it (from the Dove
+KD-tree, see nearest.py) in the same county, or, for a tower with no
+location, every ring in its county. Each candidate is then scored out
+of 100 on how alike the place names are, how alike the dedications are
+once ours is rewritten the way Dove writes them (see reconciliation.py),
+and on the bells, postcode and distance. Rings already linked to some
+other tower aren't suggested.
+
+The details of the rings needed for scoring are kept for as long as the
+DOVE generation is current (see invalidation.py), like the KD-trees, so
+scoring every tower takes a second or so.
+"""
+
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+import re
+
+from .autocomplete import normalise
+from .invalidation import DOVE, get_generation
+from .models import Dove, Tower
+from .nearest import nearest
+from .reconciliation import dove_dedication
+
+
+# How far away (in km), and how many of the nearest rings, to consider
+RADIUS = 10
+CANDIDATES = 25
+
+# How many suggestions to give by default
+LIMIT = 5
+
+# How much each thing counts towards a score out of 100
+WEIGHTS = {
+    'place': 40,
+    'dedication': 30,
+    'bells': 10,
+    'postcode': 10,
+    'distance': 10,
+}
+
+# A Dove ring as far as matching is concerned
+Ring = namedtuple('Ring', ['ringid', 'towerid', 'place', 'dedication', 'bells', 'county', 'postcode'])
+
+# A suggested ring, its score and how far away it is (None if not known)
+Suggestion = namedtuple('Suggestion', ['score', 'distance', 'ring'])
+
+
+def _postcode(postcode):
+    return re.sub(r'\s+', '', (postcode or '').upper())
+
+
+def _similarity(a, b):
+    a, b = normalise(a or ''), normalise(b or '')
+    if not a or not b:
+        return 0.0
+    return 1.0 if a == b else SequenceMatcher(None, a, b).ratio()
+
+
+# This process's rings, as (generation, {ringid: Ring}, {county: [Ring]})
+_rings = None
+
+
+def rings():
+    """
+    Return {ringid: Ring} and {county: [Ring]} for all of Dove, reading
+    them again if the data has changed
+    """
+
+    global _rings
+
+    generation = get_generation(DOVE)
+    if _rings is None or _rings[0] != generation:
+        by_id, by_county = {}, {}
+        fields = ['ringid', 'towerid', 'place', 'dedicn', 'bells', 'county', 'postcode']
+        for values in Dove.objects.order_by().values_list(*fields):
+            ring = Ring(*values)
+            by_id[ring.ringid] = ring
+            by_county.setdefault(ring.county, []).append(ring)
+        _rings = (generation, by_id, by_county)
+    return _rings[1], _rings[2]
+
+
+def score(tower, ring, distance=None):
+    """
+    Score how well Dove `ring` matches `tower`, out of 100
+    """
+
+    total = WEIGHTS['place'] * _similarity(tower.place, ring.place)
+    total += WEIGHTS['dedication'] * _similarity(dove_dedication(tower.dedication), ring.dedication)
+    if tower.bells and tower.bells == ring.bells:
+        total += WEIGHTS['bells']
+    ours, theirs = _postcode(tower.postcode), _postcode(ring.postcode)
+    if ours and theirs:
+        if ours == theirs:
+            total += WEIGHTS['postcode']
+        elif ours[:-3] == theirs[:-3]:
+            total += WEIGHTS['postcode'] / 2
+    if distance is not None:
+        total += WEIGHTS['distance'] * max(0.0, 1 - distance / RADIUS)
+    return round(total, 1)
+
+
+def linked_rings():
+    """
+    Return {ringid: tower pk} for every ring a tower is linked to
+    """
+    return dict(Tower.objects.exclude(dove_ringid='').order_by().values_list('dove_ringid', 'pk'))
+
+
+def suggest(tower, limit=LIMIT, linked=None):
+    """
+    Return up to `limit` Suggestions of the Dove ring `tower` should be
+    linked to, best first. `linked` is linked_rings(), if it's to hand.
+    """
+
+    if linked is None:
+        linked = linked_rings()
+    by_id, by_county = rings()
+    county = Tower.Counties(tower.county).label if tower.county in Tower.Counties.values else tower.county
+
+    if tower.lat is not None and tower.lng is not None:
+        found = [(distance, by_id[place.id]) for distance, place in nearest(tower.lat, tower.lng, CANDIDATES, 'dove')
+                 if distance <= RADIUS and place.id in by_id]
+        # Only the ones in the same county, if there are any
+        candidates = [(distance, ring) for distance, ring in found if ring.county == county] or found
+    else:
+        candidates = [(None, ring) for ring in by_county.get(county, [])]
+
+    suggestions = [Suggestion(score(tower, ring, distance), distance, ring) for distance, ring in candidates
+                   if linked.get(ring.ringid, tower.pk) == tower.pk]
+    suggestions.sort(key=lambda s: (-s.score, s.distance if s.distance is not None else RADIUS, s.ring.ringid))
+    return suggestions[:limit]
+
+
+def suggest_all(towers, limit=LIMIT):
+    """
+    Return {tower pk: Suggestions} for each of `towers`
+    """
+    linked = linked_rings()
+    return {tower.pk: suggest(tower, limit, linked) for tower in towers}
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.11 on 2026-10-17 19:21
+
+from django.db import migrations, models
+
+import math
+
+
+# Copied from spatial.py and Tower.parse_location as they were when this
+# was written, so later changes to them can't change what this does
+
+CELL_SIZE = 0.1
+ROWS = round(180 / CELL_SIZE)
+COLUMNS = round(360 / CELL_SIZE)
+
+
+def grid_cell(lat, lng):
+    row = min(max(math.floor((lat + 90) / CELL_SIZE), 0), ROWS - 1)
+    column = min(max(math.floor((lng + 180) / CELL_SIZE), 0), COLUMNS - 1)
+    return row * COLUMNS + column
+
+
+def parse_location(value):
+    """
+    Return the latitude and longitude in a Location ('52.2,0.12'), or None
+    """
+    try:
+        lat, lng = [float(v) for v in value.split(',')]
+    except ValueError:
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return None
+    return lat, lng
+
+
+def set_grid_cells(apps, schema_editor):
+    for model in ('Tower', 'HistoricalTower'):
+        Model = apps.get_model('tower_database', model)
+        rows = []
+        for row in Model.objects.exclude(latlng=''):
+            location = parse_location(row.latlng)
+            # Anything unreadable is left without a cell, as save() would refuse it
+            if location:
+                row.grid_cell = grid_cell(*location)
+                rows.append(row)
+        Model.objects.bulk_update(rows, ['grid_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0006_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicaltower',
+            name='grid_cell',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, help_text='Spatial index cell, derived from the location', null=True),
+        ),
+        migrations.AddField(
+            model_name='tower',
+            name='grid_cell',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, help_text='Spatial index cell, derived from the location', null=True),
+        ),
+        migrations.RunPython(set_grid_cells, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.11 on 2026-10-17 19:21
+
+from django.db import migrations, models
+
+import math
+
+
+# Copied from Tower.parse_location as it was when this was written, so
+# later changes to it can't change what this does
+
+def parse_location(value):
+    """
+    Return the latitude and longitude in a Location ('52.2,0.12'), or None
+    """
+    try:
+        lat, lng = [float(v) for v in value.split(',')]
+    except ValueError:
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return None
+    return lat, lng
+
+
+def set_lat_lng(apps, schema_editor):
+    for model in ('Tower', 'HistoricalTower'):
+        Model = apps.get_model('tower_database', model)
+        rows = []
+        for row in Model.objects.exclude(latlng=''):
+            location = parse_location(row.latlng)
+            # Anything unreadable is left NULL, as save() would refuse it
+            if location:
+                row.lat, row.lng = location
+                rows.append(row)
+        Model.objects.bulk_update(rows, ['lat', 'lng'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0007_tower_grid_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicaltower',
+            name='lat',
+            field=models.FloatField(blank=True, db_index=True, editable=False, help_text='Latitude, derived from the location', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicaltower',
+            name='lng',
+            field=models.FloatField(blank=True, db_index=True, editable=False, help_text='Longitude, derived from the location', null=True),
+        ),
+        migrations.AddField(
+            model_name='tower',
+            name='lat',
+            field=models.FloatField(blank=True, db_index=True, editable=False, help_text='Latitude, derived from the location', null=True),
+        ),
+        migrations.AddField(
+            model_name='tower',
+            name='lng',
+            field=models.FloatField(blank=True, db_index=True, editable=False, help_text='Longitude, derived from the location', null=True),
+        ),
+        migrations.RunPython(set_lat_lng, migrations.RunPython.noop),
+    ]
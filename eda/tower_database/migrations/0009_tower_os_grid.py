@@ -0,0 +1,54 @@
+# Generated by Django 5.2.11 on 2026-10-17 19:31
+
+import tower_database.models
+from django.db import migrations, models
+
+from OSGridConverter import latlong2grid
+
+import re
+
+
+# Copied from the model as it was when this was written, so later changes
+# to it can't change what this does
+
+def os_grid_reference(lat, lng):
+    """
+    Return the 6-figure OS grid reference (e.g. 'TL436578') of (`lat`, `lng`), or ''
+    """
+    try:
+        g = str(latlong2grid(lat, lng))
+    except Exception:
+        return ''
+    reference = g[0:2] + g[3:6] + g[9:12]
+    return reference if re.fullmatch(r'[A-Z]{2}\d{6}', reference) else ''
+
+
+def set_os_grid(apps, schema_editor):
+    for model in ('Tower', 'HistoricalTower'):
+        Model = apps.get_model('tower_database', model)
+        # 0008 has already worked out lat and lng wherever the location makes sense
+        rows = list(Model.objects.filter(lat__isnull=False, lng__isnull=False))
+        for row in rows:
+            row.os_grid = os_grid_reference(row.lat, row.lng)
+        Model.objects.bulk_update(rows, ['os_grid'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0008_tower_lat_lng'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicaltower',
+            name='os_grid',
+            field=models.CharField(blank=True, editable=False, help_text='Derived from the location', max_length=8, validators=[tower_database.models.Tower.grid_validator], verbose_name='OS Grid'),
+        ),
+        migrations.AddField(
+            model_name='tower',
+            name='os_grid',
+            field=models.CharField(blank=True, editable=False, help_text='Derived from the location', max_length=8, validators=[tower_database.models.Tower.grid_validator], verbose_name='OS Grid'),
+        ),
+        migrations.RunPython(set_os_grid, migrations.RunPython.noop),
+    ]
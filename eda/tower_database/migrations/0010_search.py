@@ -0,0 +1,72 @@
+from django.db import migrations
+
+from unidecode import unidecode
+
+import re
+
+
+# Copied from search.py as it was when this was written, so later changes
+# to it can't change what this does
+
+COLUMNS = {
+    'place': ['place'],
+    'dedication': ['dedication', 'full_dedication'],
+    'nickname': ['nickname'],
+    'notes': ['notes', 'long_notes'],
+    'service': ['service'],
+    'practice': ['practice'],
+}
+
+SYNONYMS = [
+    {'s', 'st', 'saint'},
+    {'ss', 'sts', 'saints'},
+    {'gt', 'great'},
+    {'lt', 'little'},
+    {'bapt', 'baptist'},
+    {'ev', 'evangelist'},
+    {'magd', 'magdalene', 'magdalen'},
+    {'v', 'virgin'},
+    {'cath', 'cathedral'},
+    {'ch', 'church'},
+]
+
+
+def normalise(text):
+    return re.sub(r"'s\b", '', unidecode(text or ''), flags=re.IGNORECASE)
+
+
+def with_synonyms(text):
+    words = set(re.findall(r'\w+', text.lower()))
+    extra = set()
+    for group in SYNONYMS:
+        if words & group:
+            extra |= group
+    return ' '.join([text, *sorted(extra - words)])
+
+
+def build_index(apps, schema_editor):
+    Tower = apps.get_model('tower_database', 'Tower')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO tower_database_search (rowid, {', '.join(COLUMNS)}) "
+            f"VALUES (%s{', %s' * len(COLUMNS)})",
+            [[tower.pk, *[with_synonyms(normalise(' '.join(getattr(tower, field) or '' for field in fields)))
+                          for fields in COLUMNS.values()]]
+             for tower in Tower.objects.all()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0009_tower_os_grid'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE VIRTUAL TABLE tower_database_search USING fts5("
+            "place, dedication, nickname, notes, service, practice, "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+            "DROP TABLE tower_database_search",
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
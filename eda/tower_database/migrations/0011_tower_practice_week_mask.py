@@ -0,0 +1,59 @@
+# Generated by Django 5.2.11 on 2026-10-17 19:47
+
+from django.db import migrations, models
+
+
+# Copied from practice.py as it was when this was written, so later
+# changes to it can't change what this does
+
+WEEKS = ['1st', '2nd', '3rd', '4th', '5th']
+ALL_WEEKS = (1 << len(WEEKS)) - 1
+ALTERNATE = 1 << len(WEEKS)
+
+
+def week_mask(practice_day, practice_weeks):
+    if not practice_day:
+        return None
+    if 'alternate' in practice_weeks:
+        return ALL_WEEKS | ALTERNATE
+    mask = 0
+    for bit, week in enumerate(WEEKS):
+        if week in practice_weeks:
+            mask |= 1 << bit
+    if not mask:
+        return ALL_WEEKS
+    return ALL_WEEKS & ~mask if 'not' in practice_weeks else mask
+
+
+def set_week_masks(apps, schema_editor):
+    for model in ('Tower', 'HistoricalTower'):
+        Model = apps.get_model('tower_database', model)
+        rows = list(Model.objects.exclude(practice_day=''))
+        for row in rows:
+            row.practice_week_mask = week_mask(row.practice_day, row.practice_weeks)
+        Model.objects.bulk_update(rows, ['practice_week_mask'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0010_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicaltower',
+            name='practice_week_mask',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, help_text='Weeks of the month of main practice, derived from the day and weeks (see practice.py)', null=True),
+        ),
+        migrations.AddField(
+            model_name='tower',
+            name='practice_week_mask',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, help_text='Weeks of the month of main practice, derived from the day and weeks (see practice.py)', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tower',
+            index=models.Index(fields=['practice_day', 'practice_week_mask'], name='tower_practice_idx'),
+        ),
+        migrations.RunPython(set_week_masks, migrations.RunPython.noop),
+    ]
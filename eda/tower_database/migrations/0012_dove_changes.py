@@ -0,0 +1,50 @@
+# Generated by Django 5.2.11 on 2026-10-17 19:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tower_database', '0011_tower_practice_week_mask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoveUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('snapshot', models.CharField(help_text='The compressed copy of the file loaded', max_length=100)),
+                ('previous_snapshot', models.CharField(blank=True, max_length=100)),
+                ('generation', models.BigIntegerField(help_text='The DOVE generation this load created')),
+                ('previous_generation', models.BigIntegerField(blank=True, null=True)),
+                ('rings', models.PositiveIntegerField(default=0)),
+                ('added', models.PositiveIntegerField(default=0)),
+                ('removed', models.PositiveIntegerField(default=0)),
+                ('changed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-time'],
+                'get_latest_by': 'time',
+            },
+        ),
+        migrations.CreateModel(
+            name='DoveChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ringid', models.CharField(db_index=True, max_length=10, verbose_name='RingID')),
+                ('towerid', models.CharField(blank=True, max_length=10, verbose_name='TowerID')),
+                ('place', models.CharField(blank=True, max_length=100)),
+                ('dedication', models.CharField(blank=True, max_length=100)),
+                ('kind', models.CharField(choices=[('A', 'Added'), ('R', 'Removed'), ('C', 'Changed')], max_length=1)),
+                ('fields', models.JSONField(blank=True, default=dict)),
+                ('reviewed', models.BooleanField(default=False)),
+                ('update', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='tower_database.doveupdate')),
+            ],
+            options={
+                'ordering': ['update', 'place', 'dedication', 'ringid'],
+            },
+        ),
+    ]
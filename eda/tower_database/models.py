@@ -1,38 +1,94 @@
 from django.contrib import admin
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
 from multiselectfield import MultiSelectField
 from simple_history.models import HistoricalRecords
-from OSGridConverter import latlong2grid
 
+import contextlib
+import functools
+import math
 import os.path
 import re
+import threading
 import uuid
 
 from collections import defaultdict
 
+from .invalidation import ALL_TOWERS, tower_key, district_key, invalidate
+from .osgrid import grid_reference
+from .practice import week_mask
+from .spatial import grid_cell
 
-# Shortcut for invalidating the cache (used for GEioJANGO) when 
-# a model instance is saved or deleted
+
+class _Changes(threading.local):
+    # The cache dependencies gathered by this thread's batched_invalidation()
+    dependencies = None
+
+_changes = _Changes()
+
+
+@contextlib.contextmanager
+def batched_invalidation():
+    """
+    Gather the cache dependencies of everything saved or deleted in the
+    block and invalidate them together, with one on_commit callback - so
+    saving a tower with all its contacts, websites and photos only bumps
+    each generation once. Use it inside the transaction making the changes.
+    """
+
+    if _changes.dependencies is not None:
+        # Already gathering for an enclosing block
+        yield
+        return
+
+    _changes.dependencies = {}
+    try:
+        yield
+        dependencies = list(_changes.dependencies)
+    finally:
+        _changes.dependencies = None
+
+    if dependencies:
+        transaction.on_commit(functools.partial(invalidate, *dependencies))
+
+
+# Shortcut for invalidating cached pages (tower details, GeoJSON
+# snapshots, etc.) that depend on a model instance when it is saved or
+# deleted. Subclasses say what they affect by implementing
+# cache_dependencies()
 
 class CacheInvalidayingModel(models.Model):
 
     class Meta:
         abstract = True
 
+    def cache_dependencies(self):
+        raise NotImplementedError
+
+    def _invalidate(self, dependencies):
+        if _changes.dependencies is not None:
+            _changes.dependencies.update(dict.fromkeys(dependencies))
+        else:
+            # Wait for the commit so nothing can re-cache the old data
+            # under the new generation (and nothing happens on a rollback)
+            transaction.on_commit(functools.partial(invalidate, *dependencies))
+
     def save(self, **kwargs):
         super().save(**kwargs)
-        cache.clear()
+        self._invalidate(self.cache_dependencies())
 
     def delete(self, **kwargs):
-        super().save(**kwargs)
-        cache.clear()
+        # Work out the dependencies while we still have a primary key
+        dependencies = self.cache_dependencies()
+        result = super().delete(**kwargs)
+        self._invalidate(dependencies)
+        return result
 
 # Create your models here.
 
@@ -155,6 +211,18 @@ class Tower(CacheInvalidayingModel):
         if not TowerConstants.POSTCODE_PATTERN.fullmatch(value):
             raise ValidationError(f"Wrong format for Postcode")
 
+    def parse_location(value):
+        """
+        Return the latitude and longitude in a Location ('52.2,0.12')
+        """
+        try:
+            lat, lng = [float(v) for v in value.split(',')]
+        except ValueError:
+            raise ValidationError(f"Wrong format for Location (use, e.g. 52.2,0.12)")
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            raise ValidationError(f"Wrong format for Location (use, e.g. 52.2,0.12)")
+        return lat, lng
+
     place = models.CharField(max_length=100, help_text="Town or village containing the tower")
     county  = models.CharField(max_length=100, choices=Counties, default='Cambridgeshire')
     dedication = models.CharField(max_length=100, help_text="Church dedication. Use ‘St’ not ‘St.’; ‘and’ not ‘&’")
@@ -168,6 +236,7 @@ class Tower(CacheInvalidayingModel):
     practice = models.CharField(max_length=200, blank=True, validators=[time_validator], help_text="Short description of normal practice ringing. No initial capital (unless day of week)")
     practice_day = models.CharField(max_length=9, blank=True, choices=Days, help_text="Day of the week of main practice")
     practice_weeks = MultiSelectField(max_length=50, blank=True, choices=PracticeWeeks, validators=[week_validator], help_text="Week(s) of the month for main practice if not all")
+    practice_week_mask = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, help_text="Weeks of the month of main practice, derived from the day and weeks (see practice.py)")
     travel_check = models.BooleanField(default=False, help_text="Check before travelling to practices?")
     bells = models.PositiveIntegerField(null=True, blank=True, help_text="Number of ringable bells",validators=[bell_validator])
     ring_type = models.CharField(max_length=20, blank=True, choices=RingTypes)
@@ -176,6 +245,10 @@ class Tower(CacheInvalidayingModel):
     gf = models.BooleanField(blank=True, null=True, verbose_name="Ground Floor?")
     postcode = models.CharField(max_length=10, blank=True, validators=[postcode_validator])
     latlng = models.CharField(max_length=20, blank=True, verbose_name='Location')
+    lat = models.FloatField(null=True, blank=True, editable=False, db_index=True, help_text="Latitude, derived from the location")
+    lng = models.FloatField(null=True, blank=True, editable=False, db_index=True, help_text="Longitude, derived from the location")
+    grid_cell = models.IntegerField(null=True, blank=True, editable=False, db_index=True, help_text="Spatial index cell, derived from the location")
+    os_grid = models.CharField(max_length=8, blank=True, editable=False, validators=[grid_validator], verbose_name="OS Grid", help_text="Derived from the location")
     peals = models.PositiveIntegerField(null=True , blank=True, help_text="Peals in most recent Annual Report")
     dove_towerid = models.CharField(max_length=10, blank=True, verbose_name="Dove TowerID")
     dove_ringid = models.CharField(max_length=10, blank=True, verbose_name="Dove RingID")
@@ -187,6 +260,9 @@ class Tower(CacheInvalidayingModel):
 
     class Meta:
         ordering = ["place", "dedication"]
+        indexes = [
+            models.Index(fields=["practice_day", "practice_week_mask"], name="tower_practice_idx"),
+        ]
         constraints = [
             models.UniqueConstraint(fields=["place", "dedication"], name="unique_place_dedication",
                 violation_error_message="Can't have two towers with the same place and dedication")
@@ -195,6 +271,49 @@ class Tower(CacheInvalidayingModel):
     def __str__(self):
         return f'{self.place} - {self.dedication}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember where we started so moves between districts invalidate both
+        instance._loaded_district = instance.__dict__.get('district')
+        # ...and where it was, so the grid reference is only recomputed after a move
+        instance._loaded_latlng = instance.__dict__.get('latlng')
+        return instance
+
+    def cache_dependencies(self):
+        dependencies = [ALL_TOWERS, tower_key(self.pk), district_key(self.district)]
+        loaded_district = getattr(self, '_loaded_district', None)
+        if loaded_district and loaded_district != self.district:
+            dependencies.append(district_key(loaded_district))
+        return dependencies
+
+    def set_location(self):
+        """
+        Bring the typed and indexed copies of the location, and the OS grid
+        reference, into step with `latlng`
+        """
+        if self.latlng:
+            self.lat, self.lng = Tower.parse_location(self.latlng)
+            self.grid_cell = grid_cell(self.lat, self.lng)
+            self.os_grid = grid_reference(self.lat, self.lng)
+        else:
+            self.lat = self.lng = self.grid_cell = None
+            self.os_grid = ''
+
+    def save(self, **kwargs):
+        # The grid reference is relatively expensive, so only work any of
+        # this out when the location has changed (or never been saved)
+        if not hasattr(self, '_loaded_latlng') or self.latlng != self._loaded_latlng:
+            self.set_location()
+        if kwargs.get('update_fields') is not None and 'latlng' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'lat', 'lng', 'grid_cell', 'os_grid'}
+        self.practice_week_mask = week_mask(self.practice_day, self.practice_weeks)
+        if kwargs.get('update_fields') is not None and {'practice_day', 'practice_weeks'} & set(kwargs['update_fields']):
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'practice_week_mask'}
+        super().save(**kwargs)
+        self._loaded_district = self.district
+        self._loaded_latlng = self.latlng
+
     def get_absolute_url(self):
         return reverse("tower_detail", kwargs={"pk": self.pk})
 
@@ -216,14 +335,17 @@ class Tower(CacheInvalidayingModel):
             n = 'not '
         return n + ', '.join([w for w in self.practice_weeks if w != 'not'])
 
-    @property
+    # These are used several times per tower when rendering, so only look
+    # once (and prefetch contact_set where there are many towers)
+
+    @cached_property
     def primary_contact(self):
         for contact in self.contact_set.all():
             if contact.primary:
                 return contact
         return None
 
-    @property
+    @cached_property
     def other_contacts(self):
         return [c for c in self.contact_set.all() if not c.primary]
 
@@ -239,20 +361,6 @@ class Tower(CacheInvalidayingModel):
     def felstead_link(self):
         return f"https://felstead.cccbr.org.uk/tbid.php?tid={self.towerbase_id}"
 
-    @property
-    def lat(self):
-        return float(self.latlng.split(',')[0])
-
-    @property
-    def lng(self):
-        return float(self.latlng.split(',')[1])
-
-    @property
-    def os_grid(self):
-        g = str(latlong2grid(self.lat, self.lng))
-        return g[0:2] + g[3:6] + g[9:12]
-    os_grid.fget.short_description = "OS Grid"
-
     def clean(self):
 
         """
@@ -288,6 +396,13 @@ class Tower(CacheInvalidayingModel):
             if not re.search(r'\b' + phrase + r'\b', self.practice, re.IGNORECASE):
                 errors['practice_weeks'].append(f"'{phrase}' doesn't appear in Practice")
 
+        # latlng - save() works out lat, lng, etc. from it
+        if self.latlng:
+            try:
+                Tower.parse_location(self.latlng)
+            except ValidationError as e:
+                errors['latlng'].extend(e.messages)
+
         if errors:
             raise ValidationError(errors)
 
@@ -338,6 +453,9 @@ class Contact(CacheInvalidayingModel):
     def __str__(self):
         return f'{self.tower} ({self.get_role_display()})'
 
+    def cache_dependencies(self):
+        return self.tower.cache_dependencies()
+
     @property
     @admin.display(ordering="first_name")
     def full_name(self):
@@ -376,6 +494,9 @@ class Website(CacheInvalidayingModel):
     def __str__(self):
         return f'{self.tower}'
 
+    def cache_dependencies(self):
+        return self.tower.cache_dependencies()
+
 
 def rename_image(instance, filename):
     suffix = (os.path.splitext(filename)[1]).lower()
@@ -399,15 +520,31 @@ class Photo(CacheInvalidayingModel):
     def __str__(self):
         return f'{self.tower} ({self.height}x{self.width})'
 
+    def cache_dependencies(self):
+        return self.tower.cache_dependencies()
+
     @property
     def img_tag(self):
         return mark_safe(f'<img src="{escape(self.image.url)}" height="{min(self.image.height, 200)} alt="{self.alt_text}">')
 
 
+class Generation(models.Model):
+
+    """
+    The current generation of each cache dependency (see invalidation.py)
+    """
+
+    key = models.CharField(max_length=100, primary_key=True)
+    value = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.key}: {self.value}'
+
+
 # Auto-generated with ./manage.py inspectdb
 
 class Dove(models.Model):
-    towerid = models.CharField(db_column='TowerID', blank=True, null=True)  # Field name made lowercase.
+    towerid = models.CharField(db_column='TowerID', blank=True, null=True, db_index=True)  # Field name made lowercase.
     ringid = models.CharField(db_column='RingID', primary_key=True)  # Field name made lowercase.
     ringtype = models.CharField(db_column='RingType', blank=True, null=True)  # Field name made lowercase.
     place = models.CharField(db_column='Place', blank=True, null=True)  # Field name made lowercase.
@@ -420,29 +557,29 @@ class Dove(models.Model):
     altname = models.CharField(db_column='AltName', blank=True, null=True)  # Field name made lowercase.
     ringname = models.CharField(db_column='RingName', blank=True, null=True)  # Field name made lowercase.
     region = models.CharField(db_column='Region', blank=True, null=True)  # Field name made lowercase.
-    county = models.CharField(db_column='County', blank=True, null=True)  # Field name made lowercase.
+    county = models.CharField(db_column='County', blank=True, null=True, db_index=True)  # Field name made lowercase.
     country = models.CharField(db_column='Country', blank=True, null=True)  # Field name made lowercase.
     histregion = models.CharField(db_column='HistRegion', blank=True, null=True)  # Field name made lowercase.
     iso3166code = models.CharField(db_column='ISO3166code', blank=True, null=True)  # Field name made lowercase.
-    diocese = models.CharField(db_column='Diocese', blank=True, null=True)  # Field name made lowercase.
-    lat = models.CharField(db_column='Lat', blank=True, null=True)  # Field name made lowercase.
-    long = models.CharField(db_column='Long', blank=True, null=True)  # Field name made lowercase.
-    bells = models.CharField(db_column='Bells', blank=True, null=True)  # Field name made lowercase.
-    ur = models.CharField(db_column='UR', blank=True, null=True)  # Field name made lowercase.
+    diocese = models.CharField(db_column='Diocese', blank=True, null=True, db_index=True)  # Field name made lowercase.
+    lat = models.FloatField(db_column='Lat', blank=True, null=True)  # Field name made lowercase.
+    long = models.FloatField(db_column='Long', blank=True, null=True)  # Field name made lowercase.
+    bells = models.IntegerField(db_column='Bells', blank=True, null=True)  # Field name made lowercase.
+    ur = models.BooleanField(db_column='UR', default=False)  # Field name made lowercase.
     semitones = models.CharField(db_column='Semitones', blank=True, null=True)  # Field name made lowercase.
-    wt = models.CharField(db_column='Wt', blank=True, null=True)  # Field name made lowercase.
-    app = models.CharField(db_column='App', blank=True, null=True)  # Field name made lowercase.
+    wt = models.FloatField(db_column='Wt', blank=True, null=True)  # Field name made lowercase.
+    app = models.BooleanField(db_column='App', default=False)  # Field name made lowercase.
     note = models.CharField(db_column='Note', blank=True, null=True)  # Field name made lowercase.
-    hz = models.CharField(db_column='Hz', blank=True, null=True)  # Field name made lowercase.
+    hz = models.FloatField(db_column='Hz', blank=True, null=True)  # Field name made lowercase.
     details = models.CharField(db_column='Details', blank=True, null=True)  # Field name made lowercase.
-    gf = models.CharField(db_column='GF', blank=True, null=True)  # Field name made lowercase.
-    toilet = models.CharField(db_column='Toilet', blank=True, null=True)  # Field name made lowercase.
-    simulator = models.CharField(db_column='Simulator', blank=True, null=True)  # Field name made lowercase.
+    gf = models.BooleanField(db_column='GF', default=False)  # Field name made lowercase.
+    toilet = models.BooleanField(db_column='Toilet', default=False)  # Field name made lowercase.
+    simulator = models.BooleanField(db_column='Simulator', default=False)  # Field name made lowercase.
     extrainfo = models.CharField(db_column='ExtraInfo', blank=True, null=True)  # Field name made lowercase.
     webpage = models.CharField(db_column='WebPage', blank=True, null=True)  # Field name made lowercase.
     affiliations = models.CharField(db_column='Affiliations', blank=True, null=True)  # Field name made lowercase.
     ng = models.CharField(db_column='NG', blank=True, null=True)  # Field name made lowercase.
-    postcode = models.CharField(db_column='Postcode', blank=True, null=True)  # Field name made lowercase.
+    postcode = models.CharField(db_column='Postcode', blank=True, null=True, db_index=True)  # Field name made lowercase.
     practice = models.CharField(db_column='Practice', blank=True, null=True)  # Field name made lowercase.
     ovhaulyr = models.CharField(db_column='OvhaulYr', blank=True, null=True)  # Field name made lowercase.
     contractor = models.CharField(db_column='Contractor', blank=True, null=True)  # Field name made lowercase.
@@ -453,15 +590,73 @@ class Dove(models.Model):
     chrassetid = models.CharField(db_column='CHRAssetID', blank=True, null=True)  # Field name made lowercase.
     towerbase = models.CharField(db_column='TowerBase', blank=True, null=True)  # Field name made lowercase.
     doveid = models.CharField(db_column='DoveID', blank=True, null=True)  # Field name made lowercase.
-    snlat = models.CharField(db_column='SNLat', blank=True, null=True)  # Field name made lowercase.
-    snlong = models.CharField(db_column='SNLong', blank=True, null=True)  # Field name made lowercase.
+    snlat = models.FloatField(db_column='SNLat', blank=True, null=True)  # Field name made lowercase.
+    snlong = models.FloatField(db_column='SNLong', blank=True, null=True)  # Field name made lowercase.
 
     class Meta:
+        # Loaded by the load_dove command, which also builds the indexes
         managed = False
         db_table = 'dove_towers'
         ordering = ["place", "dedicn"]
+        indexes = [
+            models.Index(fields=["place", "dedicn"], name="dove_towers_name"),
+            models.Index(fields=["lat", "long"], name="dove_towers_position"),
+        ]
         verbose_name = 'dove record'
 
     def __str__(self):
         return f'{self.place}  ({self.dedicn})'
 
+
+
+class DoveUpdate(models.Model):
+
+    """
+    One load of a new copy of Dove (see dove.py), with how it differed from
+    the one before
+    """
+
+    time = models.DateTimeField(auto_now_add=True)
+    snapshot = models.CharField(max_length=100, help_text="The compressed copy of the file loaded")
+    previous_snapshot = models.CharField(max_length=100, blank=True)
+    generation = models.BigIntegerField(help_text="The DOVE generation this load created")
+    previous_generation = models.BigIntegerField(null=True, blank=True)
+    rings = models.PositiveIntegerField(default=0)
+    added = models.PositiveIntegerField(default=0)
+    removed = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-time"]
+        get_latest_by = "time"
+
+    def __str__(self):
+        return f'{self.time:%Y-%m-%d %H:%M}: {self.added} added, {self.removed} removed, {self.changed} changed'
+
+
+class DoveChange(models.Model):
+
+    """
+    A Dove ring that was added, removed or changed by a DoveUpdate, with
+    the fields that changed as {field: [old, new]}
+    """
+
+    class Kind(models.TextChoices):
+        ADDED = 'A'
+        REMOVED = 'R'
+        CHANGED = 'C'
+
+    update = models.ForeignKey(DoveUpdate, on_delete=models.CASCADE, related_name='changes')
+    ringid = models.CharField(max_length=10, db_index=True, verbose_name="RingID")
+    towerid = models.CharField(max_length=10, blank=True, verbose_name="TowerID")
+    place = models.CharField(max_length=100, blank=True)
+    dedication = models.CharField(max_length=100, blank=True)
+    kind = models.CharField(max_length=1, choices=Kind.choices)
+    fields = models.JSONField(default=dict, blank=True)
+    reviewed = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ["update", "place", "dedication", "ringid"]
+
+    def __str__(self):
+        return f'{self.place} {self.dedication} ({self.get_kind_display().lower()})'
@@ -0,0 +1,230 @@
+"""
+Nearest-tower searches.
+
+Towers (and Dove rings) are indexed in a KD-tree of points on the unit
+sphere, in which straight-line distance increases with great-circle
+distance, so the nearest points in the tree are the nearest on the
+ground. A tree is built the first time it's needed for each generation
+of the underlying data (see invalidation.py) and kept for as long as
+that generation is current, so a search is just a walk down the tree.
+"""
+
+from django.urls import reverse
+
+from collections import namedtuple
+
+import heapq
+import math
+import re
+
+from .invalidation import ALL_TOWERS, DOVE, get_generation
+from .models import Tower, Dove
+
+
+EARTH_RADIUS = 6371.0088  # km
+
+# What gets returned for each tower found
+Place = namedtuple('Place', ['id', 'place', 'dedication', 'bells', 'ringing_status', 'lat', 'lng', 'url'])
+
+
+def _vector(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def _km(squared_chord):
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(squared_chord) / 2, 1.0))
+
+
+class KDTree:
+    """
+    A static KD-tree over a list of Places. The tree is implicit: each
+    node is the median of a range of the (reordered) points, with the
+    points either side of it in its two sub-trees.
+    """
+
+    def __init__(self, items):
+        points = [_vector(item.lat, item.lng) for item in items]
+        order = list(range(len(items)))
+        self._axes = [0] * len(items)
+        self._build(points, order, 0, len(order))
+        self._points = [points[i] for i in order]
+        self._items = [items[i] for i in order]
+        # The most bells anywhere in each sub-tree, so searches for rings
+        # of at least some size can skip whole sub-trees
+        self._max_bells = [0] * len(items)
+        self._index_bells(0, len(items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def _build(self, points, order, lo, hi):
+        if hi - lo < 2:
+            return
+        # Split on whichever axis the points are most spread out along
+        spreads = []
+        for axis in range(3):
+            values = [points[i][axis] for i in order[lo:hi]]
+            spreads.append(max(values) - min(values))
+        axis = spreads.index(max(spreads))
+        order[lo:hi] = sorted(order[lo:hi], key=lambda i: points[i][axis])
+        mid = (lo + hi) // 2
+        self._axes[mid] = axis
+        self._build(points, order, lo, mid)
+        self._build(points, order, mid + 1, hi)
+
+    def _index_bells(self, lo, hi):
+        if lo >= hi:
+            return 0
+        mid = (lo + hi) // 2
+        self._max_bells[mid] = max(self._items[mid].bells or 0,
+                                   self._index_bells(lo, mid),
+                                   self._index_bells(mid + 1, hi))
+        return self._max_bells[mid]
+
+    def _search(self, lo, hi, target, k, best, where, min_bells):
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        if self._max_bells[mid] < min_bells:
+            return
+        point = self._points[mid]
+        distance = ((point[0] - target[0]) ** 2 +
+                    (point[1] - target[1]) ** 2 +
+                    (point[2] - target[2]) ** 2)
+        if (self._items[mid].bells or 0) >= min_bells and (where is None or where(self._items[mid])):
+            # 'best' is a max-heap (by negated distance) of the k best so far
+            if len(best) < k:
+                heapq.heappush(best, (-distance, mid))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, mid))
+        axis = self._axes[mid]
+        offset = target[axis] - point[axis]
+        if offset < 0:
+            near, far = (lo, mid), (mid + 1, hi)
+        else:
+            near, far = (mid + 1, hi), (lo, mid)
+        self._search(*near, target, k, best, where, min_bells)
+        # Only look on the far side if something there could be closer
+        if len(best) < k or offset * offset < -best[0][0]:
+            self._search(*far, target, k, best, where, min_bells)
+
+    def nearest(self, lat, lng, k=10, where=None, min_bells=0):
+        """
+        Return a list of (distance in km, Place) for the `k` places
+        nearest to (`lat`, `lng`), nearest first, considering only those
+        with at least `min_bells` bells and for which `where` (if given)
+        returns True
+        """
+
+        best = []
+        self._search(0, len(self._items), _vector(lat, lng), k, best, where, min_bells)
+        return [(_km(-distance), self._items[i]) for distance, i in sorted(best, reverse=True)]
+
+
+def _tower_places():
+    towers = Tower.objects.exclude(lat=None).values_list(
+        'pk', 'place', 'dedication', 'bells', 'ringing_status', 'lat', 'lng')
+    return [Place(pk, place, dedication, bells, ringing_status, lat, lng, reverse('tower_detail', kwargs={'pk': pk}))
+            for pk, place, dedication, bells, ringing_status, lat, lng in towers]
+
+
+def _dove_places():
+    places = []
+    rings = Dove.objects.order_by().exclude(lat=None).exclude(long=None).values_list(
+        'ringid', 'towerid', 'place', 'dedicn', 'bells', 'ur', 'ringtype', 'lat', 'long')
+    for ringid, towerid, place, dedicn, bells, ur, ringtype, lat, lng in rings:
+        # Dove doesn't distinguish occasional ringing
+        ringing_status = 'R' if ringtype == 'Full-circle ring' and not ur else 'N'
+        places.append(Place(ringid, place, dedicn, bells, ringing_status, lat, lng,
+                            f"https://dove.cccbr.org.uk/tower/{towerid}"))
+    return places
+
+
+# Each source of places, with the generation key it depends on
+SOURCES = {
+    'towers': (ALL_TOWERS, _tower_places),
+    'dove': (DOVE, _dove_places),
+}
+
+# This process's trees, as {source: (generation, tree)}
+_trees = {}
+
+
+def tree(source='towers'):
+    """
+    Return the KD-tree for `source`, building it if the data has changed
+    """
+
+    dependency, places = SOURCES[source]
+    generation = get_generation(dependency)
+    cached = _trees.get(source)
+    if cached is None or cached[0] != generation:
+        cached = (generation, KDTree(places()))
+        _trees[source] = cached
+    return cached[1]
+
+
+def nearest(lat, lng, k=10, source='towers', bells__gte=None, ringing_status=None, exclude=None):
+    """
+    Return a list of (distance in km, Place) for the `k` towers nearest to
+    (`lat`, `lng`), optionally with at least `bells__gte` bells, with one
+    of the `ringing_status` values, and/or not including the place with
+    ID `exclude`
+    """
+
+    def where(place):
+        return ((ringing_status is None or place.ringing_status in ringing_status) and
+                (exclude is None or place.id != exclude))
+
+    filtered = ringing_status is not None or exclude is not None
+    return tree(source).nearest(lat, lng, k, where if filtered else None, bells__gte or 0)
+
+
+# A UK postcode ('CB2 1RF'), or just its outward code ('CB2')
+POSTCODE_PATTERN = re.compile(r'([A-Z]{1,2}\d[A-Z\d]?) ?(\d[A-Z]{2})?')
+
+
+def parse_postcode(value):
+    """
+    Return the outward and inward codes of the postcode `value` (the inward
+    code being None if there's only an outward one), raising ValueError if
+    it isn't one
+    """
+    match = POSTCODE_PATTERN.fullmatch(re.sub(r'\s+', ' ', value.strip().upper()))
+    if not match:
+        raise ValueError(f"'{value}' isn't a UK postcode")
+    return match.group(1), match.group(2)
+
+
+def _located(prefix=None, postcode=None):
+    # The positions of the towers and Dove rings with `postcode`, or a postcode starting with `prefix`
+    lookup = {'postcode': postcode} if postcode else {'postcode__startswith': prefix}
+    towers = Tower.objects.filter(**lookup).exclude(lat=None).order_by().values_list('lat', 'lng')
+    rings = Dove.objects.filter(**lookup).exclude(lat=None).exclude(long=None).order_by().values_list('lat', 'long')
+    return towers, rings
+
+
+def postcode_location(postcode):
+    """
+    Return the (lat, lng) of `postcode`, or None if it can't be placed.
+    There's no postcode directory, so this is where a tower or Dove ring
+    with that postcode is or, failing that, the middle of those in the same
+    sector ('CB2 1') or else district ('CB2'). Raises ValueError if
+    `postcode` isn't a UK postcode (or outward code).
+    """
+
+    outward, inward = parse_postcode(postcode)
+
+    if inward:
+        for located in _located(postcode=f'{outward} {inward}'):
+            location = located.first()
+            if location:
+                return location
+
+    prefixes = [f'{outward} {inward[0]}', f'{outward} '] if inward else [f'{outward} ']
+    for prefix in prefixes:
+        points = [point for located in _located(prefix) for point in located]
+        if points:
+            return (sum(lat for lat, _ in points) / len(points), sum(lng for _, lng in points) / len(points))
+    return None
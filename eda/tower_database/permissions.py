@@ -0,0 +1,83 @@
+"""
+Who can edit which towers.
+
+Towers (and their contacts, websites and photos) can be edited by anyone
+with the standard change_tower permission (superusers and the 'Tower
+Database admin' group) and by anyone with the admin_[district]
+permission for the tower's district (the district admin groups - see the
+setup_tower_database_permissions command).
+
+editable_districts() works out the set of districts a user can edit once
+per request and keeps it in their session, against the PERMISSIONS
+generation (see invalidation.py), which is bumped whenever anyone's
+groups or permissions change - so the admin's many permission hooks, and
+the public pages' edit links, don't each go back to the database.
+"""
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .invalidation import PERMISSIONS, get_generation, invalidate
+from .models import Tower
+
+
+SESSION_KEY = 'tower_database_editable_districts'
+
+
+def _resolve(user):
+    if not user.is_active:
+        return frozenset()
+    if user.has_perm(f'{Tower._meta.app_label}.change_tower'):
+        return frozenset(Tower.Districts.values)
+    return frozenset(district for district, label in Tower.Districts.choices
+                     if user.has_perm(f'{Tower._meta.app_label}.admin_{label.lower()}'))
+
+
+def editable_districts(request):
+    """
+    Return the set of districts whose towers the current user can edit
+    """
+
+    if not hasattr(request, '_editable_districts'):
+        user = request.user
+        if not user.is_authenticated:
+            districts = frozenset()
+        else:
+            generation = get_generation(PERMISSIONS)
+            cached = request.session.get(SESSION_KEY)
+            if cached and cached[0] == generation:
+                districts = frozenset(cached[1])
+            else:
+                districts = _resolve(user)
+                request.session[SESSION_KEY] = [generation, sorted(districts)]
+        request._editable_districts = districts
+    return request._editable_districts
+
+
+def can_edit(request, district):
+    """
+    Can the current user edit towers (and their related data) in `district`?
+    """
+    return district in editable_districts(request)
+
+
+def _permissions_changed(action=None, update_fields=None, **kwargs):
+    if action is not None and not action.startswith('post_'):
+        return
+    # Logging in saves the user, but only to record when
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    transaction.on_commit(lambda: invalidate(PERMISSIONS))
+
+
+def connect_signals():
+    User = get_user_model()
+    for through in (User.groups.through, User.user_permissions.through, Group.permissions.through):
+        m2m_changed.connect(_permissions_changed, sender=through, dispatch_uid=f'permissions_{through.__name__}')
+    # Becoming (or ceasing to be) active or a superuser, and groups or
+    # permissions disappearing, change things too
+    for model in (User, Group, Permission):
+        post_save.connect(_permissions_changed, sender=model, dispatch_uid=f'permissions_save_{model.__name__}')
+        post_delete.connect(_permissions_changed, sender=model, dispatch_uid=f'permissions_delete_{model.__name__}')
@@ -0,0 +1,255 @@
+"""
+Practice nights.
+
+A tower's practice schedule is `practice_day` plus `practice_weeks` (the
+weeks of the month, possibly with 'not', or 'alternate'), which are
+boiled down on save to `practice_week_mask`: one bit per week of the
+month (the 1st to 5th occurrences of that weekday), plus a bit for
+'alternate'. Whether a tower practises on a given date is then just a
+comparison and a bit test, which the database can do with an index.
+
+The engine expands schedules into dated practices a month at a time -
+one query for every tower that practises at all - and caches each month
+against the ALL_TOWERS generation (see invalidation.py), so a range of
+dates is a handful of cache lookups however many towers there are.
+"""
+
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.lookups import GreaterThan
+
+from collections import namedtuple
+
+import calendar
+import datetime
+import re
+from zoneinfo import ZoneInfo
+
+from .invalidation import ALL_TOWERS, versioned_key
+
+
+# Practice times are local times
+TIME_ZONE = ZoneInfo('Europe/London')
+
+WEEKS = ['1st', '2nd', '3rd', '4th', '5th']
+ALL_WEEKS = (1 << len(WEEKS)) - 1
+# Alternate weeks, with no way of telling which
+ALTERNATE = 1 << len(WEEKS)
+
+# Times like '19:30' or '19:30-21:00' in the description of the practice
+TIME_PATTERN = re.compile(r'\b(\d\d):(\d\d)\b(?:\s*-\s*(\d\d):(\d\d)\b)?')
+
+# How long a practice with no end time is taken to last
+DEFAULT_LENGTH = datetime.timedelta(hours=2)
+
+# The details of a practising tower needed to show its practices
+PracticeTower = namedtuple('PracticeTower', ['id', 'name', 'district', 'bells', 'practice', 'travel_check',
+                                             'alternate', 'start', 'end', 'url'])
+
+# One tower's practice on one date
+Practice = namedtuple('Practice', ['date', 'tower'])
+
+
+def week_mask(practice_day, practice_weeks):
+    """
+    Return the practice_week_mask for a tower's `practice_day` and
+    `practice_weeks`, or None if it doesn't practise
+    """
+
+    if not practice_day:
+        return None
+    if 'alternate' in practice_weeks:
+        return ALL_WEEKS | ALTERNATE
+    mask = 0
+    for bit, week in enumerate(WEEKS):
+        if week in practice_weeks:
+            mask |= 1 << bit
+    if not mask:
+        return ALL_WEEKS
+    return ALL_WEEKS & ~mask if 'not' in practice_weeks else mask
+
+
+def week_of_month(date):
+    """
+    Which occurrence of its weekday in the month `date` is (0 for the 1st)
+    """
+    return (date.day - 1) // 7
+
+
+def practising_on(queryset, date):
+    """
+    Filter `queryset` (of towers) down to those with a practice on `date`
+    (including any that practise alternate weeks)
+    """
+    bit = 1 << week_of_month(date)
+    return queryset.filter(GreaterThan(F('practice_week_mask').bitand(bit), 0),
+                           practice_day=str(date.isoweekday()))
+
+
+def practice_times(practice):
+    """
+    Return the (start, end) times in the description of a practice, either
+    of which may be None
+    """
+
+    match = TIME_PATTERN.search(practice)
+    if not match:
+        return None, None
+    hour, minute, end_hour, end_minute = match.groups()
+    try:
+        start = datetime.time(int(hour), int(minute))
+        end = datetime.time(int(end_hour), int(end_minute)) if end_hour else None
+    except ValueError:
+        return None, None
+    return start, end
+
+
+def _practice_tower(tower):
+    start, end = practice_times(tower.practice)
+    return PracticeTower(tower.pk, tower.name, tower.district, tower.bells, tower.practice, tower.travel_check,
+                         bool(tower.practice_week_mask & ALTERNATE), start, end, tower.get_absolute_url())
+
+
+def _by_day():
+    # Every tower that practises, as (week mask, PracticeTower) by day of the week
+    from .models import Tower
+
+    towers = (Tower.objects.filter(practice_week_mask__gt=0).exclude(practice_day='')
+              .only('place', 'dedication', 'include_dedication', 'district', 'bells', 'practice',
+                    'travel_check', 'practice_day', 'practice_week_mask')
+              .order_by('place', 'dedication'))
+    by_day = {}
+    for tower in towers:
+        by_day.setdefault(int(tower.practice_day), []).append((tower.practice_week_mask, _practice_tower(tower)))
+    return by_day
+
+
+def _expand(year, month, by_day):
+    practices = []
+    for day in range(1, calendar.monthrange(year, month)[1] + 1):
+        date = datetime.date(year, month, day)
+        bit = 1 << week_of_month(date)
+        practices.extend(Practice(date, tower) for mask, tower in by_day.get(date.isoweekday(), []) if mask & bit)
+    return practices
+
+
+def months(months):
+    """
+    Return {(year, month): every practice in that month, in date then place
+    order} for each of `months`, reading the towers at most once
+    """
+
+    keys = {versioned_key(f'practices:{year}-{month:02}', ALL_TOWERS): (year, month) for year, month in months}
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        by_day = _by_day()
+        for key in missing:
+            found[key] = _expand(*keys[key], by_day)
+        cache.set_many({key: found[key] for key in missing}, None)
+    return {keys[key]: practices for key, practices in found.items()}
+
+
+def month(year, month):
+    """
+    Return every practice in the given month, in date then place order
+    """
+    return months([(year, month)])[year, month]
+
+
+def practices(start, end, district=None):
+    """
+    Return the practices from `start` to `end` (dates, inclusive), in date
+    then place order, optionally just those in `district`
+    """
+
+    wanted = []
+    year, m = start.year, start.month
+    while (year, m) <= (end.year, end.month):
+        wanted.append((year, m))
+        year, m = (year + 1, 1) if m == 12 else (year, m + 1)
+
+    by_month = months(wanted)
+    return [p for year_month in wanted for p in by_month[year_month]
+            if start <= p.date <= end and (district is None or p.tower.district == district)]
+
+
+def today():
+    return datetime.datetime.now(TIME_ZONE).date()
+
+
+# iCalendar (RFC 5545)
+
+def _ical_text(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _ical_line(line):
+    # Lines are folded at 75 octets, without splitting characters
+    encoded = line.encode('utf-8')
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        while cut and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+    parts.append(encoded)
+    return (b'\r\n '.join(parts) + b'\r\n').decode('utf-8')
+
+
+def _utc(date, time):
+    local = datetime.datetime.combine(date, time, tzinfo=TIME_ZONE)
+    return local.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def ical_event(practice, base_url, stamp):
+    """
+    Return the VEVENT for `practice`, with URLs made absolute with
+    `base_url` and DTSTAMP `stamp`
+    """
+
+    tower = practice.tower
+    lines = ['BEGIN:VEVENT',
+             f'UID:practice-{tower.id}-{practice.date:%Y%m%d}@{_ical_text(base_url.split("://")[-1])}',
+             f'DTSTAMP:{stamp}']
+    if tower.start:
+        lines.append(f'DTSTART:{_utc(practice.date, tower.start)}')
+        if tower.end and tower.end > tower.start:
+            lines.append(f'DTEND:{_utc(practice.date, tower.end)}')
+        else:
+            end = datetime.datetime.combine(practice.date, tower.start) + DEFAULT_LENGTH
+            lines.append(f'DTEND:{_utc(end.date(), end.time())}')
+    else:
+        lines.append(f'DTSTART;VALUE=DATE:{practice.date:%Y%m%d}')
+    summary = f'Practice: {tower.name}'
+    if tower.travel_check:
+        summary += ' (check before travelling)'
+    lines.append(f'SUMMARY:{_ical_text(summary)}')
+    if tower.practice:
+        lines.append(f'DESCRIPTION:{_ical_text(tower.practice)}')
+    lines.append(f'URL:{base_url}{tower.url}')
+    lines.append('END:VEVENT')
+    return ''.join(_ical_line(line) for line in lines)
+
+
+def iter_ical(practices, name, base_url):
+    """
+    Yield an iCalendar of `practices`, called `name`, a piece at a time.
+    Practices on alternate weeks are left out, as there's no knowing
+    which weeks they're on.
+    """
+
+    yield ''.join(_ical_line(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Ely Diocesan Association//Tower Database//EN',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_ical_text(name)}',
+    ])
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    for practice in practices:
+        if not practice.tower.alternate:
+            yield ical_event(practice, base_url, stamp)
+    yield _ical_line('END:VCALENDAR')
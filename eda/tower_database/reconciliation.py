@@ -0,0 +1,283 @@
+"""
+Reconciliation of the tower database against Dove's Guide.
+
+Each tower is compared with the Dove ring it's linked to (by
+dove_ringid) using the table of CHECKS below, plus the Diocese and
+Affiliation checks, which only look at the Dove side. All the Dove rings
+needed are fetched in one query up front.
+
+reconcile() can also work incrementally: given the results of a previous
+run (see load_state()/save_state()), it only re-checks the towers that
+simple_history says have changed since then, and those linked to Dove
+rings that have changed in any reloads of Dove since (see dove.py), and
+carries the rest over. If Dove has been reloaded without recording what
+changed, everything is checked again.
+"""
+
+from django.conf import settings
+from django.utils import timezone
+
+from collections import namedtuple
+from unidecode import unidecode
+from urllib.parse import urlparse
+
+import datetime
+import json
+import os
+import re
+import tempfile
+
+from .dove import changed_rings
+from .invalidation import DOVE, get_generation
+from .models import Tower, Dove
+
+
+# Where the results of the last run are kept, for incremental runs
+STATE_FILE = os.path.join(settings.SNAPSHOT_ROOT, 'reconciliation.json')
+
+
+# Our dedications rewritten into Dove's abbreviated style
+DEDICATION_SUBSTITUTIONS = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r'\bthe Great\b',                  'Gt'),
+    (r'\bMary Magdalene\b',             'Mary Magd'),
+    (r'\bMary the Virgin\b',            'Mary V'),
+    (r'\bMary the Blessed Virgin\b',    'Mary BV'),
+    (r'\bthe Baptist\b',                'Bapt'),
+    (r'\bthe Evangelist\b',             'Ev'),
+    (r'\bof the Blessed Virgin Mary\b', 'of BVM'),
+    (r' and the Holy Host of Heaven\b', ''),
+    (r'\bCathedral Church\b',           'Cath Ch'),
+    (r'\bthe English Martyrs\b',        'Eng Martyrs'),
+    (r'\bKing and Martyr\b',            'K&M'),
+    (r'\bof the Holy and Undivided\b',  'of Holy and Undivided'),
+    (r'^The ',                          ''),
+    (r'\bSt\b',                         'S'),
+    (r'\band\b',                        '&'),
+)]
+
+
+def dove_dedication(dedication):
+    """
+    Rewrite one of our dedications the way Dove would write it
+    """
+    dedication = unidecode(dedication)
+    for pattern, replacement in DEDICATION_SUBSTITUTIONS:
+        dedication = pattern.sub(replacement, dedication)
+    return dedication
+
+
+# Comparisons: each is given our value and Dove's
+
+def is_eq(eda, dove):
+    return str(eda) == str(dove)
+
+def is_county_eq(eda, dove):
+    return bool(dove) and eda == dove[0]
+
+def is_dedication_eq(eda, dove):
+    return dove_dedication(eda) == dove
+
+def is_status_believable(eda, dove):
+    if dove:
+        return eda == Tower.RingingStatus.NONE
+    return True
+
+def is_type_eq(eda, dove):
+    if eda == '' and dove == 'Full-circle ring':
+        return True
+    return eda == dove
+
+def is_bool_eq(eda, dove):
+    return bool(dove) == eda
+
+def web_page_eq(eda, dove):
+    eda_parsed = urlparse(eda)
+    dove_parsed = urlparse(dove)
+    if eda_parsed.hostname == 'dove.cccbr.org.uk':
+        return True
+    return (eda_parsed.netloc == dove_parsed.netloc and
+            eda_parsed.path == dove_parsed.path and
+            eda_parsed.query == dove_parsed.query)
+
+
+Check = namedtuple('Check', ['label', 'ours', 'theirs', 'compare'])
+
+CHECKS = [
+    Check('TowerID', 'dove_towerid', 'towerid', is_eq),
+    Check('Place', 'place', 'place', is_eq),
+    Check('County', 'county', 'county', is_county_eq),
+    Check('Dedication', 'dedication', 'dedicn', is_dedication_eq),
+    Check('Status', 'ringing_status', 'ur', is_status_believable),
+    Check('Bells', 'bells', 'bells', is_eq),
+    Check('Type', 'ring_type', 'ringtype', is_type_eq),
+    # Weight
+    #Check('Note', 'note', 'note', is_eq),
+    Check('GF', 'gf', 'gf', is_bool_eq),
+    Check('OSGrid', 'os_grid', 'ng', is_eq),
+    Check('Postcode', 'postcode', 'postcode', is_eq),
+    # Lat
+    # Lng
+    #Check('Website', 'website', 'webpage', web_page_eq),
+    Check('TowerbaseID', 'towerbase_id', 'towerbase', is_eq),
+]
+
+# The checks that aren't in the table
+OTHER_CHECKS = ['RingID', 'Diocese', 'Affiliation']
+
+LABELS = [check.label for check in CHECKS] + OTHER_CHECKS
+
+
+# One thing that doesn't match
+Discrepancy = namedtuple('Discrepancy', ['tower_id', 'tower', 'test', 'ours', 'theirs', 'message'])
+
+
+def check(tower, dove, tests=None):
+    """
+    Return a list of Discrepancies between `tower` and its Dove ring
+    `dove` (None if it couldn't be found), optionally only running the
+    `tests` named
+    """
+
+    def do_this(test):
+        return tests is None or test in tests
+
+    def discrepancy(test, ours, theirs, message):
+        return Discrepancy(tower.pk, f'{tower.place} {tower.dedication}', test, ours, theirs, message)
+
+    if dove is None:
+        return [discrepancy('RingID', tower.dove_ringid, None, f"'{tower.dove_ringid}' not found")]
+
+    errors = []
+    for label, us, them, compare in CHECKS:
+        if do_this(label):
+            ours, theirs = getattr(tower, us), getattr(dove, them)
+            if not compare(ours, theirs):
+                errors.append(discrepancy(label, ours, theirs, f"us: '{ours}', them: '{theirs}'"))
+
+    if do_this('Diocese'):
+        if 'Ely' not in (dove.diocese or '').split(';'):
+            errors.append(discrepancy('Diocese', None, dove.diocese,
+                                      f"'Ely' not found in Dove Diocese '{dove.diocese}'"))
+
+    # Dove normally only list Affiliation for Bells >= 4 and it only matters for
+    # Full-circle rings
+    if do_this('Affiliation'):
+        if ((dove.bells or 0) >= 4 and
+            dove.ringtype == 'Full-circle ring' and
+            'Ely Diocesan Association' not in (dove.affiliations or '').split(';')):
+            errors.append(discrepancy('Affiliation', None, dove.affiliations,
+                                      f"'Ely Diocesan Association' not found in Dove Affiliations :'{dove.affiliations}'"))
+
+    return errors
+
+
+class Result(namedtuple('Result', ['place', 'dedication', 'discrepancies'])):
+    """
+    The outcome for one tower
+    """
+
+    @property
+    def name(self):
+        return f'{self.place} {self.dedication}'
+
+
+def check_towers(towers, tests=None):
+    """
+    Return {tower pk: Result} for `towers`, fetching all their Dove rings
+    at once
+    """
+    towers = list(towers)
+    rings = Dove.objects.in_bulk({tower.dove_ringid for tower in towers})
+    return {tower.pk: Result(tower.place, tower.dedication, check(tower, rings.get(tower.dove_ringid), tests))
+            for tower in towers}
+
+
+def changed_since(since):
+    """
+    Return the pks of the towers simple_history has recorded changes to
+    (including creation and deletion) since `since`
+    """
+    return set(Tower.history.filter(history_date__gt=since).values_list('id', flat=True).distinct())
+
+
+class State(namedtuple('State', ['time', 'dove_generation', 'tests', 'results', 'checked'])):
+    """
+    The results of a run: when it started, the Dove generation it was
+    against, the tests run (None for all), {tower pk: Result} for every
+    tower, and how many towers were actually checked this time
+    """
+
+    def in_order(self):
+        return sorted(self.results.values(), key=lambda result: (result.place, result.dedication))
+
+    def discrepancies(self):
+        return [d for result in self.in_order() for d in result.discrepancies]
+
+    def as_json(self):
+        return {
+            'time': self.time.isoformat(),
+            'dove_generation': self.dove_generation,
+            'tests': self.tests,
+            'towers': len(self.results),
+            'checked': self.checked,
+            'discrepancies': [d._asdict() for d in self.discrepancies()],
+        }
+
+
+def reconcile(tests=None, previous=None):
+    """
+    Reconcile every tower against Dove, optionally only running the
+    `tests` named. If the `previous` State is given, and was for the same
+    tests, only the towers changed since, and those linked to Dove rings
+    that have changed since, are checked again. Returns a new State.
+    """
+
+    started = timezone.now()
+    generation = get_generation(DOVE)
+    tests = sorted(tests) if tests is not None else None
+
+    rings = changed_rings(previous.dove_generation, generation) if previous and previous.tests == tests else None
+    if rings is not None:
+        results = dict(previous.results)
+        changed = changed_since(previous.time)
+        if rings:
+            changed |= set(Tower.objects.filter(dove_ringid__in=rings).values_list('pk', flat=True))
+        for pk in changed:
+            results.pop(pk, None)
+        results.update(check_towers(Tower.objects.filter(pk__in=changed), tests))
+        checked = len(changed)
+    else:
+        results = check_towers(Tower.objects.all(), tests)
+        checked = len(results)
+
+    return State(started, generation, tests, results, checked)
+
+
+def load_state(path=STATE_FILE):
+    """
+    Return the State saved by the last run, or None
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        results = {int(pk): Result(place, dedication, [Discrepancy(**d) for d in discrepancies])
+                   for pk, (place, dedication, discrepancies) in data['results'].items()}
+        return State(datetime.datetime.fromisoformat(data['time']), data['dove_generation'], data['tests'], results, 0)
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_state(state, path=STATE_FILE):
+    data = {
+        'time': state.time.isoformat(),
+        'dove_generation': state.dove_generation,
+        'tests': state.tests,
+        'results': {pk: [result.place, result.dedication, [d._asdict() for d in result.discrepancies]]
+                    for pk, result in state.results.items()},
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to one side and renamed, so a reader never sees half of it
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
@@ -0,0 +1,150 @@
+"""
+Full-text search over towers.
+
+Towers are indexed in an SQLite FTS5 table (created by migration 0010),
+one row per tower with the tower's primary key as its rowid. The text is
+passed through unidecode first, as reconsile_with_dove does when
+comparing with Dove, so 'Ünïcode' is found by 'unicode' and vice versa;
+the usual abbreviations are indexed spelt out (and the other way round),
+so 'St' finds 'S' and 'great' finds 'Gt'. Every word searched for
+matches the start of a word, so partly typed words are found, and so
+'marys' can find 'St Mary' (and 'St Mary's') its final 's' is optional.
+
+The index is kept up to date by signal handlers (see connect_signals())
+whenever a tower is saved or deleted, in the same transaction.
+"""
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+from unidecode import unidecode
+
+import re
+
+
+TABLE = 'tower_database_search'
+
+# The indexed columns, what goes in each and how much a match in each counts
+COLUMNS = {
+    'place': (['place'], 10.0),
+    'dedication': (['dedication', 'full_dedication'], 5.0),
+    'nickname': (['nickname'], 5.0),
+    'notes': (['notes', 'long_notes'], 1.0),
+    'service': (['service'], 1.0),
+    'practice': (['practice'], 1.0),
+}
+
+# Words written both ways (dedications are often in Dove's abbreviated
+# style); whichever is used, the others are indexed too
+SYNONYMS = [
+    {'s', 'st', 'saint'},
+    {'ss', 'sts', 'saints'},
+    {'gt', 'great'},
+    {'lt', 'little'},
+    {'bapt', 'baptist'},
+    {'ev', 'evangelist'},
+    {'magd', 'magdalene', 'magdalen'},
+    {'v', 'virgin'},
+    {'cath', 'cathedral'},
+    {'ch', 'church'},
+]
+
+# The most results search() will return by default
+LIMIT = 50
+
+
+def normalise(text):
+    """
+    Fold `text` to the plain ASCII that's indexed and searched for
+    """
+    # "Mary's" is indexed (and searched for) as "Mary"
+    return re.sub(r"'s\b", '', unidecode(text or ''), flags=re.IGNORECASE)
+
+
+def _with_synonyms(text):
+    words = set(re.findall(r'\w+', text.lower()))
+    extra = set()
+    for group in SYNONYMS:
+        if words & group:
+            extra |= group
+    return ' '.join([text, *sorted(extra - words)])
+
+
+def _document(tower):
+    return [_with_synonyms(normalise(' '.join(getattr(tower, field) or '' for field in fields)))
+            for fields, _ in COLUMNS.values()]
+
+
+def index(*towers):
+    """
+    Add `towers` to the index, replacing whatever was there for them
+    """
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {TABLE} (rowid, {', '.join(COLUMNS)}) "
+            f"VALUES (%s{', %s' * len(COLUMNS)})",
+            [[tower.pk, *_document(tower)] for tower in towers])
+
+
+def unindex(*pks):
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [[pk] for pk in pks])
+
+
+def rebuild(towers):
+    """
+    Replace the whole index with one of `towers`
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+    index(*towers)
+
+
+def match_expression(query):
+    """
+    Turn what someone typed into an FTS5 query: every word has to match
+    the start of some word in the tower's text. Returns '' if there's
+    nothing to search for.
+    """
+    words = re.findall(r'\w+', normalise(query))
+    # (Short words like 'ss' are left alone)
+    words = [word[:-1] if len(word) > 3 and word[-1] in 'sS' else word for word in words]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search(query, limit=LIMIT):
+    """
+    Return the primary keys of the towers matching `query`, best first
+    (or all of them if `limit` is None)
+    """
+
+    expression = match_expression(query)
+    if not expression:
+        return []
+
+    weights = ', '.join(str(weight) for _, weight in COLUMNS.values())
+    sql = f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY bm25({TABLE}, {weights}), rowid"
+    params = [expression]
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [pk for pk, in cursor.fetchall()]
+
+
+def _tower_saved(instance, update_fields=None, **kwargs):
+    indexed = {field for fields, _ in COLUMNS.values() for field in fields}
+    if update_fields is None or indexed & set(update_fields):
+        index(instance)
+
+
+def _tower_deleted(instance, **kwargs):
+    unindex(instance.pk)
+
+
+def connect_signals():
+    from .models import Tower
+    post_save.connect(_tower_saved, sender=Tower, dispatch_uid='search_index_tower')
+    post_delete.connect(_tower_deleted, sender=Tower, dispatch_uid='search_index_tower')
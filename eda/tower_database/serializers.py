@@ -0,0 +1,186 @@
+from geojson import Point, Feature, dumps
+
+from .models import Tower, Contact, Website, Photo
+
+
+# How many towers to fetch (with their related objects) at a time, and
+# roughly how much text to yield at once, when streaming
+CHUNK_SIZE = 200
+BUFFER_SIZE = 64 * 1024
+
+
+# Optional related data, and the prefetch each needs
+INCLUDES = {
+    'contacts': 'contact_set',
+    'websites': 'website_set',
+    'photos': 'photo_set',
+}
+
+# Tower fields that are only kept to make queries quicker, worked out
+# from the others on save
+DERIVED = ['lat', 'lng', 'grid_cell', 'os_grid', 'practice_week_mask']
+
+OMIT = ['id', 'latlng', *DERIVED, 'maintainer_notes']
+
+
+def tower_properties():
+    """
+    Return the names of the (non-related) properties that tower_as_geojson()
+    can produce, in the order it produces them
+    """
+    return [f.name for f in Tower._meta.fields if f.name not in OMIT] + ['os_grid', 'url']
+
+
+def tower_columns(fields):
+    """
+    Return the Tower columns needed to produce `fields` (and the geometry)
+    """
+    columns = {'id', 'lat', 'lng'}
+    model_fields = {f.name for f in Tower._meta.fields}
+    columns.update(f for f in fields if f in model_fields)
+    return columns
+
+
+def tower_as_geojson(tower, fields=None, include=None):
+    """
+    Return a GeoJSON Feature for `tower`. By default this has every
+    property and all the tower's related data; `fields` and `include`
+    limit it to a subset of tower_properties() and INCLUDES respectively.
+    """
+
+    point = Point((float(tower.lng), float(tower.lat)))
+
+    if fields is None:
+        fields = tower_properties()
+    if include is None:
+        include = INCLUDES.keys()
+
+    properties = {}
+
+    # All (most) individual Tower fields
+    for  name in [f.name for f in Tower._meta.fields if f.name not in OMIT]:
+        if name in fields:
+            properties[name] = getattr(tower, name)
+    # OS Grid goes at the end, as it always has, and url isn't actually a field
+    if 'os_grid' in fields:
+        properties['os_grid'] = tower.os_grid
+    if 'url' in fields:
+        properties['url'] = tower.get_absolute_url()
+
+    if 'contacts' in include:
+        # Tower primary contact, if available and publishable
+        primary_c = {}
+        if tower.primary_contact and tower.primary_contact.publish:
+            for  name in [f.name for f in Contact._meta.fields if f.name != 'tower']:
+                primary_c[name] = getattr(tower.primary_contact, name)
+        properties['primary_contact'] = primary_c
+
+        # All other Tower contacts, if publishable
+        other_contacts = []
+        for contact in tower.other_contacts:
+            if contact.publish:
+                c = {}
+                for  name  in [f.name for f in Contact._meta.fields if f.name != 'tower']:
+                    c[name] = getattr(contact, name)
+                other_contacts.append(c)
+        properties['other_contacts'] = other_contacts
+
+    if 'websites' in include:
+        # All websites
+        websites = []
+        for website in tower.website_set.all():
+            w = {}
+            for  name in [f.name for f in Website._meta.fields if f.name != 'tower']:
+                w[name] = getattr(website, name)
+            websites.append(w)
+        properties['websites'] = websites
+
+    if 'photos' in include:
+        # All photos
+        photos = []
+        for photo in tower.photo_set.all():
+            p = {}
+            for  name in [f.name for f in Photo._meta.fields if f.name != 'tower']:
+                if name == 'image':
+                    p[name] = getattr(photo, name).url
+                else:
+                    p[name] = getattr(photo, name)
+            photos.append(p)
+        properties['photos'] = photos
+
+    return Feature(id=tower.id, geometry=point, properties=properties)
+
+
+def as_json(feature):
+    # Matches what geojson.dump() has always produced for us
+    return dumps(feature, ensure_ascii=True)
+
+
+def iter_feature_collection(towers, fields=None, include=None):
+    """
+    Yield a GeoJSON FeatureCollection of `towers` as text, a buffer at a
+    time, without ever holding more than one chunk of towers in memory.
+    The result is identical to serialising the whole FeatureCollection
+    in one go. `fields` and `include` are as for tower_as_geojson(), and
+    only the columns and related data they need are fetched.
+    """
+
+    if not towers.ordered:
+        towers = towers.order_by('pk')
+
+    if fields is not None:
+        towers = towers.only(*tower_columns(fields))
+    if include is None:
+        include = INCLUDES.keys()
+    prefetches = [INCLUDES[i] for i in include]
+    if prefetches:
+        towers = towers.prefetch_related(*prefetches)
+
+    buffer = ['{"type": "FeatureCollection", "features": [']
+    size = 0
+    separator = ''
+    for tower in towers.iterator(chunk_size=CHUNK_SIZE):
+        feature = separator + as_json(tower_as_geojson(tower, fields, include))
+        separator = ', '
+        buffer.append(feature)
+        size += len(feature)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(']}')
+    yield ''.join(buffer)
+
+
+# Per-tower columns in the marker feed, and whether each holds strings
+MARKER_COLUMNS = [
+    ('id', False),
+    ('lat', False),
+    ('lng', False),
+    ('place', True),
+    ('dedication', True),
+    ('include_dedication', False),
+    ('district', True),
+    ('bells', False),
+    ('ringing_status', True),
+]
+
+
+def markers_as_json(towers):
+    """
+    Return just what the map needs to draw a marker for each of `towers`
+    as compact JSON: one array per column, with every string replaced by
+    its index in a shared 'strings' array
+    """
+
+    strings = {}
+    columns = {name: [] for name, is_string in MARKER_COLUMNS}
+    for row in towers.exclude(lat=None).values_list(*[name for name, is_string in MARKER_COLUMNS]):
+        for (name, is_string), value in zip(MARKER_COLUMNS, row):
+            if is_string:
+                value = strings.setdefault(value, len(strings))
+            elif isinstance(value, bool):
+                value = int(value)
+            columns[name].append(value)
+
+    return dumps({'strings': list(strings), **columns}, ensure_ascii=True, separators=(',', ':'))
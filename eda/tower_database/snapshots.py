@@ -0,0 +1,140 @@
+"""
+Pre-built GeoJSON documents, stored on disk and served as static bytes.
+
+The all-towers, per-district and per-tower GeoJSON documents are
+serialised the first time they're asked for after the data they depend
+on changes, and written to files named after the current generation of
+that data (see invalidation.py). Serving one is then just a matter of
+working out the current file name and streaming it - no ORM work on the
+request path.
+"""
+
+from django.conf import settings
+
+import glob
+import os
+import tempfile
+
+from .invalidation import ALL_TOWERS, tower_key, district_key, get_generation
+from .models import Tower
+from .serializers import as_json, iter_feature_collection, tower_as_geojson
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+GEOJSON_DIR = os.path.join(settings.SNAPSHOT_ROOT, 'geojson')
+
+
+def _scope(towerid=None, district=None):
+    """
+    Return the document name and the generation key that it depends on
+    """
+    if towerid:
+        return f'tower-{towerid}', tower_key(towerid)
+    elif district:
+        return f'district-{district}', district_key(district)
+    else:
+        return 'towers', ALL_TOWERS
+
+
+def filename(towerid=None, district=None):
+    name, dependency = _scope(towerid, district)
+    return f'{name}.geojson'
+
+
+def _path(name, generation):
+    return os.path.join(GEOJSON_DIR, f'{name}.{generation}.geojson')
+
+
+def _chunks(towerid=None, district=None):
+
+    if towerid:
+        yield as_json(tower_as_geojson(Tower.objects.get(pk=towerid)))
+    else:
+        towers = Tower.objects.all()
+        if district:
+            towers = towers.filter(district=district)
+        yield from iter_feature_collection(towers)
+
+
+def _write(name, path, chunks):
+    """
+    Write `chunks` to `path`, yielding each one as it goes. The file only
+    appears (and older versions are only removed) once it's complete.
+    """
+
+    logger.info(f'Building GeoJSON snapshot {os.path.basename(path)}')
+
+    # Write to a temporary file and rename so readers never see a partial file
+    os.makedirs(GEOJSON_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=GEOJSON_DIR, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    prune(name, keep=path)
+
+
+def _current_path(towerid=None, district=None):
+    name, dependency = _scope(towerid, district)
+    # Read the generation *before* the data so that a concurrent change
+    # can only ever leave newer data under an older name, never the reverse
+    return name, _path(name, get_generation(dependency))
+
+
+def build(towerid=None, district=None):
+    """
+    Write the current version of a document to disk, remove any older
+    versions, and return its path. Raises Tower.DoesNotExist for an
+    unknown tower.
+    """
+
+    name, path = _current_path(towerid, district)
+    for chunk in _write(name, path, _chunks(towerid, district)):
+        pass
+    return path
+
+
+def prune(name, keep=None):
+    for old in glob.glob(_path(glob.escape(name), '*')):
+        if old != keep:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+
+
+def current(towerid=None, district=None):
+    """
+    Return the path to the current version of a document, building it if necessary
+    """
+
+    name, path = _current_path(towerid, district)
+
+    if not os.path.exists(path):
+        path = build(towerid, district)
+
+    return path
+
+
+def current_or_stream(towerid=None, district=None):
+    """
+    Return (path, None) if the current version of a document is already
+    on disk, otherwise (None, chunks) where iterating over `chunks` yields
+    the document while writing it to disk
+    """
+
+    name, path = _current_path(towerid, district)
+
+    if os.path.exists(path):
+        return path, None
+
+    return None, _write(name, path, _chunks(towerid, district))
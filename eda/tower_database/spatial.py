@@ -0,0 +1,80 @@
+"""
+A simple spatial index for towers.
+
+The world is divided into a grid of CELL_SIZE degree cells, numbered row
+by row from the south-west corner. Every tower stores the number of the
+cell it's in (Tower.grid_cell, which is indexed), so the towers in a
+bounding box can be found with one index range per row of cells that
+the box covers, and then checked exactly against Tower.lat and Tower.lng.
+"""
+
+from django.db.models import Q
+
+import math
+
+
+CELL_SIZE = 0.1
+ROWS = round(180 / CELL_SIZE)
+COLUMNS = round(360 / CELL_SIZE)
+
+# Beyond this many rows, just scan from the first cell to the last -
+# fewer, bigger index ranges are cheaper than a huge OR
+MAX_RANGES = 50
+
+
+def _row(lat):
+    return min(max(math.floor((lat + 90) / CELL_SIZE), 0), ROWS - 1)
+
+
+def _column(lng):
+    return min(max(math.floor((lng + 180) / CELL_SIZE), 0), COLUMNS - 1)
+
+
+def grid_cell(lat, lng):
+    """
+    Return the number of the cell containing (`lat`, `lng`)
+    """
+    return _row(lat) * COLUMNS + _column(lng)
+
+
+def parse_bbox(value):
+    """
+    Parse 'minlng,minlat,maxlng,maxlat' into a tuple of floats, raising
+    ValueError if it isn't one
+    """
+
+    try:
+        minlng, minlat, maxlng, maxlat = [float(v) for v in value.split(',')]
+    except ValueError:
+        raise ValueError("expected 'minlng,minlat,maxlng,maxlat'")
+    if not (-180 <= minlng <= maxlng <= 180 and -90 <= minlat <= maxlat <= 90):
+        raise ValueError("bounds out of range or in the wrong order")
+    return minlng, minlat, maxlng, maxlat
+
+
+def cell_ranges(bbox):
+    """
+    Return a list of (first, last) cell numbers that between them cover `bbox`
+    """
+
+    minlng, minlat, maxlng, maxlat = bbox
+    first_row, last_row = _row(minlat), _row(maxlat)
+    first_column, last_column = _column(minlng), _column(maxlng)
+
+    if last_row - first_row + 1 > MAX_RANGES:
+        return [(first_row * COLUMNS + first_column, last_row * COLUMNS + last_column)]
+
+    return [(row * COLUMNS + first_column, row * COLUMNS + last_column)
+            for row in range(first_row, last_row + 1)]
+
+
+def bbox_q(bbox):
+    """
+    Return a Q object selecting the towers in `bbox`
+    """
+
+    minlng, minlat, maxlng, maxlat = bbox
+    cells = Q()
+    for first, last in cell_ranges(bbox):
+        cells |= Q(grid_cell__range=(first, last))
+    return cells & Q(lat__range=(minlat, maxlat), lng__range=(minlng, maxlng))
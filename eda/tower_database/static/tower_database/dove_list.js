@@ -0,0 +1,36 @@
+/* Setup datatables for browsing Dove - far too big to send whole, so it's
+   fetched from the server a page at a time */
+
+"use strict";
+
+const data = document.currentScript.dataset;
+const table_id = data.table_id;
+const columns = ['place', 'dedicn', 'county', 'country', 'bells', 'ringtype'];
+
+// Build a datables config structure
+var dt_options = {
+    serverSide: true,
+    processing: true,
+    ajax: window.location.pathname,
+    columns: columns.map((name) => ({ data: name })),
+    pageLength: 25,
+	// Enable searchPanes for filtering
+    layout: {
+        topStart: {
+            buttons: ['searchPanes'],
+        }
+    },
+    columnDefs: [
+    	// The server only offers panes for the columns with a few distinct values
+        {
+            targets: [0, 1],
+            searchPanes: {
+                show: false
+            },
+        },
+    ]
+};
+
+$(document).ready( function () {
+        $(`#${table_id}`).DataTable(dt_options);
+});
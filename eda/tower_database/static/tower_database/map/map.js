@@ -28,7 +28,6 @@ const overlays = {
     {
         name: 'Parishes',
         show: false,
-        file: 'Parishes.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'parish_boundary',
@@ -50,7 +49,6 @@ const overlays = {
     {
         name: 'Deaneries',
         show: false,
-        file: 'Deaneries.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'parish_boundary',
@@ -71,7 +69,6 @@ const overlays = {
     {
         name: 'Benifices',
         show: false,
-        file: 'Benifices.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'benifice_boundary',
@@ -93,7 +90,6 @@ const overlays = {
     {
         name: 'Counties',
         show: false,
-        file: 'BoundaryCeremonial.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'county_boundary',
@@ -112,7 +108,6 @@ const overlays = {
     {
         name: 'Association',
         show: true,
-        file: 'Association.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'association_boundary',
@@ -132,7 +127,6 @@ const overlays = {
     {
         name: 'Districts',
         show: true,
-        file: 'Districts.geojson',
         layer: L.geoJSON(null,
             {
                 pane: 'association_boundary',
@@ -357,18 +351,22 @@ function filter_towers() {
     hidden_tower_layer.eachLayer(toggle_display, context);
 
     if (document.getElementById('parish').checked) {
+        load_overlay('parishes');
+        load_overlay('deaneries');
         parishes_fg.addTo(map);
     } else {
         parishes_fg.removeFrom(map);
     }
 
     if (document.getElementById('benifice').checked) {
+        load_overlay('benifices');
         overlays.benifices.layer.addTo(map);
     } else {
         overlays.benifices.layer.removeFrom(map);
     }
 
     if (document.getElementById('county').checked) {
+        load_overlay('counties');
         overlays.counties.layer.addTo(map);
     } else {
         overlays.counties.layer.removeFrom(map);
@@ -537,29 +535,156 @@ function set_bounds(name, overlay) {
 
 }
 
-function load_boundary_data() {
+function topology_as_geojson(topology) {
 
-    for (let [name, overlay] of Object.entries(overlays)) {
+    // Decode the (quantized, delta-encoded) TopoJSON that the server sends
+    // for boundary overlays. Every object is a collection of MultiPolygons
 
-        var url = `${map_config.static_root}/${overlay.file}`
+    var scale = topology.transform.scale;
+    var translate = topology.transform.translate;
+
+    var arcs = topology.arcs.map(function (arc) {
+        var x = 0;
+        var y = 0;
+        return arc.map(function (delta) {
+            x += delta[0];
+            y += delta[1];
+            return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+        });
+    });
 
-        $.ajax({url: url, dataType: 'json'}
-        ).done(
-            function (data) {
-                overlay.layer.addData(data);
-                if (overlay.add_to) {
-                    overlay.layer.addTo(overlay.add_to);
+    function ring(references) {
+        var points = [];
+        references.forEach(function (reference) {
+            var arc = reference < 0 ? arcs[~reference].slice().reverse() : arcs[reference];
+            // Consecutive arcs share their end points
+            points = points.concat(points.length ? arc.slice(1) : arc);
+        });
+        return points;
+    }
+
+    var features = [];
+    Object.values(topology.objects).forEach(function (object) {
+        object.geometries.forEach(function (geometry) {
+            features.push({
+                type: 'Feature',
+                properties: geometry.properties,
+                geometry: {
+                    type: 'MultiPolygon',
+                    coordinates: geometry.arcs.map(function (polygon) { return polygon.map(ring); })
                 }
+            });
+        });
+    });
+
+    return { type: 'FeatureCollection', features: features };
+
+}
+
+function zoom_band() {
+
+    // The lowest zoom of the band containing the map's zoom (or of the
+    // first band if the map hasn't been positioned yet)
+
+    var zoom = map.getZoom() || 0;
+    var band = map_config.boundary_bands[0];
+    for (var i = 0; i < map_config.boundary_bands.length; i++) {
+        if (zoom >= map_config.boundary_bands[i]) {
+            band = map_config.boundary_bands[i];
+        }
+    }
+    return band;
+
+}
+
+function load_overlay(name) {
+
+    // Load (or reload) an overlay at the right level of detail for the
+    // current zoom, unless it's already got it
+
+    var overlay = overlays[name];
+    var band = zoom_band();
+
+    if (overlay.band === band) {
+        return;
+    }
+    overlay.band = band;
+
+    $.ajax({url: map_config.boundaries[name], data: {zoom: band}, dataType: 'json'}
+    ).done(
+        function (data) {
+            // Ignore anything overtaken by a later zoom
+            if (overlay.band !== band) {
+                return;
+            }
+            var first = !overlay.loaded;
+            overlay.loaded = true;
+            overlay.layer.clearLayers();
+            overlay.layer.addData(topology_as_geojson(data));
+            if (overlay.add_to) {
+                overlay.layer.addTo(overlay.add_to);
+            }
+            if (first) {
                 set_bounds(name, overlay);
             }
-        ).fail(
-            function (ignore, ignore1, error_thrown) {
-                alert('Loading boudary data failed - see Javascript console for details');
+        }
+    ).fail(
+        function (ignore, ignore1, error_thrown) {
+            overlay.band = undefined;
+            alert('Loading boudary data failed - see Javascript console for details');
+        }
+    );
+
+}
+
+function load_boundary_data() {
+
+    // Only load the overlays that are shown to start with - the rest
+    // wait until they're turned on
+
+    for (let [name, overlay] of Object.entries(overlays)) {
+        if (overlay.show) {
+            load_overlay(name);
+        }
+    }
+
+    // Swap in more (or less) detail for whatever's showing as the zoom changes
+    map.on('zoomend', function () {
+        for (let [name, overlay] of Object.entries(overlays)) {
+            if (overlay.band !== undefined && map.hasLayer(overlay.layer)) {
+                load_overlay(name);
             }
-        );
+        }
+    });
+
+}
 
+function markers_as_geojson(markers) {
+
+    // Turn the server's columnar marker feed (parallel arrays, with strings
+    // replaced by indexes into markers.strings) into minimal GeoJSON
+
+    var strings = markers.strings;
+    var features = [];
+
+    for (var i = 0; i < markers.id.length; i++) {
+        features.push({
+            type: 'Feature',
+            id: markers.id[i],
+            geometry: { type: 'Point', coordinates: [markers.lng[i], markers.lat[i]] },
+            properties: {
+                place: strings[markers.place[i]],
+                dedication: strings[markers.dedication[i]],
+                include_dedication: markers.include_dedication[i] === 1,
+                district: strings[markers.district[i]],
+                bells: markers.bells[i],
+                ringing_status: strings[markers.ringing_status[i]]
+            }
+        });
     }
 
+    return { type: 'FeatureCollection', features: features };
+
 }
 
 function load_tower_data(map) {
@@ -605,22 +730,40 @@ function load_tower_data(map) {
     }
 
     function add_popup(feature, layer) {
-        layer.bindPopup(tower_as_text(feature)).getPopup();
+        layer.bindPopup('Loading...').getPopup();
         var popup = layer.getPopup();
         if (map_config.towerid && map_config.towerid === feature.id) {
             layer.setZIndexOffset(1000);
             popup.options.autoClose = false;
             popup.options.closeOnClick = false;
         }
+        // The markers only know enough to draw themselves - fetch the
+        // rest of the tower's details the first time its popup opens
+        layer.on('popupopen', function () {
+            if (layer.tower_loaded) {
+                return;
+            }
+            $.ajax({url: map_config.tower_json.replace('{id}', feature.id), dataType: 'json'}
+            ).done(
+                function (data) {
+                    layer.tower_loaded = true;
+                    layer.setPopupContent(tower_as_text(data));
+                }
+            ).fail(
+                function (ignore, ignore1, error_thrown) {
+                    layer.setPopupContent('Loading tower details failed');
+                }
+            );
+        });
     }
 
-    var url = map_config.towers_json;
+    var url = map_config.markers_json;
 
     $.ajax({url: url, dataType: 'json'}
     ).done(
         function (data) {
             hidden_tower_layer = L.geoJSON(
-                data,
+                markers_as_geojson(data),
                 {   pane: 'towers',
                     pointToLayer: create_marker,
                     onEachFeature: add_popup
@@ -5,6 +5,9 @@
 // Get what to group by - only 'district' and 'bells' supported
 const data = document.currentScript.dataset;
 const table_id = data.table_id;
+// Big tables are fetched from the server a page at a time
+const server_side = data.server_side == 'True';
+const columns = ['practice_day', 'day', 'place', 'bells', 'district', 'map'];
 
 // Build a datables config structure
 var dt_options = {
@@ -39,6 +42,22 @@ var dt_options = {
     ]
 };
 
+if (server_side) {
+    dt_options['paging'] = true;
+    dt_options['serverSide'] = true;
+    dt_options['processing'] = true;
+    dt_options['ajax'] = window.location.pathname;
+    dt_options['columns'] = columns.map((name) => ({ data: name }));
+    dt_options['rowGroup'] = { dataSrc: 'day' };
+    // The server only offers panes for the columns with a few distinct values
+    dt_options['columnDefs'].push({
+        target: 2,
+        searchPanes: {
+            show: false
+        },
+    });
+};
+
 $(document).ready( function () {
         $(`#${table_id}`).DataTable(dt_options);
 });
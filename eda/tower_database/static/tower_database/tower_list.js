@@ -6,6 +6,9 @@
 const data = document.currentScript.dataset;
 const group_by = data.group_by;
 const table_id = data.table_id;
+// Big tables are fetched from the server a page at a time
+const server_side = data.server_side == 'True';
+const columns = ['place', 'dedication', 'bells', 'ringing_status', 'district', 'map'];
 
 var column = null;
 var direction = null;
@@ -64,6 +67,24 @@ if (column) {
     })
 };
 
+if (server_side) {
+    dt_options['paging'] = true;
+    dt_options['serverSide'] = true;
+    dt_options['processing'] = true;
+    dt_options['ajax'] = window.location.pathname;
+    dt_options['columns'] = columns.map((name) => ({ data: name }));
+    if (column) {
+        dt_options['rowGroup'] = { dataSrc: columns[column] };
+    }
+    // The server only offers panes for the columns with a few distinct values
+    dt_options['columnDefs'].push({
+        target: 0,
+        searchPanes: {
+            show: false
+        },
+    });
+};
+
 $(document).ready( function () {
         $(`#${table_id}`).DataTable(dt_options);
 });
@@ -1,3 +1,1112 @@
-from django.test import TestCase
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django import forms
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+from geojson import FeatureCollection
+from OSGridConverter import latlong2grid
+from PIL import Image
+
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import logging
+import os
+import tempfile
+from unittest import mock
+
+from . import autocomplete, boundaries, dove, invalidation, matching, models, nearest, osgrid, practice, reconciliation, search, serializers, snapshots, spatial, views
+from .models import Tower, Dove, Generation
+from .serializers import as_json, tower_as_geojson
+
+
+def png():
+    image = io.BytesIO()
+    Image.new('RGB', (40, 30)).save(image, 'PNG')
+    return SimpleUploadedFile('photo.png', image.getvalue(), content_type='image/png')
+
+
+class TempFilesMixin:
+    """
+    Keep a TestCase's generation bus, snapshots, boundary overlays and
+    uploaded files out of the real directories, and have each test start
+    with no generations seen (as the last test's data is rolled back)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        tmp = cls.enterClassContext(tempfile.TemporaryDirectory())
+        cls.enterClassContext(mock.patch.object(invalidation, 'BUS_FILE', os.path.join(tmp, 'generations')))
+        cls.enterClassContext(mock.patch.object(snapshots, 'GEOJSON_DIR', os.path.join(tmp, 'geojson')))
+        cls.enterClassContext(mock.patch.object(boundaries, 'BOUNDARY_DIR', os.path.join(tmp, 'boundaries')))
+        cls.enterClassContext(mock.patch.object(dove, 'SNAPSHOT_DIR', os.path.join(tmp, 'dove')))
+        cls.enterClassContext(override_settings(MEDIA_ROOT=os.path.join(tmp, 'media')))
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.multiple(invalidation, _generations={}, _bus_state=None))
+
+
+class DoveTableMixin:
+    """
+    Create the (unmanaged, so normally missing) Dove table for a TestCase
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Before the class's transaction starts, as SQLite needs
+        with connection.schema_editor() as editor:
+            editor.create_model(Dove)
+        cls.addClassCleanup(cls._drop_dove)
+        super().setUpClass()
+
+    @classmethod
+    def _drop_dove(cls):
+        with connection.schema_editor() as editor:
+            editor.delete_model(Dove)
+
+
+class OSGridTests(SimpleTestCase):
+    """
+    The batch OS grid converter against OSGridConverter, one point at a time
+    """
+
+    # Across Great Britain and a little beyond, where there are no letters
+    POINTS = ([(49.9 + i * 0.37, -7.9 + j * 0.33) for i in range(30) for j in range(30)] +
+              [(52.2031, 0.1184), (52.5402, 0.0914), (60.8, -0.8), (49.0, -2.0), (48.0, 5.0), (62.0, -12.0)])
+
+    def test_batch_matches_scalar(self):
+        lats, lngs = [lat for lat, _ in self.POINTS], [lng for _, lng in self.POINTS]
+        eastings, northings = osgrid.eastings_northings(lats, lngs)
+        references = osgrid.grid_references(lats, lngs, figures=10)
+        # OSGridConverter logs an error and prints a traceback for every point off the grid
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+            expected = [latlong2grid(lat, lng) for lat, lng in self.POINTS]
+            expected = [(grid.E, grid.N, str(grid).replace(' ', '')) for grid in expected]
+        for point, want, easting, northing, reference in zip(
+                self.POINTS, expected, eastings.tolist(), northings.tolist(), references):
+            with self.subTest(point=point):
+                self.assertEqual((easting, northing, reference), want)
+                self.assertEqual(osgrid.grid_reference(*point), reference[:5] + reference[7:10] if reference else '')
+
+    def test_grid_reference(self):
+        self.assertEqual(osgrid.grid_reference(52.2031, 0.1184), 'TL448582')
+        self.assertEqual(osgrid.grid_reference(52.2031, 0.1184, figures=4), 'TL4458')
+        self.assertEqual(osgrid.grid_references([52.2031, float('nan'), 10.0], [0.1184, 0.0, 0.0]),
+                         ['TL448582', '', ''])
+
+
+class InvalidationTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Saving something bumps the generations of just what depends on it
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cambridge = Tower.objects.create(place='Cambridge', dedication='St Bene\'t', district='C', latlng='52.2,0.1')
+        cls.ely = Tower.objects.create(place='Ely', dedication='Cathedral', district='E', latlng='52.4,0.26')
+
+    KEYS = [invalidation.ALL_TOWERS, invalidation.DOVE,
+            invalidation.district_key('C'), invalidation.district_key('E'), invalidation.district_key('W')]
+
+    def changed(self, change):
+        """
+        Return the keys whose generation goes up when `change` is called and committed
+        """
+        keys = self.KEYS + [invalidation.tower_key(self.cambridge.pk), invalidation.tower_key(self.ely.pk)]
+        before = invalidation.get_generations(*keys)
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        after = invalidation.get_generations(*keys)
+        for key in keys:
+            self.assertGreaterEqual(after[key], before[key])
+        return {key for key in keys if after[key] != before[key]}
+
+    def test_tower(self):
+        self.assertEqual(self.changed(self.cambridge.save), {
+            invalidation.ALL_TOWERS, invalidation.tower_key(self.cambridge.pk), invalidation.district_key('C')})
+
+    def test_related(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            contact = self.ely.contact_set.create(role='C', name='Person')
+        self.assertEqual(self.changed(contact.delete), {
+            invalidation.ALL_TOWERS, invalidation.tower_key(self.ely.pk), invalidation.district_key('E')})
+
+    def test_move(self):
+        # Both the district it's left and the one it's joined
+        def move():
+            self.cambridge.district = 'W'
+            self.cambridge.save()
+        self.assertEqual(self.changed(move), {
+            invalidation.ALL_TOWERS, invalidation.tower_key(self.cambridge.pk),
+            invalidation.district_key('C'), invalidation.district_key('W')})
+
+    def test_rolled_back(self):
+        def fail():
+            with transaction.atomic():
+                self.cambridge.save()
+                transaction.set_rollback(True)
+        self.assertEqual(self.changed(fail), set())
+
+    def test_versioned_key(self):
+        key = invalidation.versioned_key('page', invalidation.tower_key(self.cambridge.pk))
+        self.changed(self.ely.save)
+        self.assertEqual(invalidation.versioned_key('page', invalidation.tower_key(self.cambridge.pk)), key)
+        self.changed(self.cambridge.save)
+        self.assertNotEqual(invalidation.versioned_key('page', invalidation.tower_key(self.cambridge.pk)), key)
+
+
+    def test_batched(self):
+        # Saving a tower with its contacts and websites bumps each generation
+        # once, when it commits - and leaves the snapshots until they're next wanted
+        with self.captureOnCommitCallbacks(execute=True):
+            contact = self.cambridge.contact_set.create(role='C', name='Person')
+            website = self.cambridge.website_set.create(url='https://example.com/')
+        with mock.patch.object(models, 'invalidate') as invalidate, \
+                mock.patch.object(snapshots, 'build') as build:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks, \
+                    transaction.atomic(), models.batched_invalidation():
+                self.cambridge.save()
+                contact.save()
+                website.save()
+                invalidate.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        invalidate.assert_called_once_with(
+            invalidation.ALL_TOWERS, invalidation.tower_key(self.cambridge.pk), invalidation.district_key('C'))
+        build.assert_not_called()
+
+    def test_admin_change(self):
+        # Which the admin does for a tower and all its inlines
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cambridge.contact_set.create(role='C', name='Person')
+            self.cambridge.website_set.create(url='https://example.com/')
+        self.client.force_login(get_user_model().objects.create_superuser(email='admin@example.com', password='password'))
+        url = reverse('admin:tower_database_tower_change', args=[self.cambridge.pk])
+        data = self.form_data(self.client.get(url))
+        # The model's default county isn't one of its choices
+        data['county'] = Tower.Counties.CAMBRIDGESHIRE
+        data['contact_set-0-name'] = 'Someone else'
+        data['website_set-0-url'] = 'https://example.net/'
+        with mock.patch.object(models, 'invalidate') as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.cambridge.contact_set.filter(name='Someone else').exists())
+        invalidate.assert_called_once_with(
+            invalidation.ALL_TOWERS, invalidation.tower_key(self.cambridge.pk), invalidation.district_key('C'))
+
+    @staticmethod
+    def form_data(response):
+        """
+        Return the POST data for submitting an admin change form unaltered
+        """
+        shown = [response.context['adminform'].form]
+        data = {}
+        for inline in response.context['inline_admin_formsets']:
+            management = inline.formset.management_form
+            data.update({management.add_prefix(name): value for name, value in management.initial.items()})
+            shown += inline.formset.initial_forms
+        for form in shown:
+            for name, field in form.fields.items():
+                value = form[name].value()
+                # Files already uploaded are kept if nothing new is sent
+                if value is None or value is False or isinstance(field, forms.FileField):
+                    continue
+                data[form.add_prefix(name)] = value
+        return data
+
+class GeoJSONTests(TempFilesMixin, TestCase):
+    """
+    The tower GeoJSON, from snapshots or built to order
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.march = Tower.objects.create(
+            place='March', dedication='St Wendreda', district='W', bells=6, ringing_status='R',
+            practice_day='3', practice='Wednesday', postcode='PE15 9JS', latlng='52.5402,0.0914')
+        cls.march.contact_set.create(role='C', primary=True, name='Ringer', publish=True)
+        cls.march.website_set.create(url='https://example.com/march')
+        cls.ely = Tower.objects.create(
+            place='Ely', dedication='Cathedral Church of the Holy and Undivided Trinity', district='E', bells=10,
+            ringing_status='R', latlng='52.3986,0.2638')
+        cls.cambridge = Tower.objects.create(
+            place='Cambridge', dedication='St Bene’t', district='C', bells=6, ringing_status='N',
+            latlng='52.2031,0.1184')
+
+    def get(self, name, kwargs=None, data=None):
+        response = self.client.get(reverse(name, kwargs=kwargs), data)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_snapshots(self):
+        # Byte for byte what serialising the whole thing in one go gives, whether
+        # streamed while the snapshot's built or served from it afterwards
+        collections = [
+            ('towers_geojson', None, Tower.objects.all()),
+            ('district_geojson', {'district': 'C'}, Tower.objects.filter(district='C')),
+        ]
+        for name, kwargs, towers in collections:
+            expected = as_json(FeatureCollection([tower_as_geojson(t) for t in towers])).encode()
+            for attempt in ('built', 'served'):
+                with self.subTest(name=name, kwargs=kwargs, attempt=attempt):
+                    response, content = self.get(name, kwargs)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(content, expected)
+        response, content = self.get('tower_geojson', {'towerid': self.ely.pk})
+        self.assertEqual(content, as_json(tower_as_geojson(Tower.objects.get(pk=self.ely.pk))).encode())
+
+    def test_chunked(self):
+        # However it's split up
+        with mock.patch.object(serializers, 'BUFFER_SIZE', 1), mock.patch.object(serializers, 'CHUNK_SIZE', 2):
+            chunks = list(serializers.iter_feature_collection(Tower.objects.all()))
+        self.assertGreater(len(chunks), 2)
+        expected = as_json(FeatureCollection([tower_as_geojson(t) for t in Tower.objects.all()]))
+        self.assertEqual(''.join(chunks), expected)
+
+    def test_conditional(self):
+        # Data that's never changed has no time, so give it one
+        with self.captureOnCommitCallbacks(execute=True):
+            self.march.save()
+        response, content = self.get('district_geojson', {'district': 'W'})
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        url = reverse('district_geojson', kwargs={'district': 'W'})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        # Other districts' changes make no difference
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ely.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # But its own do
+        with self.captureOnCommitCallbacks(execute=True):
+            self.march.save()
+        response, content = self.get('district_geojson', {'district': 'W'})
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_unknown_tower(self):
+        # Looking generations up never writes, whatever's asked for
+        generations = Generation.objects.count()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('tower_geojson', kwargs={'towerid': 99999}))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(invalidation.get_generation(invalidation.tower_key(99998)), 0)
+        self.assertEqual(Generation.objects.count(), generations)
+
+    def features(self, name='towers_geojson', kwargs=None, **data):
+        response, content = self.get(name, kwargs, data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(content)['features']
+
+    def places(self, name='towers_geojson', kwargs=None, **data):
+        return {feature['properties']['place'] for feature in self.features(name, kwargs, **data)}
+
+    def test_filters(self):
+        self.assertEqual(self.places(bells__gte=7), {'Ely'})
+        self.assertEqual(self.places(bells__lte=6), {'March', 'Cambridge'})
+        self.assertEqual(self.places(bells=6, ringing_status='R'), {'March'})
+        self.assertEqual(self.places(ringing_status='N,O'), {'Cambridge'})
+        self.assertEqual(self.places(practice_day='3'), {'March'})
+        self.assertEqual(self.places('district_geojson', {'district': 'C'}, bells=6), {'Cambridge'})
+        self.assertEqual(self.places('district_geojson', {'district': 'W'}, bells=10), set())
+
+    def test_fields(self):
+        feature, = self.features(fields='bells,place,url', bells__gte=10)
+        # In the usual order, and no related data unless it's asked for
+        self.assertEqual(list(feature['properties']), ['place', 'bells', 'url'])
+        self.assertEqual(feature['geometry']['coordinates'], [0.2638, 52.3986])
+        feature, = self.features(fields='place', include='contacts,websites', practice_day='3')
+        self.assertEqual(list(feature['properties']), ['place', 'primary_contact', 'other_contacts', 'websites'])
+        self.assertEqual(feature['properties']['primary_contact']['name'], 'Ringer')
+        # Everything, the same as the snapshot, by default
+        everything = self.features(bells__gte=10)
+        self.assertEqual(everything, [f for f in self.features() if f['properties']['place'] == 'Ely'])
+
+    def test_bad_requests(self):
+        for data in [{'fields': 'place,latlng'}, {'include': 'bells'}, {'bells': 'six'}, {'bells__gte': ''},
+                     {'ringing_status': 'R,X'}, {'county': 'Cambridge'}, {'colour': 'red'}]:
+            with self.subTest(data=data):
+                response = self.client.get(reverse('towers_geojson'), data)
+                self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('district_geojson', kwargs={'district': 'X'}), {'bells': 6})
+        self.assertEqual(response.status_code, 404)
+
+    def test_bbox(self):
+        self.assertEqual(self.places(bbox='0,52.3,0.3,52.6'), {'March', 'Ely'})
+        self.assertEqual(self.places(bbox='0.1184,52.2031,0.1184,52.2031'), {'Cambridge'})
+        self.assertEqual(self.places(bbox='0.2,52,1,52.3'), set())
+        self.assertEqual(self.places(bbox='-1,52,1,53', bells=6), {'March', 'Cambridge'})
+        # More rows of cells than it's worth having a range for each
+        self.assertEqual(self.places(bbox='-10,40,10,60'), {'March', 'Ely', 'Cambridge'})
+        self.assertEqual(self.places('district_geojson', {'district': 'E'}, bbox='0,52.3,0.3,52.6'), {'Ely'})
+
+    def test_bbox_matches_scan(self):
+        # The grid index finds exactly what checking every tower would
+        towers = list(Tower.objects.all())
+        for bbox in [(0.09, 52.2, 0.12, 52.55), (0.0914, 52.3986, 0.2638, 52.5402), (0.1, 52.0, 0.3, 52.4),
+                     (-180, -90, 180, 90), (0.2638, 52.3986, 0.2638, 52.3986)]:
+            with self.subTest(bbox=bbox):
+                minlng, minlat, maxlng, maxlat = bbox
+                expected = {t.pk for t in towers if minlng <= t.lng <= maxlng and minlat <= t.lat <= maxlat}
+                found = set(Tower.objects.filter(spatial.bbox_q(bbox)).values_list('pk', flat=True))
+                self.assertEqual(found, expected)
+
+    def test_bad_bbox(self):
+        for bbox in ['0,52,1', '0,52,1,53,54', '0,52,east,53', '1,52,0,53', '0,53,1,52', '0,-91,1,53', '']:
+            with self.subTest(bbox=bbox):
+                self.assertEqual(self.client.get(reverse('towers_geojson'), {'bbox': bbox}).status_code, 400)
+
+    def markers(self, name='towers_markers', kwargs=None):
+        """
+        Return the marker feed as a list of {column: value}
+        """
+        response, content = self.get(name, kwargs)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        feed = json.loads(content)
+        # As compact as JSON gets
+        self.assertEqual(content, json.dumps(feed, separators=(',', ':')).encode())
+        columns = [name for name, is_string in serializers.MARKER_COLUMNS]
+        self.assertEqual(list(feed), ['strings'] + columns)
+        strings = feed.pop('strings')
+        # Every string's there once
+        self.assertEqual(len(strings), len(set(strings)))
+        rows = []
+        for values in zip(*feed.values()):
+            rows.append({name: strings[value] if is_string else value
+                         for (name, is_string), value in zip(serializers.MARKER_COLUMNS, values)})
+        return rows
+
+    def test_markers(self):
+        rows = self.markers()
+        self.assertEqual([row['id'] for row in rows], [t.pk for t in Tower.objects.all()])
+        cambridge = next(row for row in rows if row['id'] == self.cambridge.pk)
+        self.assertEqual(cambridge, {
+            'id': self.cambridge.pk, 'lat': 52.2031, 'lng': 0.1184, 'place': 'Cambridge', 'dedication': 'St Bene’t',
+            'include_dedication': 0, 'district': 'C', 'bells': 6, 'ringing_status': 'N'})
+        self.assertEqual([row['place'] for row in self.markers('district_markers', {'district': 'W'})], ['March'])
+        # The cached feed is replaced when the data changes
+        with self.captureOnCommitCallbacks(execute=True):
+            self.march.bells = 8
+            self.march.save()
+        self.assertEqual([row['bells'] for row in self.markers('district_markers', {'district': 'W'})], [8])
+        self.assertEqual(self.client.get(reverse('district_markers', kwargs={'district': 'X'})).status_code, 404)
+
+    def test_rebuilt(self):
+        old = snapshots.current(district='W')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.march.bells = 8
+            self.march.save()
+        new = snapshots.current(district='W')
+        self.assertNotEqual(new, old)
+        self.assertTrue(os.path.exists(new))
+        self.assertFalse(os.path.exists(old))
+        with open(new) as f:
+            self.assertEqual(json.load(f)['features'][0]['properties']['bells'], 8)
+
+
+class ListTests(TempFilesMixin, TestCase):
+    """
+    The tower lists, as pages and as CSV
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Tower.objects.create(place='March', dedication='St Wendreda', district='W', bells=6, latlng='52.5402,0.0914')
+
+    def test_page_validators(self):
+        # A list page's ETag changes with the templates and static files as well as the data
+        response = self.client.get(reverse('tower_list'))
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(reverse('tower_list'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with mock.patch.object(views, 'page_version', return_value='deployed'):
+            self.assertEqual(self.client.get(reverse('tower_list'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # The rows for it are just data
+        response = self.client.get(reverse('tower_list'), {'draw': 1})
+        self.assertNotIn(views.page_version(), response['ETag'])
+
+    def test_csv(self):
+        # Fields derived to speed up queries aren't exported
+        header = self.client.get(reverse('towers_csv')).content.decode().splitlines()[0].split(',')
+        self.assertIn('latlng', header)
+        self.assertFalse({'lat', 'lng', 'grid_cell', 'os_grid', 'practice_week_mask'} & set(header))
+
+
+class NearestTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Finding the towers nearest a point or a postcode
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.north = Tower.objects.create(place='North', dedication='St Mary', district='C', bells=6,
+                                         postcode='CB1 1AA', latlng='52.1,0.1')
+        cls.south = Tower.objects.create(place='South', dedication='St Mary', district='C', bells=8,
+                                         postcode='CB1 2BB', latlng='52.3,0.3')
+        Dove.objects.create(ringid='100', towerid='10', place='March', dedicn='S Wendreda', bells=6,
+                            postcode='PE15 8PP', lat=52.54, long=0.09)
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.object(nearest, '_trees', {}))
+
+    def assertLocation(self, postcode, expected):
+        location = nearest.postcode_location(postcode)
+        self.assertEqual(location and tuple(round(v, 6) for v in location), expected)
+
+    def test_postcode_location(self):
+        # Exactly, however it's written
+        self.assertLocation('CB1 1AA', (52.1, 0.1))
+        self.assertLocation(' cb11aa ', (52.1, 0.1))
+        self.assertLocation('PE15 8PP', (52.54, 0.09))
+        # Otherwise the middle of the sector, or the district
+        self.assertLocation('CB1 1ZZ', (52.1, 0.1))
+        self.assertLocation('CB1 9ZZ', (52.2, 0.2))
+        self.assertLocation('CB1', (52.2, 0.2))
+        self.assertLocation('SW1A 1AA', None)
+
+    def test_bad_postcodes(self):
+        for postcode in ['', 'AB', '12345', 'CB1 1AAA', 'CB1-1AA', 'C1 A']:
+            with self.subTest(postcode=postcode), self.assertRaises(ValueError):
+                nearest.parse_postcode(postcode)
+
+    def test_nearest_towers(self):
+        response = self.client.get(reverse('nearest_towers'), {'postcode': 'CB1 2ZZ', 'k': 1})
+        self.assertEqual([f['properties']['place'] for f in response.json()['features']], ['South'])
+        response = self.client.get(reverse('nearest_towers'), {'lat': 52.11, 'lng': 0.1, 'bells__gte': 7})
+        self.assertEqual([f['properties']['place'] for f in response.json()['features']], ['South'])
+        response = self.client.get(reverse('nearest_towers'), {'lat': 52.11, 'lng': 0.1, 'source': 'dove'})
+        self.assertEqual([f['properties']['place'] for f in response.json()['features']], ['March'])
+        self.assertEqual(self.client.get(reverse('nearest_towers'), {'postcode': 'SW1A 1AA'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('nearest_towers'), {'postcode': ' AB'}).status_code, 400)
+
+
+class QueryBudgetTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Lock in how many queries each public page takes. There are several
+    towers, each with contacts, websites and photos, so anything that
+    queries per tower (or per related row) will blow its budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(6):
+            tower = Tower.objects.create(
+                place=f'Place {n}', dedication='St Mary', district='CW'[n % 2], bells=n + 3,
+                ringing_status='NR'[n % 2], practice='Tuesday', practice_day='2',
+                postcode=f'CB{n} 1AA', latlng=f'52.{n}1,0.{n}2')
+            tower.contact_set.create(role='C', primary=True, name=f'Person {n}', publish=True)
+            tower.contact_set.create(role='TC', name=f'Captain {n}', publish=True)
+            tower.website_set.create(url=f'https://example.com/{n}')
+            tower.website_set.create(url=f'https://example.org/{n}')
+            tower.photo_set.create(image=png(), alt_text='Tower')
+            Dove.objects.create(ringid=str(n), towerid=str(n), place=f'Place {n}', dedicn='S Mary', bells=n + 3,
+                                county='Cambridgeshire', lat=52.1 + n / 10, long=0.2)
+        cls.tower = tower
+
+    def assertQueries(self, queries, name, kwargs=None, data=None):
+        url = reverse(name, kwargs=kwargs)
+        # The first request builds what's only built once per change to the
+        # data (snapshots, search trees, generations); the budget is for the
+        # requests after that, with the page cache cold
+        self.fetch(url, data)
+        cache.clear()
+        with self.assertNumQueries(queries):
+            response = self.fetch(url, data)
+        self.assertEqual(response.status_code, 200)
+
+    def fetch(self, url, data):
+        response = self.client.get(url, data)
+        # Streamed responses only do their work as they're read
+        if response.streaming:
+            b''.join(response.streaming_content)
+        response.close()
+        return response
+
+    def test_lists(self):
+        self.assertQueries(1, 'tower_list')
+        self.assertQueries(1, 'tower_button_list')
+        self.assertQueries(1, 'district_list')
+        self.assertQueries(1, 'single_district_list', {'district': 'C'})
+        self.assertQueries(1, 'bells_list')
+        self.assertQueries(1, 'un_bells_list')
+        self.assertQueries(1, 'practice_night_list')
+
+    def test_server_side_table(self):
+        # Once the unfiltered counts are cached, an unfiltered page is just the page
+        self.fetch(reverse('tower_list'), {'draw': 1})
+        with self.assertNumQueries(1):
+            self.fetch(reverse('tower_list'), {'draw': 1, 'start': 3, 'length': 3})
+        data = {'draw': 2, 'columns[0][data]': 'bells', 'order[0][column]': 0, 'order[0][dir]': 'desc',
+                'searchPanes[district][0]': 'C', 'length': 2}
+        response = self.client.get(reverse('tower_list'), data).json()
+        self.assertEqual((response['draw'], response['recordsTotal'], response['recordsFiltered']), (2, 6, 3))
+        self.assertEqual([row['bells'] for row in response['data']], [7, 5])
+        district = {option['value']: option['count'] for option in response['searchPanes']['options']['district']}
+        self.assertEqual(district, {'C': 3, 'W': 0})
+
+    def test_bad_table_requests(self):
+        # Parameters that should have parts but don't, and vice versa
+        for data in [{'searchPanes[district]': 'C'}, {'columns[0][search]': 'x'}, {'order[0]': 'x'},
+                     {'search[value][0]': 'x'}, {'order[0][column]': 0, 'columns[0]': 'x'}, {'length': 'abc'}]:
+            for name in ['tower_list', 'dove_list']:
+                with self.subTest(name=name, data=data):
+                    response = self.client.get(reverse(name), {'draw': 1, **data})
+                    self.assertEqual(response.status_code, 400)
+
+    def test_dove_list(self):
+        self.assertQueries(1, 'dove_list')
+        self.fetch(reverse('dove_list'), {'draw': 1})
+        with self.assertNumQueries(1):
+            self.fetch(reverse('dove_list'), {'draw': 1, 'start': 2, 'length': 2})
+
+    def test_tower_detail(self):
+        self.assertQueries(4, 'tower_detail', {'pk': self.tower.pk})
+
+    def test_maps(self):
+        self.assertQueries(0, 'towers_map')
+        self.assertQueries(0, 'district_map', {'district': 'C'})
+        self.assertQueries(1, 'tower_map', {'towerid': self.tower.pk})
+        self.assertQueries(0, 'boundary_overlay', {'layer': 'association'}, {'zoom': 8})
+
+    def test_geojson(self):
+        self.assertQueries(0, 'towers_geojson')
+        self.assertQueries(1, 'towers_geojson', data={'bells__gte': 4, 'fields': 'place,bells'})
+        self.assertQueries(4, 'towers_geojson', data={'bbox': '0,52,1,53'})
+        self.assertQueries(0, 'district_geojson', {'district': 'C'})
+        self.assertQueries(1, 'tower_geojson', {'towerid': self.tower.pk})
+
+    def test_markers(self):
+        self.assertQueries(1, 'towers_markers')
+        self.assertQueries(1, 'district_markers', {'district': 'C'})
+
+    def test_nearest(self):
+        self.assertQueries(0, 'nearest_towers', data={'lat': 52.2, 'lng': 0.1})
+        self.assertQueries(1, 'nearest_towers', data={'postcode': 'CB1 1AA', 'bells__gte': 4})
+
+    def test_search(self):
+        self.assertQueries(2, 'search_towers', data={'q': 'st mary'})
+
+    def test_practices(self):
+        # However many months they span
+        self.assertQueries(1, 'practices_tonight', data={'date': '2026-10-20'})
+        self.assertQueries(1, 'practices_week', data={'date': '2026-10-28'})
+
+    def test_ical(self):
+        self.assertQueries(1, 'practices_ical')
+        self.assertQueries(1, 'district_practices_ical', {'district': 'C'})
+
+    def test_csv(self):
+        self.assertQueries(1, 'towers_csv')
+        self.assertQueries(1, 'contacts_csv')
+        self.assertQueries(1, 'websites_csv')
+        self.assertQueries(1, 'photos_csv')
+
+
+class LocationTests(TestCase):
+
+    def test_parse_location(self):
+        self.assertEqual(Tower.parse_location('52.2, 0.12'), (52.2, 0.12))
+        for value in ['52.2', '52.2,0.12,3', 'north,east', 'nan,0.12']:
+            with self.subTest(value=value), self.assertRaises(ValidationError):
+                Tower.parse_location(value)
+
+    def test_bad_location(self):
+        tower = Tower(place='Place', dedication='St Mary', district='C', bells=6, latlng='52.2')
+        with self.assertRaises(ValidationError) as raised:
+            tower.clean()
+        self.assertEqual(list(raised.exception.error_dict), ['latlng'])
+        # Nor will it be saved
+        with self.assertRaises(ValidationError), self.assertNumQueries(0):
+            tower.save()
+        tower.latlng = '52.2,0.12,3'
+        with self.assertRaises(ValidationError):
+            tower.clean()
+        tower.latlng = '52.2,0.12'
+        tower.set_location()
+        self.assertEqual((tower.lat, tower.lng, tower.os_grid), (52.2, 0.12, 'TL449578'))
+
+    def test_os_grid(self):
+        tower = Tower.objects.create(place='Place', dedication='St Mary', district='C', bells=6, latlng='52.2,0.12')
+        self.assertEqual(Tower.objects.get(pk=tower.pk).os_grid, 'TL449578')
+        # Only worked out again when the tower moves
+        tower = Tower.objects.get(pk=tower.pk)
+        with mock.patch.object(models, 'grid_reference') as grid_reference:
+            tower.bells = 8
+            tower.save()
+        grid_reference.assert_not_called()
+        tower.latlng = '52.5402,0.0914'
+        tower.save(update_fields=['latlng'])
+        self.assertEqual(Tower.objects.get(pk=tower.pk).os_grid, 'TL419956')
+
+
+class PermissionTests(TempFilesMixin, TestCase):
+    """
+    The editable-districts resolver behind the admin and the edit links
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('setup_tower_database_permissions')
+        cls.cambridge = Tower.objects.create(place='Cambridge', dedication='St Bene\'t', district='C', latlng='52.2,0.1')
+        cls.ely = Tower.objects.create(place='Ely', dedication='Cathedral', district='E', latlng='52.4,0.26')
+        cls.user = get_user_model().objects.create_user(email='admin@example.com', password='password', is_staff=True)
+        cls.user.groups.add(Group.objects.get(name='Tower Database admin Cambridge'))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def can_edit(self, tower):
+        response = self.client.get(reverse('tower_detail', kwargs={'pk': tower.pk}))
+        return response.context['user_can_edit']
+
+    def test_district_admin(self):
+        self.assertTrue(self.can_edit(self.cambridge))
+        self.assertFalse(self.can_edit(self.ely))
+
+    def test_editable_filter(self):
+        response = self.client.get(reverse('admin:tower_database_tower_changelist'), {'editable': 'yes'})
+        self.assertEqual(list(response.context['cl'].queryset), [self.cambridge])
+
+    def test_cached_until_groups_change(self):
+        self.can_edit(self.ely)
+        # The page's own four, the session and the user - but not their permissions
+        with self.assertNumQueries(6):
+            self.assertFalse(self.can_edit(self.ely))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(Group.objects.get(name='Tower Database admin'))
+        self.assertTrue(self.can_edit(self.ely))
+
+
+class SearchTests(TempFilesMixin, TestCase):
+    """
+    The full-text index behind the public search and the admin
+    """
+
+    def search(self, query):
+        response = self.client.get(reverse('search_towers'), {'q': query})
+        return [result['place'] for result in response.json()['results']]
+
+    def test_search(self):
+        Tower.objects.create(place='March', dedication='S Mary', district='W', latlng='52.55,0.09')
+        Tower.objects.create(place='St Ives', dedication='All Saints', district='H', latlng='52.33,-0.08')
+        Tower.objects.create(place='Ünïcode Städt', dedication='Gt S Mary', district='C', latlng='52.2,0.1',
+                             notes='Wedding ringers welcome')
+        self.assertEqual(self.search('st marys march'), ['March'])
+        self.assertEqual(self.search('unicode great'), ['Ünïcode Städt'])
+        self.assertEqual(self.search('weddi'), ['Ünïcode Städt'])
+        # Place names count for more than dedications
+        self.assertEqual(self.search('ives saint')[0], 'St Ives')
+        self.assertEqual(self.search('saint')[0], 'St Ives')
+        self.assertEqual(self.search('!'), [])
+
+    def test_kept_up_to_date(self):
+        tower = Tower.objects.create(place='March', dedication='S Mary', district='W', latlng='52.55,0.09')
+        tower.place = 'Marsh'
+        tower.save()
+        self.assertEqual(self.search('march'), [])
+        self.assertEqual(self.search('marsh'), ['Marsh'])
+        tower.delete()
+        self.assertEqual(self.search('marsh'), [])
+
+
+class AutocompleteTests(TempFilesMixin, TestCase):
+    """
+    The prefix index behind the admin's suggestions and tower pickers
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.march = Tower.objects.create(place='March', dedication='S Mary', district='W', latlng='52.55,0.09')
+        cls.ely = Tower.objects.create(place='Ely', dedication='Cathedral', district='E', latlng='52.4,0.26')
+        cls.user = get_user_model().objects.create_superuser(email='admin@example.com', password='password')
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.object(autocomplete, '_indexes', {}))
+
+    def test_prefix_index(self):
+        index = autocomplete.PrefixIndex([(1, 'March', 'March S Mary'), (2, 'Marston', 'Marston Ss Mary & Martin'),
+                                          (3, 'Städt', 'Städt S Mary')])
+        self.assertEqual(index.complete('mar'), [1, 2, 3])
+        self.assertEqual(index.complete('mart'), [2])
+        self.assertEqual(index.complete('mary'), [1, 3, 2])
+        self.assertEqual(index.complete('s mary'), [1, 3])
+        self.assertEqual(index.complete('STADT'), [3])
+        self.assertEqual(index.complete('mary', limit=1), [1])
+        self.assertEqual(index.complete(' '), [])
+
+    def test_suggestions(self):
+        url = reverse('admin:tower_database_tower_changelist') + 'search/s mar'
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.user)
+        self.assertEqual([s['keyword'] for s in self.client.get(url).json()], ['March, S Mary'])
+        # Rebuilt once the towers change
+        with self.captureOnCommitCallbacks(execute=True):
+            Tower.objects.create(place='Ramsey', dedication='S Mary', district='H', latlng='52.45,-0.1')
+        self.assertEqual(len(self.client.get(url).json()), 2)
+
+    def test_tower_picker(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'term': 'cath', 'app_label': 'tower_database', 'model_name': 'contact', 'field_name': 'tower'})
+        self.assertEqual([r['id'] for r in response.json()['results']], [str(self.ely.pk)])
+
+
+class PracticeTests(TempFilesMixin, TestCase):
+    """
+    The practice schedule engine and the views and feeds built on it
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        def tower(place, practice, day, weeks=(), district='C'):
+            return Tower.objects.create(place=place, dedication='S Mary', district=district, latlng='52.2,0.1',
+                                        practice=practice, practice_day=day, practice_weeks=list(weeks))
+        cls.weekly = tower('Weekly', 'Tuesday 19:30-21:00', '2')
+        cls.first_third = tower('Firsts', 'Tuesday 19:30 (1st and 3rd)', '2', ['1st', '3rd'], district='E')
+        cls.not_first = tower('Seconds', 'Tuesday (not 1st)', '2', ['not', '1st'])
+        cls.never = tower('Never', '', '')
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_week_mask(self):
+        self.assertEqual(practice.week_mask('2', []), 0b11111)
+        self.assertEqual(practice.week_mask('2', ['1st', '3rd']), 0b00101)
+        self.assertEqual(practice.week_mask('2', ['not', '1st']), 0b11110)
+        self.assertEqual(practice.week_mask('2', ['alternate']), 0b11111 | practice.ALTERNATE)
+        self.assertIsNone(practice.week_mask('', ['1st']))
+        self.assertEqual(Tower.objects.get(pk=self.first_third.pk).practice_week_mask, 0b00101)
+
+    def test_practising_on(self):
+        # 6th October 2026 is the 1st Tuesday, the 13th the 2nd
+        def on(date):
+            return set(practice.practising_on(Tower.objects.all(), date).values_list('place', flat=True))
+        self.assertEqual(on(datetime.date(2026, 10, 6)), {'Weekly', 'Firsts'})
+        self.assertEqual(on(datetime.date(2026, 10, 13)), {'Weekly', 'Seconds'})
+        self.assertEqual(on(datetime.date(2026, 10, 14)), set())
+
+    def test_practices(self):
+        practices = practice.practices(datetime.date(2026, 9, 29), datetime.date(2026, 10, 13))
+        self.assertEqual([(p.date.day, p.tower.name) for p in practices], [
+            (29, 'Seconds'), (29, 'Weekly'), (6, 'Firsts'), (6, 'Weekly'), (13, 'Seconds'), (13, 'Weekly')])
+        self.assertEqual(practices[1].tower.start, datetime.time(19, 30))
+        self.assertEqual(practices[1].tower.end, datetime.time(21, 0))
+        self.assertEqual(len(practice.practices(datetime.date(2026, 10, 1), datetime.date(2026, 10, 31), 'E')), 2)
+        # Changes show up straight away
+        with self.captureOnCommitCallbacks(execute=True):
+            self.weekly.practice_day = '3'
+            self.weekly.save()
+        practices = practice.practices(datetime.date(2026, 10, 13), datetime.date(2026, 10, 14))
+        self.assertEqual([(p.date.day, p.tower.name) for p in practices], [(13, 'Seconds'), (14, 'Weekly')])
+
+    def ical(self, district):
+        with mock.patch.object(practice, 'today', return_value=datetime.date(2026, 10, 13)):
+            response = self.client.get(reverse('district_practices_ical', kwargs={'district': district}))
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        return b''.join(response.streaming_content).decode()
+
+    def test_ical(self):
+        ical = self.ical('C')
+        self.assertTrue(ical.startswith('BEGIN:VCALENDAR\r\n') and ical.endswith('END:VCALENDAR\r\n'))
+        self.assertNotIn('Firsts', ical)
+        # 19:30 BST, then GMT once the clocks go back
+        self.assertIn('BEGIN:VEVENT\r\nUID:practice-%d-20261013@testserver\r\n' % self.weekly.pk, ical)
+        self.assertIn('DTSTART:20261013T183000Z\r\nDTEND:20261013T200000Z\r\n', ical)
+        self.assertIn('DTSTART:20261110T193000Z\r\nDTEND:20261110T210000Z\r\n', ical)
+        # No time at all
+        self.assertIn('DTSTART;VALUE=DATE:20261013\r\nSUMMARY:Practice: Seconds\r\n', ical)
+        # No end time, so two hours
+        self.assertIn('DTSTART:20261103T193000Z\r\nDTEND:20261103T213000Z\r\n', self.ical('E'))
+
+
+class ReconciliationTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Checking towers against Dove
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Dove.objects.create(ringid='100', towerid='10', place='March', dedicn='S Mary Magd', county='Cambridgeshire',
+                            diocese='Ely', bells=8, ringtype='Full-circle ring', affiliations='Ely Diocesan Association',
+                            ng='TL419956', postcode='PE15 8PP', towerbase='5')
+        cls.march = Tower.objects.create(
+            place='March', dedication='St Mary Magdalene', county='C', district='W', bells=8, ringing_status='R', gf=False,
+            postcode='PE15 8PP', latlng='52.5402,0.0914', dove_ringid='100', dove_towerid='10', towerbase_id='5')
+        cls.lost = Tower.objects.create(place='Lost', dedication='S Mary', district='C', latlng='52.2,0.1',
+                                        dove_ringid='999')
+
+    def test_dove_dedication(self):
+        self.assertEqual(reconciliation.dove_dedication('St Mary the Virgin'), 'S Mary V')
+        self.assertEqual(reconciliation.dove_dedication('St Peter and St Paul'), 'S Peter & S Paul')
+        self.assertEqual(reconciliation.dove_dedication('The Cathedral Church of the Holy and Undivided Trinity'),
+                         'Cath Ch of Holy & Undivided Trinity')
+
+    def test_reconcile(self):
+        results = reconciliation.reconcile().results
+        self.assertEqual(results[self.march.pk].discrepancies, [])
+        self.assertEqual([(d.test, d.message) for d in results[self.lost.pk].discrepancies],
+                         [('RingID', "'999' not found")])
+        Tower.objects.filter(pk=self.march.pk).update(bells=6, place='Marsh')
+        only = reconciliation.reconcile(tests=['Place', 'Diocese']).results
+        self.assertEqual([(d.test, d.ours, d.theirs) for d in only[self.march.pk].discrepancies],
+                         [('Place', 'Marsh', 'March')])
+
+    def test_since(self):
+        invalidation.get_generation(invalidation.DOVE)
+        with self.assertNumQueries(2):
+            first = reconciliation.reconcile()
+        self.assertEqual(first.checked, 2)
+        second = reconciliation.reconcile(previous=first)
+        self.assertEqual((second.checked, second.discrepancies()), (0, first.discrepancies()))
+
+        self.march.bells = 10
+        self.march.save()
+        third = reconciliation.reconcile(previous=second)
+        self.assertEqual(third.checked, 1)
+        self.assertEqual([d.test for d in third.results[self.march.pk].discrepancies], ['Bells'])
+        self.assertEqual(third.results[self.lost.pk], first.results[self.lost.pk])
+
+        # Everything again after Dove's reloaded
+        invalidation.invalidate(invalidation.DOVE)
+        self.assertEqual(reconciliation.reconcile(previous=third).checked, 2)
+
+    def test_state_file(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'state.json')
+        self.assertIsNone(reconciliation.load_state(path))
+        state = reconciliation.reconcile()
+        reconciliation.save_state(state, path)
+        loaded = reconciliation.load_state(path)
+        self.assertEqual((loaded.time, loaded.dove_generation, loaded.results),
+                         (state.time, state.dove_generation, state.results))
+
+
+class DoveLoadTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Loading Dove's CSV file, and recording what's changed
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Each test starts with no snapshots
+        self.tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(mock.patch.object(dove, 'SNAPSHOT_DIR', os.path.join(self.tmp, 'dove')))
+
+    def csv(self, *rows):
+        columns = [field.db_column for field in Dove._meta.concrete_fields]
+        lines = [','.join(columns)]
+        for row in rows:
+            lines.append(','.join(row.get(column, '') for column in columns))
+        return io.StringIO('\n'.join(lines) + '\n')
+
+    def test_load(self):
+        Dove.objects.create(ringid='1', place='Gone')
+        f = self.csv(
+            {'RingID': '100', 'TowerID': '10', 'Place': 'March', 'Bells': '8', 'Wt': '1234.5', 'Lat': '52.5402',
+             'Long': '0.0914', 'UR': 'u/r', 'GF': 'GF', 'TowerBase': '0042'},
+            {'RingID': '101', 'Place': 'Ely', 'Bells': 'many', 'Lat': ''},
+        )
+        with mock.patch.object(dove, 'invalidate') as invalidate:
+            count, bad = dove.load(f)
+        invalidate.assert_called_once_with(invalidation.DOVE)
+        self.assertEqual((count, dict(bad)), (2, {'bells': 1}))
+
+        self.assertEqual(list(Dove.objects.values_list('ringid', flat=True)), ['101', '100'])
+        march = Dove.objects.get(ringid='100')
+        self.assertEqual((march.bells, march.wt, march.lat, march.ur, march.gf, march.toilet, march.towerbase),
+                         (8, 1234.5, 52.5402, True, True, False, '0042'))
+        ely = Dove.objects.get(ringid='101')
+        self.assertEqual((ely.bells, ely.lat, ely.ur, ely.towerid), (None, None, False, ''))
+
+        indexes = connection.introspection.get_constraints(connection.cursor(), Dove._meta.db_table)
+        self.assertIn('dove_towers_position', indexes)
+        self.assertIn('dove_towers_county', indexes)
+
+    def test_missing_columns(self):
+        with self.assertRaisesMessage(ValueError, 'Columns missing'):
+            dove.load(io.StringIO('RingID,Place\n1,March\n'))
+
+    def update(self, *rows):
+        path = os.path.join(self.tmp, 'dove.csv')
+        with open(path, 'w', newline='') as f:
+            f.write(self.csv(*rows).getvalue())
+        return dove.update(path)[0]
+
+    def test_update(self):
+        march = {'RingID': '100', 'Place': 'March', 'Bells': '8'}
+        ely = {'RingID': '101', 'Place': 'Ely', 'Bells': '6'}
+        first = self.update(march, ely)
+        self.assertEqual((first.rings, first.previous_snapshot, first.changes.count()), (2, '', 0))
+        # The same again is no change, and doesn't need another snapshot
+        second = self.update(march, ely)
+        self.assertEqual((second.snapshot, second.changes.count()), (first.snapshot, 0))
+
+        third = self.update({**march, 'Bells': '10', 'GF': 'GF'}, {'RingID': '102', 'Place': 'Wisbech'})
+        self.assertEqual((third.added, third.removed, third.changed), (1, 1, 1))
+        self.assertEqual(sorted((c.ringid, c.kind, c.fields) for c in third.changes.all()),
+                         [('100', 'C', {'bells': ['8', '10'], 'gf': ['', 'GF']}), ('101', 'R', {}), ('102', 'A', {})])
+        self.assertEqual(Dove.objects.get(ringid='100').bells, 10)
+        self.assertEqual(len(dove.snapshots()), 2)
+
+        # What's changed is only known from once there was something to compare with
+        self.assertIsNone(dove.changed_rings(first.previous_generation, third.generation))
+        self.assertEqual(dove.changed_rings(first.generation, third.generation), {'100', '101', '102'})
+        self.assertEqual(dove.changed_rings(third.generation, third.generation), set())
+        dove.load(self.csv(march))
+        self.assertIsNone(dove.changed_rings(third.generation, invalidation.get_generation(invalidation.DOVE)))
+
+
+class MatchingTests(TempFilesMixin, DoveTableMixin, TestCase):
+    """
+    Suggesting Dove rings for towers
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for ringid, place, dedicn, bells, county, postcode, lat, lng in [
+                ('100', 'March', 'S Wendreda', 8, 'Cambridgeshire', 'PE15 8PP', 52.5402, 0.0914),
+                ('101', 'March', 'S John', 6, 'Cambridgeshire', 'PE15 8QD', 52.5485, 0.0880),
+                ('102', 'March', 'S Peter', 1, 'Cambridgeshire', 'PE15 9JN', 52.5511, 0.0875),
+                ('103', 'Doddington', 'S Mary', 8, 'Cambridgeshire', 'PE15 0TF', 52.4986, 0.0594),
+                ('200', 'Upwell', 'S Peter', 8, 'Norfolk', 'PE14 9AB', 52.5800, 0.2200)]:
+            Dove.objects.create(ringid=ringid, towerid=str(int(ringid) + 1000), place=place, dedicn=dedicn, bells=bells,
+                                county=county, postcode=postcode, lat=lat, long=lng)
+        cls.wendreda = Tower.objects.create(place='March', dedication='St Wendreda', county='C', district='W', bells=8,
+                                            postcode='PE15 8PP', latlng='52.5403,0.0915')
+        cls.john = Tower.objects.create(place='March', dedication='St John', county='C', district='W', bells=6,
+                                        latlng='52.5480,0.0881', dove_ringid='101')
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.object(nearest, '_trees', {}))
+        self.enterContext(mock.patch.object(matching, '_rings', None))
+
+    def test_suggest(self):
+        suggestions = matching.suggest(self.wendreda)
+        self.assertEqual(suggestions[0].ring.ringid, '100')
+        self.assertGreater(suggestions[0].score, 95)
+        # Not rings linked to other towers, nor ones in other counties
+        self.assertEqual([s.ring.ringid for s in suggestions], ['100', '102', '103'])
+        self.assertEqual(matching.suggest(self.john)[0].ring.ringid, '101')
+
+    def test_without_location(self):
+        self.wendreda.lat = self.wendreda.lng = None
+        suggestions = matching.suggest(self.wendreda, limit=2)
+        self.assertEqual([(s.ring.ringid, s.distance) for s in suggestions], [('100', None), ('102', None)])
+        # Once Dove's been read, just the one query for the linked rings
+        matching.suggest(self.john)
+        with self.assertNumQueries(1):
+            self.assertEqual(matching.suggest_all([self.wendreda, self.john], limit=1)[self.john.pk][0].ring.ringid, '101')
+
+
+class BoundaryTests(TempFilesMixin, TestCase):
+    """
+    The map's boundary overlays
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Two squares side by side
+        source = self.enterContext(tempfile.TemporaryDirectory())
+        squares = [{'type': 'Feature', 'properties': {'name': name, 'area': 1},
+                    'geometry': {'type': 'Polygon', 'coordinates': [[[x, 52], [x + 1, 52], [x + 1, 53], [x, 53], [x, 52]]]}}
+                   for name, x in [('West', 0), ('East', 1)]]
+        with open(os.path.join(source, 'Squares.geojson'), 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': squares}, f)
+        self.enterContext(mock.patch.object(boundaries, 'SOURCE_DIR', source))
+        self.enterContext(mock.patch.object(boundaries, 'LAYERS', {'squares': ('Squares.geojson', ['name'])}))
+
+    def test_shared_arcs(self):
+        for zoom in boundaries.ZOOM_BANDS:
+            with self.subTest(zoom=zoom):
+                with open(boundaries.current('squares', zoom)) as f:
+                    topology = json.load(f)
+                west, east = topology['objects']['squares']['geometries']
+                self.assertEqual([west['properties'], east['properties']], [{'name': 'West'}, {'name': 'East'}])
+                # The edge between them is one arc, used forwards by one and backwards by the other
+                self.assertEqual(len(topology['arcs']), 3)
+                [[west_arcs]], [[east_arcs]] = west['arcs'], east['arcs']
+                shared = set(west_arcs) & {~arc for arc in east_arcs}
+                self.assertEqual(len(shared), 1)
+
+    def test_overlay(self):
+        response = self.client.get(reverse('boundary_overlay', kwargs={'layer': 'squares'}), {'zoom': 11})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['type'], 'Topology')
+        etag = response['ETag']
+        response = self.client.get(reverse('boundary_overlay', kwargs={'layer': 'squares'}), {'zoom': 11},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse('boundary_overlay', kwargs={'layer': 'squares'}), {'zoom': 14})
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(reverse('boundary_overlay', kwargs={'layer': 'rivers'})).status_code, 404)
+        response = self.client.get(reverse('boundary_overlay', kwargs={'layer': 'squares'}), {'zoom': 'far'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MigrationTests(TestCase):
+    """
+    Filling in what's derived from existing towers' data
+    """
+
+    def migration(self, name):
+        return importlib.import_module(f'tower_database.migrations.{name}')
+
+    def towers(self, *locations):
+        # As they were before the columns were added, including locations save() wouldn't allow
+        towers = [Tower.objects.create(place=f'Place {n}', dedication='S Mary', district='C', latlng='52.2,0.12')
+                  for n in range(len(locations))]
+        for tower, latlng in zip(towers, locations):
+            Tower.objects.filter(pk=tower.pk).update(latlng=latlng, lat=None, lng=None, grid_cell=None, os_grid='')
+        return [tower.pk for tower in towers]
+
+    def test_grid_cell(self):
+        towers = self.towers('52.2,0.12', '52.2', 'north,east', 'nan,0.12', '52.2,0.12,3')
+        self.migration('0007_tower_grid_cell').set_grid_cells(apps, None)
+        cells = dict(Tower.objects.values_list('pk', 'grid_cell'))
+        self.assertEqual([cells[pk] for pk in towers], [spatial.grid_cell(52.2, 0.12), None, None, None, None])
+
+    def test_lat_lng(self):
+        towers = self.towers('52.2,0.12', '52.2', 'north,east', 'nan,0.12', '52.2,0.12,3')
+        self.migration('0008_tower_lat_lng').set_lat_lng(apps, None)
+        locations = {pk: (lat, lng) for pk, lat, lng in Tower.objects.values_list('pk', 'lat', 'lng')}
+        self.assertEqual([locations[pk] for pk in towers], [(52.2, 0.12)] + [(None, None)] * 4)
+
+    def test_os_grid(self):
+        # Including places off the grid
+        towers = self.towers('52.2,0.12', '52.2', '0,0', '-40,170')
+        self.migration('0008_tower_lat_lng').set_lat_lng(apps, None)
+        self.migration('0009_tower_os_grid').set_os_grid(apps, None)
+        references = dict(Tower.objects.values_list('pk', 'os_grid'))
+        self.assertEqual([references[pk] for pk in towers], ['TL449578', '', '', ''])
+
+    def test_search_index(self):
+        tower = Tower.objects.create(place='Great Shelford', dedication='S Mary', district='C', latlng='52.15,0.14')
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM tower_database_search")
+        self.migration('0010_search').build_index(apps, mock.Mock(connection=connection))
+        self.assertEqual(search.search('gt shelford st marys'), [tower.pk])
+
+    def test_week_mask(self):
+        tower = Tower.objects.create(place='Place', dedication='S Mary', district='C', latlng='52.2,0.12',
+                                     practice_day='2', practice_weeks=['not', '1st'])
+        Tower.objects.filter(pk=tower.pk).update(practice_week_mask=None)
+        self.migration('0011_tower_practice_week_mask').set_week_masks(apps, None)
+        self.assertEqual(Tower.objects.get(pk=tower.pk).practice_week_mask, 0b11110)
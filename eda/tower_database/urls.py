@@ -12,17 +12,26 @@ urlpatterns = [
 
     path(r'', view=views.TowerListView.as_view(), name='tower_list'),
     path(r'geojson/', view=views.geojson, name='towers_geojson'),
+    path(r'markers/', view=views.markers, name='towers_markers'),
     path(r'buttons/', view=views.TowerButtonListView.as_view(), name='tower_button_list'),
     path(r'districts/', view=views.DistrictListView.as_view(), name='district_list'),
     path(r'map/', view=views.MapView.as_view(), name='towers_map'),
+    path(r'nearest/', view=views.nearest_towers, name='nearest_towers'),
+    path(r'search/', view=views.search_towers, name='search_towers'),
+    path(r'boundaries/<str:layer>/', view=views.boundary, name='boundary_overlay'),
 
     path(r'district/<str:district>/', view=views.SingleDistrictListView.as_view(), name='single_district_list'),
     path(r'district/<str:district>/map/', view=views.MapView.as_view(), name='district_map'),
     path(r'district/<str:district>/json/', view=views.geojson, name='district_geojson'),
+    path(r'district/<str:district>/markers/', view=views.markers, name='district_markers'),
+    path(r'district/<str:district>/practices.ics', view=views.practices_ical, name='district_practices_ical'),
 
     path(r'bells/', view=views.BellsListView.as_view(), name='bells_list'),
     path(r'unbells/', view=views.UnBellsListView.as_view(), name='un_bells_list'),
     path(r'night/', view=views.PracticeNightListView.as_view(), name='practice_night_list'),
+    path(r'tonight/', view=views.PracticeCalendarView.as_view(), name='practices_tonight'),
+    path(r'week/', view=views.PracticeCalendarView.as_view(days=7, title='Practices this week'), name='practices_week'),
+    path(r'dove/', view=views.DoveListView.as_view(), name='dove_list'),
 
     path(r'tower/<int:pk>/', view=views.TowerDetailView.as_view(), name='tower_detail'),
     path(r'tower/<int:towerid>/json/', view=views.geojson, name='tower_geojson'),
@@ -32,5 +41,6 @@ urlpatterns = [
     path(r'contacts.csv', view=views.contact_csv, name='contacts_csv'),
     path(r'websites.csv', view=views.website_csv, name='websites_csv'),
     path(r'photos.csv', view=views.photo_csv, name='photos_csv'),
+    path(r'practices.ics', view=views.practices_ical, name='practices_ical'),
 
 ]
\ No newline at end of file
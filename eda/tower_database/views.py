@@ -1,17 +1,34 @@
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.exceptions import BadRequest
 from django.db import models
+from django.db.models import Q
 from django.db.models.fields import Field
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template import engines
 from django.templatetags.static import static
 from django.urls import reverse
+from django.utils.html import format_html
 from django.views.decorators.cache import cache_page
 from django.views.decorators.clickjacking import xframe_options_exempt
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView, ListView, DetailView
 
-from geojson import Point, Feature, FeatureCollection, dump
 import csv
+import datetime
+import functools
+import hashlib
+import os
 
-from .models import Tower, Contact, Website, Photo
+from geojson import Point, Feature, FeatureCollection
+
+from . import boundaries, datatables, nearest, practice, search, snapshots, spatial
+from .datatables import Column
+from .serializers import DERIVED, INCLUDES, as_json, iter_feature_collection, markers_as_json, tower_properties
+from .invalidation import ALL_TOWERS, DOVE, tower_key, district_key, get_generation, get_generations, generation_time, versioned_key
+from .models import Tower, Contact, Website, Photo, Dove
+from .permissions import can_edit
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,8 +40,184 @@ class XFrameOptionsExemptMixin:
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
 
-class TowerListView(XFrameOptionsExemptMixin, ListView):
+
+@functools.cache
+def page_version():
+    """
+    Return a version for what HTML pages are made from other than the
+    data: the templates, and the static files they link to (by way of the
+    hash of the static files manifest, when there is one). It's worked out
+    once per process, so it changes when new code is deployed.
+    """
+
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(getattr(staticfiles_storage, 'manifest_hash', '').encode())
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def data_condition(dependencies, page=False):
+    """
+    Decorator adding strong ETag and Last-Modified headers derived from
+    the generations of the data a view depends on, and answering
+    conditional GETs with a 304 before the view itself runs.
+    `dependencies` is called with the request and the view's keyword
+    arguments and returns the generation keys to use, or None to skip.
+
+    For an HTML `page` the data isn't all that matters: the ETag includes
+    page_version() too, and there's no Last-Modified, which would say the
+    page hadn't changed after a deploy.
+    """
+
+    def generations(request, **kwargs):
+        if not hasattr(request, '_data_generations'):
+            keys = dependencies(request, **kwargs)
+            request._data_generations = [get_generations(*keys)[k] for k in keys] if keys else None
+        return request._data_generations
+
+    def etag(request, *args, **kwargs):
+        current = generations(request, **kwargs)
+        if not current:
+            return None
+        tag = '-'.join(str(g) for g in current)
+        return f'{page_version()}-{tag}' if page else tag
+
+    def last_modified(request, *args, **kwargs):
+        current = generations(request, **kwargs)
+        if page:
+            return None
+        # Generation 0 is data that's never changed, so there's no time for it
+        return generation_time(max(current)) if current and max(current) else None
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+class DataConditionMixin:
+    """
+    Conditional GET support (see data_condition) for class-based views
+    """
+
+    def get_dependencies(self):
+        return [ALL_TOWERS]
+
+    def dispatch(self, request, *args, **kwargs):
+        # DataTables' requests for rows (see ServerSideTableMixin) are just
+        # data; anything else is the page itself
+        page = 'draw' not in request.GET
+        view = data_condition(lambda request, **kwargs: self.get_dependencies(), page)(super().dispatch)
+        return view(request, *args, **kwargs)
+
+
+class TowerRowCacheMixin:
+    """
+    Give each tower its current cache version, so that templates can cache
+    each row as a fragment that's only re-rendered when that tower changes
+    """
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        towers = context['object_list']
+        generations = get_generations(*[tower_key(tower.pk) for tower in towers])
+        for tower in towers:
+            tower.cache_version = generations[tower_key(tower.pk)]
+        return context
+
+
+class ServerSideTableMixin:
+    """
+    Serve the table a page at a time (see datatables.py) once it's too big
+    to send whole: the page itself then has no rows, and DataTables' requests
+    for them (which have a 'draw' parameter) get JSON from `table`
+    """
+
+    table = None
+
+    def get(self, request, *args, **kwargs):
+        if self.table and 'draw' in request.GET:
+            # The unfiltered counts only change when the data does
+            key = versioned_key(f'table:{request.path}', *self.get_dependencies())
+            return JsonResponse(self.table.process(request.GET, self.get_queryset(), key))
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        if not self.table:
+            return super().get_context_data(**kwargs)
+        # Fetching one more than the threshold says whether we're over it,
+        # and otherwise gets the rows we need anyway
+        rows = list(self.object_list[:datatables.SERVER_SIDE_THRESHOLD + 1])
+        server_side = len(rows) > datatables.SERVER_SIDE_THRESHOLD
+        kwargs['object_list'] = [] if server_side else rows
+        context = super().get_context_data(**kwargs)
+        context['server_side'] = server_side
+        return context
+
+
+def _tower_link(tower, text):
+    return format_html('<b><a href="{}">{}</a></b>', tower.get_absolute_url(), text)
+
+
+def _map_link(tower):
+    return format_html('<a href="{}">Map</a>', reverse('tower_map', kwargs={'towerid': tower.pk}))
+
+
+# The columns of tower_list.html
+TOWER_TABLE = datatables.Table([
+        Column('place', 'place'),
+        Column('dedication', 'dedication'),
+        Column('bells', 'bells', searchable=False, pane=True),
+        Column('ringing_status', 'ringing_status', searchable=False, pane=True, labels=dict(Tower.RingingStatus.choices)),
+        Column('district', 'district', searchable=False, pane=True, labels=dict(Tower.Districts.choices)),
+        Column('map'),
+    ],
+    lambda tower: {
+        'place': _tower_link(tower, tower.place),
+        'dedication': format_html('{}', tower.dedication),
+        'bells': tower.bells,
+        'ringing_status': tower.get_ringing_status_display(),
+        'district': tower.get_district_display(),
+        'map': _map_link(tower),
+    }
+)
+
+
+def _practice_place(tower):
+    text = _tower_link(tower, tower.name)
+    if tower.practice_weeks:
+        text += format_html(' ({})', tower.practice_weeks_text)
+    if tower.travel_check:
+        text += ' (check)'
+    return text
+
+
+# The columns of practice_list.html
+PRACTICE_TABLE = datatables.Table([
+        Column('practice_day', 'practice_day', searchable=False),
+        Column('day'),
+        Column('place', 'place'),
+        Column('bells', 'bells', searchable=False, pane=True),
+        Column('district', 'district', searchable=False, pane=True, labels=dict(Tower.Districts.choices)),
+        Column('map'),
+    ],
+    lambda tower: {
+        'practice_day': tower.practice_day,
+        'day': tower.get_practice_day_display(),
+        'place': _practice_place(tower),
+        'bells': tower.bells,
+        'district': tower.get_district_display(),
+        'map': _map_link(tower),
+    }
+)
+
+
+class TowerListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
     model = Tower
+    table = TOWER_TABLE
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -33,8 +226,11 @@ class TowerListView(XFrameOptionsExemptMixin, ListView):
 
 class TowerButtonListView(TowerListView):
     template_name = 'tower_database/tower_list_buttons.html'
+    # Not a table
+    table = None
 
-class DistrictListView(XFrameOptionsExemptMixin, ListView):
+class DistrictListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
+    table = TOWER_TABLE
     model = Tower
     ordering = ('district', 'place', 'dedication')
 
@@ -45,7 +241,11 @@ class DistrictListView(XFrameOptionsExemptMixin, ListView):
         return context
 
 
-class SingleDistrictListView(XFrameOptionsExemptMixin, ListView):
+class SingleDistrictListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
+    table = TOWER_TABLE
+
+    def get_dependencies(self):
+        return [district_key(self.kwargs["district"])]
 
     def get_queryset(self):
         district = self.kwargs["district"]
@@ -59,7 +259,8 @@ class SingleDistrictListView(XFrameOptionsExemptMixin, ListView):
         return context
 
 
-class BellsListView(XFrameOptionsExemptMixin, ListView):
+class BellsListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
+    table = TOWER_TABLE
     queryset = Tower.objects.exclude(ringing_status = 'N').exclude(bells=None)
     ordering = ('-bells', 'place', 'dedication')
 
@@ -70,7 +271,8 @@ class BellsListView(XFrameOptionsExemptMixin, ListView):
         return context
 
 
-class UnBellsListView(XFrameOptionsExemptMixin, ListView):
+class UnBellsListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
+    table = TOWER_TABLE
     queryset = Tower.objects.filter(ringing_status = 'N').exclude(bells=None)
     ordering = ('-bells', 'place', 'dedication')
 
@@ -83,7 +285,8 @@ class UnBellsListView(XFrameOptionsExemptMixin, ListView):
         return context
 
 
-class PracticeNightListView(XFrameOptionsExemptMixin, ListView):
+class PracticeNightListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, TowerRowCacheMixin, ListView):
+    table = PRACTICE_TABLE
     queryset = Tower.objects.exclude(practice_day = '')
     ordering = ('practice_day', 'place', 'dedication')
     template_name = 'tower_database/practice_list.html'
@@ -94,18 +297,113 @@ class PracticeNightListView(XFrameOptionsExemptMixin, ListView):
         return context
 
 
+class PracticeCalendarView(XFrameOptionsExemptMixin, TemplateView):
+    """
+    Practices over the next `days` days (see practice.py), from ?date= if
+    given, optionally just in ?district=
+    """
+    template_name = 'tower_database/practice_calendar.html'
+    days = 1
+    title = 'Practices tonight'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        params = self.request.GET
+        try:
+            start = datetime.date.fromisoformat(params['date']) if 'date' in params else practice.today()
+        except ValueError as e:
+            raise BadRequest(f"Bad parameter: {e}")
+        district = params.get('district') or None
+        if district and district not in Tower.Districts.values:
+            raise Http404(f"No such district '{district}'")
+        end = start + datetime.timedelta(days=self.days - 1)
+
+        by_date = {start + datetime.timedelta(days=n): [] for n in range(self.days)}
+        for p in practice.practices(start, end, district):
+            by_date[p.date].append(p.tower)
+
+        context['title'] = self.title
+        context['district'] = Tower.Districts(district).label if district else None
+        context['by_date'] = by_date.items()
+        context['ical_url'] = (reverse('district_practices_ical', kwargs={'district': district}) if district
+                               else reverse('practices_ical'))
+        return context
+
+
+# How far back and ahead the iCalendar feeds go
+ICAL_PAST = datetime.timedelta(weeks=2)
+ICAL_FUTURE = datetime.timedelta(weeks=13)
+
+
+def practices_ical(request, district=None):
+    """
+    An iCalendar feed of practices (see practice.py), optionally just for
+    one district
+    """
+
+    if district and district not in Tower.Districts.values:
+        raise Http404(f"No such district '{district}'")
+
+    today = practice.today()
+    practices = practice.practices(today - ICAL_PAST, today + ICAL_FUTURE, district)
+    name = f'{Tower.Districts(district).label if district else "Ely DA"} practices'
+    base_url = request.build_absolute_uri('/').rstrip('/')
+
+    response = StreamingHttpResponse(practice.iter_ical(practices, name, base_url),
+                                     content_type='text/calendar; charset=utf-8')
+    response['Content-Disposition'] = f'inline; filename="practices{"-" + district if district else ""}.ics"'
+    return response
+
+
+# The columns of dove_list.html
+DOVE_TABLE = datatables.Table([
+        Column('place', 'place'),
+        Column('dedicn', 'dedicn'),
+        Column('county', 'county', pane=True),
+        Column('country', 'country', searchable=False, pane=True),
+        Column('bells', 'bells', searchable=False, pane=True),
+        Column('ringtype', 'ringtype', searchable=False, pane=True),
+    ],
+    lambda ring: {
+        'place': format_html('<b><a href="https://dove.cccbr.org.uk/tower/{}">{}</a></b>', ring.towerid, ring.place),
+        'dedicn': format_html('{}', ring.dedicn or ''),
+        'county': format_html('{}', ring.county or ''),
+        'country': format_html('{}', ring.country or ''),
+        'bells': format_html('{}{}', ring.bells or '', ' (unringable)' if ring.ur else ''),
+        'ringtype': format_html('{}', ring.ringtype or ''),
+    }
+)
+
+
+class DoveListView(XFrameOptionsExemptMixin, DataConditionMixin, ServerSideTableMixin, ListView):
+    """
+    Browse the whole of Dove's Guide - which is far too big to send whole
+    """
+    model = Dove
+    table = DOVE_TABLE
+    template_name = 'tower_database/dove_list.html'
+
+    def get_dependencies(self):
+        return [DOVE]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["title"] = "Dove's Guide"
+        return context
+
+
 class TowerDetailView(XFrameOptionsExemptMixin, DetailView):
-    model = Tower
+    # Everything the template shows, in one query per table
+    queryset = Tower.objects.prefetch_related('contact_set', 'website_set', 'photo_set')
     context_object_name = 'tower'
 
     def get_context_data(self, **kwargs):
-        admin_group = f'Tower Database admin { self.object.get_district_display() }'
         context = super().get_context_data(**kwargs)
-        context['user_can_edit'] = (
-            self.request.user.is_superuser or
-            self.request.user.groups.filter(name='Tower Database admin').exists() or
-            self.request.user.groups.filter(name=admin_group).exists()
-        )
+        context['cache_version'] = get_generation(tower_key(self.object.pk))
+        if self.object.lat is not None:
+            context['nearby'] = nearest.nearest(self.object.lat, self.object.lng, k=5, exclude=self.object.pk)
+        context['user_can_edit'] = can_edit(self.request, self.object.district)
 
         return context
 
@@ -118,106 +416,269 @@ class MapView(XFrameOptionsExemptMixin, TemplateView):
 
         # Build config to pass to the map JavaScript
         map_config = { "static_root": static('tower_database/map') }
+        # Boundary overlays, loaded when they're shown and per zoom band
+        map_config["boundaries"] = {name: reverse('boundary_overlay', kwargs={'layer': name}) for name in boundaries.LAYERS}
+        map_config["boundary_bands"] = boundaries.ZOOM_BANDS
         if 'towerid' in context:
             tower = get_object_or_404(Tower, pk=context['towerid'])
             map_config["centre"] = [tower.lat, tower.lng]
             map_config["towerid"] = context['towerid']
             # All towers, so we can optionally display them
-            map_config["towers_json"] = reverse('towers_geojson')
+            map_config["markers_json"] = reverse('towers_markers')
         elif 'district' in context:
             map_config["district"] = context['district']
-            map_config["towers_json"] = reverse('district_geojson', kwargs={'district': context['district']})
+            map_config["markers_json"] = reverse('district_markers', kwargs={'district': context['district']})
         else:
-            map_config["towers_json"] = reverse('towers_geojson')
+            map_config["markers_json"] = reverse('towers_markers')
+        # Full details are only fetched for a tower when its popup is opened
+        map_config["tower_json"] = reverse('tower_geojson', kwargs={'towerid': 0}).replace('/0/', '/{id}/')
         context['map_config'] = map_config
 
         return context
 
 
-def tower_as_geojson(tower):
-
-    point = Point((float(tower.lng), float(tower.lat)))
-
-    omit = ['id', 'latlng', 'maintainer_notes']
-    properties = {}
-
-    # All (most) individual Tower fields
-    for  name in [f.name for f in Tower._meta.fields if f.name not in omit]:
-        properties[name] = getattr(tower, name)
-    # OS Grid and url aren't actually fields...
-    properties['os_grid'] = tower.os_grid
-    properties['url'] = tower.get_absolute_url()
-
-    # Tower primary contact, if available and publishable
-    primary_c = {}
-    if tower.primary_contact and tower.primary_contact.publish:
-        for  name in [f.name for f in Contact._meta.fields if f.name != 'tower']:
-            primary_c[name] = getattr(tower.primary_contact, name)
-    properties['primary_contact'] = primary_c
-
-    # All other Tower contacts, if publishable
-    other_contacts = []
-    for contact in tower.other_contacts:
-        if contact.publish:
-            c = {}
-            for  name  in [f.name for f in Contact._meta.fields if f.name != 'tower']:
-                c[name] = getattr(contact, name)
-            other_contacts.append(c)
-    properties['other_contacts'] = other_contacts
-
-    # All websites
-    websites = []
-    for website in tower.website_set.all():
-        w = {}
-        for  name in [f.name for f in Website._meta.fields if f.name != 'tower']:
-            w[name] = getattr(website, name)
-        websites.append(w)
-    properties['websites'] = websites
-
-    # All photos
-    photos = []
-    for photo in tower.photo_set.all():
-        p = {}
-        for  name in [f.name for f in Photo._meta.fields if f.name != 'tower']:
-            if name == 'image':
-                p[name] = getattr(photo, name).url
-            else:
-                p[name] = getattr(photo, name)
-        photos.append(p)
-    properties['photos'] = photos
-
-    return Feature(id=tower.id, geometry=point, properties=properties)
+def boundary_etag(request, layer):
+    try:
+        return f'{boundaries.version(layer)}-{boundaries.band(int(request.GET.get("zoom", 0)))}'
+    except (KeyError, ValueError, FileNotFoundError):
+        return None
 
 
-def geojson(request, towerid=None, district=None):
+@condition(etag_func=boundary_etag)
+def boundary(request, layer):
 
-    logger.info('Rebuilding the GeoJSONson page')
+    try:
+        zoom = int(request.GET.get('zoom', 0))
+    except ValueError:
+        raise BadRequest("zoom must be a number")
 
-    if towerid:
-        tower = get_object_or_404(Tower, pk=towerid)
-        result = tower_as_geojson(tower)
+    try:
+        path = boundaries.current(layer, zoom)
+    except (KeyError, FileNotFoundError):
+        raise Http404(f"No such boundary layer '{layer}'")
 
-    elif district:
-        features = []
-        for tower in Tower.objects.filter(district=district).prefetch_related('contact_set', 'website_set', 'photo_set'):
-            features.append(tower_as_geojson(tower))
-        result = FeatureCollection(features)
+    return FileResponse(open(path, 'rb'), content_type='application/json')
 
+
+def geojson_dependencies(request, towerid=None, district=None):
+    if towerid:
+        # Before any generation lookups, which are no use for towers that don't exist
+        if not Tower.objects.filter(pk=towerid).exists():
+            raise Http404(f"No tower with ID {towerid}")
+        return [tower_key(towerid)]
+    elif district:
+        return [district_key(district)] if district in Tower.Districts.values else None
     else:
-        features = []
-        for tower in Tower.objects.prefetch_related('contact_set', 'website_set', 'photo_set'):
-            features.append(tower_as_geojson(tower))
-        result = FeatureCollection(features)
+        return [ALL_TOWERS]
+
+
+def _lookup(lookup, convert):
+    return lambda value: Q(**{lookup: convert(value)})
+
+
+def _choices(choices):
+    def convert(value):
+        values = value.split(',')
+        for v in values:
+            if v not in choices.values:
+                raise ValueError(f"'{v}' isn't one of {', '.join(choices.values)}")
+        return values
+    return convert
+
+
+# Query parameters that can be used to filter the GeoJSON collections,
+# each with a function turning its value into a Q object
+GEOJSON_FILTERS = {
+    'bells': _lookup('bells', int),
+    'bells__gte': _lookup('bells__gte', int),
+    'bells__lte': _lookup('bells__lte', int),
+    'ringing_status': _lookup('ringing_status__in', _choices(Tower.RingingStatus)),
+    'practice_day': _lookup('practice_day__in', _choices(Tower.Days)),
+    'ring_type': _lookup('ring_type__in', _choices(Tower.RingTypes)),
+    'county': _lookup('county__in', _choices(Tower.Counties)),
+    'bbox': lambda value: spatial.bbox_q(spatial.parse_bbox(value)),
+}
+
+
+def geojson_query(params):
+    """
+    Turn GeoJSON query parameters into (filters, fields, include).
+    `fields` and `include` are None when all of them are wanted - except
+    that asking for specific fields drops the related data unless it's
+    also asked for explicitly. Raises BadRequest for anything invalid.
+    """
+
+    filters = []
+    fields = include = None
+
+    for param, value in params.items():
+        if param == 'fields':
+            fields = [f for f in value.split(',') if f]
+            unknown = set(fields) - set(tower_properties())
+            if unknown:
+                raise BadRequest(f"Unknown field(s): {', '.join(sorted(unknown))}")
+        elif param == 'include':
+            include = [i for i in value.split(',') if i]
+            unknown = set(include) - set(INCLUDES)
+            if unknown:
+                raise BadRequest(f"Unknown include(s): {', '.join(sorted(unknown))}")
+        elif param in GEOJSON_FILTERS:
+            try:
+                filters.append(GEOJSON_FILTERS[param](value))
+            except ValueError as e:
+                raise BadRequest(f"Bad value for '{param}': {e}")
+        else:
+            raise BadRequest(f"Unknown parameter '{param}'")
 
-    response = HttpResponse(
+    if fields is not None and include is None:
+        include = []
+
+    return filters, fields, include
+
+
+@data_condition(geojson_dependencies)
+def geojson(request, towerid=None, district=None):
+
+    if district and district not in Tower.Districts.values:
+        raise Http404(f"No such district '{district}'")
+
+    name = snapshots.filename(towerid=towerid, district=district)
+
+    # Filtered or partial collections are built on demand rather than
+    # kept as snapshots - with only the columns and prefetches they need
+    if request.GET and not towerid:
+        filters, fields, include = geojson_query(request.GET)
+        towers = Tower.objects.filter(*filters)
+        if district:
+            towers = towers.filter(district=district)
+        return StreamingHttpResponse(
+            iter_feature_collection(towers, fields, include),
+            content_type='application/geo+json',
+            headers={"Content-Disposition": f'inline; filename="{name}"'},
+        )
+
+    if towerid:
+        try:
+            path = snapshots.current(towerid=towerid)
+        except Tower.DoesNotExist:
+            raise Http404(f"No tower with ID {towerid}")
+        return FileResponse(open(path, 'rb'), content_type='application/geo+json', filename=name)
+
+    # Collections can be large, so if there isn't a current snapshot stream
+    # the document out as it's built rather than making the client wait
+    path, chunks = snapshots.current_or_stream(district=district)
+    if path:
+        return FileResponse(open(path, 'rb'), content_type='application/geo+json', filename=name)
+
+    return StreamingHttpResponse(
+        chunks,
         content_type='application/geo+json',
+        headers={"Content-Disposition": f'inline; filename="{name}"'},
     )
 
-    dump(result, response)
+MAX_NEAREST = 100
+
+
+def nearest_dependencies(request):
+    return [DOVE if request.GET.get('source') == 'dove' else ALL_TOWERS]
 
-    return response
 
-def as_csv(model, request, queryset=None):
+@data_condition(nearest_dependencies)
+def nearest_towers(request):
+    """
+    GeoJSON for the towers nearest to ?lat=&lng= or ?postcode=, optionally
+    with ?k=, ?source=towers|dove, ?bells__gte= and ?ringing_status=
+    """
+
+    params = request.GET
+    try:
+        if 'postcode' in params:
+            location = nearest.postcode_location(params['postcode'])
+            if location is None:
+                raise Http404(f"Postcode '{params['postcode']}' not found")
+            lat, lng = location
+        else:
+            lat, lng = float(params['lat']), float(params['lng'])
+        k = int(params.get('k', 10))
+        bells__gte = int(params['bells__gte']) if 'bells__gte' in params else None
+        ringing_status = _choices(Tower.RingingStatus)(params['ringing_status']) if 'ringing_status' in params else None
+    except KeyError as e:
+        raise BadRequest(f"Missing parameter {e}")
+    except ValueError as e:
+        raise BadRequest(f"Bad parameter: {e}")
+
+    source = params.get('source', 'towers')
+    if source not in nearest.SOURCES:
+        raise BadRequest(f"Unknown source '{source}'")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 1 <= k <= MAX_NEAREST):
+        raise BadRequest(f"Position out of range or k not between 1 and {MAX_NEAREST}")
+
+    features = []
+    for distance, place in nearest.nearest(lat, lng, k, source, bells__gte, ringing_status):
+        properties = place._asdict()
+        del properties['id'], properties['lat'], properties['lng']
+        properties['distance'] = round(distance, 3)
+        features.append(Feature(id=place.id, geometry=Point((place.lng, place.lat)), properties=properties))
+
+    return HttpResponse(as_json(FeatureCollection(features)), content_type='application/geo+json')
+
+
+MAX_SEARCH = search.LIMIT
+
+
+@data_condition(lambda request, **kwargs: [ALL_TOWERS])
+def search_towers(request):
+    """
+    Towers matching ?q= (see search.py), best match first, optionally
+    with ?limit=
+    """
+
+    query = request.GET.get('q', '')
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError as e:
+        raise BadRequest(f"Bad parameter: {e}")
+    if not 1 <= limit <= MAX_SEARCH:
+        raise BadRequest(f"limit must be between 1 and {MAX_SEARCH}")
+
+    pks = search.search(query, limit)
+    towers = Tower.objects.only('place', 'dedication', 'bells', 'ringing_status', 'district').in_bulk(pks)
+    results = [{
+        'id': tower.pk,
+        'place': tower.place,
+        'dedication': tower.dedication,
+        'bells': tower.bells,
+        'ringing_status': tower.ringing_status,
+        'district': tower.district,
+        'url': tower.get_absolute_url(),
+    } for tower in (towers[pk] for pk in pks if pk in towers)]
+
+    return JsonResponse({'query': query, 'results': results})
+
+
+@data_condition(geojson_dependencies)
+def markers(request, district=None):
+    """
+    The compact marker feed for the map (see serializers.markers_as_json)
+    """
+
+    if district and district not in Tower.Districts.values:
+        raise Http404(f"No such district '{district}'")
+
+    dependencies = geojson_dependencies(request, district=district)
+    key = versioned_key(f'markers:{district or "all"}', *dependencies)
+    content = cache.get(key)
+    if content is None:
+        towers = Tower.objects.all()
+        if district:
+            towers = towers.filter(district=district)
+        content = markers_as_json(towers)
+        cache.set(key, content, None)
+
+    return HttpResponse(content, content_type='application/json')
+
+
+def as_csv(model, request, queryset=None, omit=()):
 
     response = HttpResponse(
         content_type="text/csv",
@@ -225,10 +686,10 @@ def as_csv(model, request, queryset=None):
     )
     writer = csv.writer(response)
 
-    fields = [f.name for f in model._meta.fields]
+    fields = [f.name for f in model._meta.fields if f.name not in omit]
     writer.writerow(fields)
 
-    if not queryset:
+    if queryset is None:
         queryset = model.objects.all()
 
     for row in queryset.values(*fields):
@@ -236,15 +697,23 @@ def as_csv(model, request, queryset=None):
 
     return response
 
+def csv_dependencies(request):
+    # Every change to any of the exported models bumps ALL_TOWERS
+    return [ALL_TOWERS]
+
+@data_condition(csv_dependencies)
 def tower_csv(response):
-    return as_csv(Tower, response)
+    return as_csv(Tower, response, omit=DERIVED)
 
+@data_condition(csv_dependencies)
 def contact_csv(response):
     queryset = Contact.objects.filter(publish=True)
     return as_csv(Contact, response, queryset)
 
+@data_condition(csv_dependencies)
 def website_csv(response):
     return as_csv(Website, response)
 
+@data_condition(csv_dependencies)
 def photo_csv(response):
     return as_csv(Photo, response)
@@ -1,3 +1,3 @@
 #!/bin/bash
 
-sqlite3 eda/db.sqlite3 "drop table if exists dove_towers" ".mode csv" ".import dove.csv dove_towers"
\ No newline at end of file
+cd eda && ./manage.py load_dove ../dove.csv
@@ -12,6 +12,8 @@ export DJANGO_SETTINGS_MODULE=eda.production_settings
 
 ./manage.py collectstatic --no-input
 ./manage.py migrate
+./manage.py backfill_os_grid
+./manage.py build_boundary_lod
 
 echo "Now reload from the web console"
 echo ""